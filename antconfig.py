@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+"""antconfig.py: Read antenna layout files (CASA .cfg, listobs text) without eval, cached as memory-mapped .npy files."""
+
+import os
+import hashlib
+
+import numpy as np
+
+
+## Layout files offered as array configurations (configtype 'file:<name>'), and where their parsed
+## forms are cached. SIMMER_ANTCONFIG_CACHE moves the cache (e.g. if antconfigs/ is read-only).
+config_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'antconfigs')
+cache_dir = os.environ.get('SIMMER_ANTCONFIG_CACHE', os.path.join(config_dir, '.cache'))
+config_extensions = ['.cfg', '.txt']
+
+## One record per antenna. Names longer than 16 characters are truncated.
+layout_dtype = np.dtype([('name','U16'), ('east','f8'), ('north','f8'), ('elev','f8'), ('diam','f8')])
+
+## Parsed layouts already loaded in this process, by (path, size, mtime).
+loaded = {}
+
+
+def listConfigs(directory=None):
+    """
+    Names of the layout files in the configuration directory.
+    """
+    directory = config_dir if directory is None else directory
+    if not os.path.isdir(directory):
+        return []
+    return sorted(fname for fname in os.listdir(directory)
+                  if os.path.splitext(fname)[1] in config_extensions and not fname.startswith('.'))
+
+
+def findConfig(name):
+    """
+    Path of a layout file, given by its name in the configuration directory (one of listConfigs()).
+    Names come from clients (configtype 'file:<name>'), so no other file can be read : names with
+    directories in them (or '..') and names of files that are not offered are rejected.
+    """
+    name = str(name)
+    if '/' in name or '\\' in name or '..' in name or os.path.isabs(name) or name not in listConfigs():
+        raise ValueError("Unknown antenna layout file : %r"%(name))
+    return os.path.join(config_dir, name)
+
+
+def toNumbers(rows, cols, fname, lineidx):
+    """
+    The given columns of the rows (lists of tokens) as a float array (nrow, ncol), converted in one go.
+    A bad value is reported with its line number.
+    """
+    tokens = np.array([[row[col] for col in cols] for row in rows], dtype='U40')
+    try:
+        return tokens.astype('float')
+    except ValueError:
+        for idx in range(len(rows)):
+            for col in cols:
+                try:
+                    float(rows[idx][col])
+                except ValueError:
+                    raise ValueError("%s, line %d : not a number : %s"%(fname, lineidx[idx]+1, rows[idx][col]))
+        raise
+
+
+def localFromGeocentric(xyz):
+    """
+    East, North, Up offsets (m) of geocentric (ITRF) X, Y, Z positions from their mean position.
+    """
+    cen = np.mean(xyz, axis=0)
+    lon = np.arctan2(cen[1], cen[0])
+    lat = np.arctan2(cen[2], np.hypot(cen[0], cen[1]))
+    rot = np.array([[-np.sin(lon),              np.cos(lon),              0.0],
+                    [-np.sin(lat)*np.cos(lon), -np.sin(lat)*np.sin(lon), np.cos(lat)],
+                    [ np.cos(lat)*np.cos(lon),  np.cos(lat)*np.sin(lon), np.sin(lat)]])
+    return np.dot(xyz-cen, rot.T)
+
+
+def parseLayout(fname):
+    """
+    Read an antenna layout file into a layout_dtype array. Formats :
+      CASA .cfg     : header comments ('# coordsys=LOC' for local East North Up, or XYZ for geocentric),
+                      then one antenna per line : x y z diam [name]
+      listobs text  : the antenna table printed by listobs (column titles are skipped), one antenna per line starting with its ID :
+                      ID Name [Station] Diam m Long Lat East North Elev ...
+    Lines are split and converted column by column (no eval), and checked for the number of columns,
+    numbers, finite positions and positive diameters.
+    """
+    with open(fname) as fp:
+        lines = fp.read().splitlines()
+    header = {}
+    rows, lineidx = [], []
+    for idx, line in enumerate(lines):
+        text = line.strip()
+        if text.startswith('#'):
+            if '=' in text:
+                key, val = text.lstrip('#').split('=',1)
+                header[key.strip().lower()] = val.strip().split()[0] if val.strip() else ''
+            continue
+        if text:
+            rows.append(text.split())
+            lineidx.append(idx)
+    if len(rows)==0:
+        raise ValueError("%s : no antennas"%(fname))
+
+    ## listobs tables : antenna lines start with an integer ID, and have the diameter just before an 'm'.
+    ## Any other lines (the table's column titles) are skipped.
+    isant = [row[0].isdigit() and 'm' in row[2:5] for row in rows]
+    if any(isant):
+        rows = [row for row, ant in zip(rows, isant) if ant]
+        lineidx = [idx for idx, ant in zip(lineidx, isant) if ant]
+        mcol = [row.index('m', 2) for row in rows]
+        if len(set(mcol)) > 1 or mcol[0]+6 > min(len(row) for row in rows):
+            raise ValueError("%s : inconsistent listobs columns"%(fname))
+        dcol = mcol[0]-1
+        nums = toNumbers(rows, [dcol, dcol+4, dcol+5, dcol+6], fname, lineidx)
+        diams, enu = nums[:,0], nums[:,1:4]
+        names = [row[1] for row in rows]
+    else:
+        ncols = set(len(row) for row in rows)
+        if min(ncols) < 4:
+            bad = [idx for idx in range(len(rows)) if len(rows[idx]) < 4][0]
+            raise ValueError("%s, line %d : expected x y z diam [name]"%(fname, lineidx[bad]+1))
+        nums = toNumbers(rows, [0,1,2,3], fname, lineidx)
+        diams = nums[:,3]
+        names = [row[4] if len(row) > 4 else 'A%d'%(idx) for idx, row in enumerate(rows)]
+        coordsys = header.get('coordsys', 'LOC').upper()
+        if coordsys=='LOC':
+            enu = nums[:,0:3]
+        elif coordsys=='XYZ':
+            enu = localFromGeocentric(nums[:,0:3])
+        else:
+            raise ValueError("%s : unsupported coordsys %s (use LOC or XYZ)"%(fname, coordsys))
+
+    if not np.all(np.isfinite(enu)):
+        raise ValueError("%s : positions must be finite"%(fname))
+    if not np.all(diams > 0):
+        bad = int(np.flatnonzero(~(diams > 0))[0])
+        raise ValueError("%s, line %d : dish diameter must be positive"%(fname, lineidx[bad]+1))
+
+    layout = np.zeros(len(rows), layout_dtype)
+    layout['name'] = names
+    layout['east'], layout['north'], layout['elev'] = enu[:,0], enu[:,1], enu[:,2]
+    layout['diam'] = diams
+    return layout
+
+
+def layoutStamp(name):
+    """
+    (path, size, modification time) of a layout file, which changes whenever the file does.
+    """
+    path = os.path.abspath(findConfig(name))
+    stat = os.stat(path)
+    return (path, stat.st_size, stat.st_mtime_ns)
+
+
+def loadLayout(name, cachedir=None):
+    """
+    The layout (a read-only layout_dtype array) of a layout file, from the binary cache if the file
+    is unchanged since it was cached (same path, size and modification time), else parsed and cached.
+    Cached layouts are memory-mapped, so even very large arrays load in well under a millisecond.
+    """
+    stamp = layoutStamp(name)
+    path = stamp[0]
+    if stamp in loaded:
+        return loaded[stamp]
+
+    cachedir = cache_dir if cachedir is None else cachedir
+    digest = hashlib.sha1(repr(stamp).encode('utf-8')).hexdigest()[0:12]
+    cachename = os.path.join(cachedir, '%s.%s.npy'%(os.path.basename(path), digest))
+    if os.path.exists(cachename):
+        layout = np.load(cachename, mmap_mode='r')
+    else:
+        layout = parseLayout(path)
+        try:
+            os.makedirs(cachedir, exist_ok=True)
+            ## Written under a temporary name and renamed, so a cache file that exists is complete.
+            tmpname = cachename+'.%d.tmp.npy'%(os.getpid())
+            np.save(tmpname, layout)
+            os.replace(tmpname, cachename)
+            layout = np.load(cachename, mmap_mode='r')
+        except OSError:
+            layout.setflags(write=False)
+    loaded[stamp] = layout
+    return layout
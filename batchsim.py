@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+
+"""batchsim.py: Headless parameter sweeps of the imaging simulator, over a process pool, streamed to disk."""
+
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import multiprocessing
+
+import numpy as np
+
+from calcsim import CalcSim
+from diskcache import DiskCache
+from deconvolver import restore, fitBeam
+
+
+## Order of the sweep axes. The last ones vary fastest, so consecutive jobs (which go to the
+## same worker in chunks) mostly differ in the cheap, late pipeline stages.
+sweep_order = ['configtype', 'nant', 'zoom', 'randseed', 'dishdiam', 'obslatitude', 'dec', 'has', 'inttime', 'bwr', 'nchan', 'chanwidth',
+               'npix', 'cellsize', 'padding', 'precision', 'imtype', 'primarybeam', 'gaintype', 'gainamp', 'gainphase', 'gainseed',
+               'tsys', 'noisemode', 'noiseseed', 'cleanalgo', 'cleaniter', 'cleangain', 'cleanthresh', 'specmode', 'weighting']
+
+## Arrays that can be saved per simulation, and where they live on a CalcSim after simulate().
+products = {'psf'    : lambda sim : sim.psf,
+            'uvcov'  : lambda sim : sim.uvcov,
+            'image'  : lambda sim : sim.obssky,
+            'sky'    : lambda sim : sim.sky,
+            'pbeam'  : lambda sim : sim.pbimage if sim.pbimage is not None else np.zeros(0),
+            'clean'  : lambda sim : sim.cleanimage,
+            'model'  : lambda sim : sim.cleanmodel if sim.cleanmodel is not None else np.zeros(0),
+            'cube'   : lambda sim : sim.cube if sim.cube is not None else np.zeros(0),
+            'antpos' : lambda sim : np.stack([sim.antennalist['EastLoc'], sim.antennalist['NorthLoc'],
+                                              sim.antennalist['ElevLoc']], axis=-1)}
+
+
+def expandSweep(spec):
+    """
+    All parameter combinations of a sweep spec : a dict of CalcSim parameter (or 'randseed') ->
+    list of values (a single value is a list of one). Ranges such as 'has' and 'bwr' are
+    given as [start, end] pairs, so a list of them is a list of pairs.
+    Returns a list of parameter dicts, with the 'weighting' values varying fastest.
+    """
+    axes = []
+    for par in spec:
+        if par not in sweep_order:
+            raise ValueError("Unknown sweep parameter : "+str(par))
+    for par in sweep_order:
+        if par not in spec:
+            continue
+        vals = spec[par]
+        if not isinstance(vals, (list, tuple)) or (par in ['has','bwr'] and not isinstance(vals[0], (list, tuple))):
+            vals = [vals]
+        axes.append( [(par, val) for val in vals] )
+    return [dict(combo) for combo in itertools.product(*axes)]
+
+
+def summaryMetrics(sim):
+    """
+    Figures of merit for one simulation :
+      sumwt          : peak of the unnormalised PSF (sum of weights),
+      beam_area      : PSF main lobe area (pixels above half power),
+      psf_sidelobe   : largest |PSF| outside the main lobe (twice its half-power radius),
+      uv_filled      : fraction of uv cells within the longest baseline that are sampled,
+      image_peak/rms : of the dirty image,
+      image_error    : rms of (dirty image - sky), relative to the sky peak,
+      noise_rms      : expected thermal noise in the image (Jy/beam),
+      clean_iterations, clean_error : CLEAN components, and the rms of (restored image - sky convolved
+                       with the clean beam) relative to its peak (None without CLEAN).
+    The image is the sky mirrored about the centre (it is the transform of the sky's transform), so it
+    is compared with the mirrored sky.
+    """
+    psf = sim.psf
+    cen = psf.shape[0]//2
+    mainlobe = psf >= 0.5
+    beam_area = int(np.count_nonzero(mainlobe))
+    rad = 2*np.sqrt(beam_area/np.pi)
+    yy, xx = np.ogrid[0:psf.shape[0], 0:psf.shape[1]]
+    outside = (xx-cen)**2 + (yy-cen)**2 > rad**2
+    sidelobe = float(np.max(np.abs(psf[outside]))) if np.any(outside) else 0.0
+
+    counts = sim.uvcounts
+    ucen = counts.shape[0]//2
+    vv, uu = np.nonzero(counts)
+    uvdist2 = (uu-ucen)**2 + (vv-ucen)**2
+    uvmax2 = np.max(uvdist2) if len(uvdist2)>0 else 0
+    yy, xx = np.ogrid[0:counts.shape[0], 0:counts.shape[1]]
+    ninside = np.count_nonzero( (xx-ucen)**2 + (yy-ucen)**2 <= uvmax2 )
+
+    image = sim.obssky
+    sky = np.roll(sim.sky[::-1,::-1], 1, axis=(0,1))
+    skypeak = float(np.max(np.abs(sky)))
+    clean_error = None
+    if sim.cleanmodel is not None:
+        smoothsky = restore(sky, np.zeros_like(sky), fitBeam(psf))
+        clean_error = float(np.sqrt(np.mean((sim.cleanimage-smoothsky).astype('float64')**2)))/max(float(np.max(np.abs(smoothsky))),1e-30)
+    return {'sumwt' : float(sim.sumwt),
+            'beam_area' : beam_area,
+            'psf_sidelobe' : sidelobe,
+            'uv_filled' : float(len(uvdist2))/max(ninside,1),
+            'image_peak' : float(np.max(image)),
+            'image_rms' : float(np.sqrt(np.mean(image.astype('float64')**2))),
+            'image_error' : float(np.sqrt(np.mean((image-sky).astype('float64')**2)))/max(skypeak,1e-30),
+            'noise_rms' : sim.noiserms,
+            'clean_iterations' : int(sim.cleaniterdone),
+            'clean_error' : clean_error}
+
+
+## One simulator per worker process, reused across its jobs (so unchanged stages are not recomputed).
+worker_sim = None
+
+def runJob(job):
+    """
+    Simulate one parameter set, save its arrays (if any are requested) and return its record.
+    """
+    global worker_sim
+    index, params, outdir, save, cachedir = job
+    if worker_sim is None:
+        ## All workers (and later sweeps, or the web app) share the on-disk cache, if any.
+        worker_sim = CalcSim(cache=DiskCache(cachedir) if cachedir else None)
+    sim = worker_sim
+    params = dict(params)
+    sim.randseed = params.pop('randseed', 1)
+
+    tim1 = time.time()
+    sim.simulate(stage='clean', **params)
+    sim.runStage('cube')
+    recomputed = sim.getRecomputed()
+    tim2 = time.time()
+
+    record = {'index':index, 'params':params, 'randseed':sim.randseed, 'metrics':summaryMetrics(sim),
+              'recomputed':recomputed, 'time':round(tim2-tim1,4), 'worker':os.getpid()}
+    if len(save)>0:
+        fname = 'sim_%06d.npz'%(index)
+        ## Written under a temporary name and renamed, so a file that exists is complete.
+        tmpname = os.path.join(outdir, fname+'.tmp.npz')
+        np.savez(tmpname, **{name:products[name](sim) for name in save})
+        os.replace(tmpname, os.path.join(outdir, fname))
+        record['file'] = fname
+    return record
+
+
+def readRecords(outdir):
+    """
+    The records written so far by runSweep() into outdir (from its results.jsonl).
+    """
+    fname = os.path.join(outdir, 'results.jsonl')
+    if not os.path.exists(fname):
+        return []
+    records = []
+    with open(fname) as fp:
+        for line in fp:
+            line = line.strip()
+            if line:
+                records.append( json.loads(line) )
+    return records
+
+
+def runSweep(spec, outdir, processes=None, save=('psf','uvcov','image'), resume=False, chunksize=None, cachedir=None):
+    """
+    Run all the simulations of a sweep spec (see expandSweep) on a pool of worker processes.
+
+    Each simulation's arrays (those named in 'save', from 'products') go to outdir/sim_<index>.npz
+    and its parameters and summaryMetrics() are appended to outdir/results.jsonl, as soon as it finishes
+    (so results stream in, in completion order). With resume=True, jobs already in results.jsonl are skipped.
+    With a cachedir, the uv coverage, PSF and sky products are shared through a diskcache.DiskCache there.
+
+    This is a generator of the records, in completion order.
+    """
+    for name in save:
+        if name not in products:
+            raise ValueError("Unknown product : "+str(name))
+    os.makedirs(outdir, exist_ok=True)
+    paramsets = expandSweep(spec)
+    done = set(rec['index'] for rec in readRecords(outdir)) if resume else set()
+    jobs = [(index, params, outdir, tuple(save), cachedir) for index, params in enumerate(paramsets) if index not in done]
+
+    if chunksize is None:
+        ## Whole runs of the fastest axis per chunk, so a worker sweeps the weighting on one uv coverage.
+        chunksize = len(spec['weighting']) if isinstance(spec.get('weighting'), (list, tuple)) else 1
+
+    with open(os.path.join(outdir, 'results.jsonl'), 'a' if resume else 'w') as fp:
+        if processes==1:
+            results = map(runJob, jobs)
+            pool = None
+        else:
+            pool = multiprocessing.Pool(processes)
+            results = pool.imap_unordered(runJob, jobs, chunksize=chunksize)
+        try:
+            for record in results:
+                fp.write(json.dumps(record)+'\n')
+                fp.flush()
+                yield record
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+
+def parseRange(text):
+    """
+    '1.2,1.6' or '[-1,1]' -> [start, end]. (The brackets keep argparse from reading a negative start as an option.)
+    """
+    vals = [float(val) for val in text.strip('[] ').split(',')]
+    if len(vals)==1:
+        vals = vals*2
+    if len(vals)!=2:
+        raise argparse.ArgumentTypeError("Expected start,end : "+text)
+    return vals
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a sweep of imaging simulations and save the results.')
+    parser.add_argument('outdir', help='output directory (results.jsonl and sim_<index>.npz files)')
+    parser.add_argument('--spec', help='JSON file with the sweep spec (parameter -> list of values); '
+                                       'the options below add to or override it')
+    parser.add_argument('--config', nargs='+', dest='configtype', help='array configurations, e.g. YConfig SpiralConfig')
+    parser.add_argument('--nant', nargs='+', type=int)
+    parser.add_argument('--zoom', nargs='+', type=float)
+    parser.add_argument('--seed', nargs='+', type=int, dest='randseed', help='seeds for the random configurations')
+    parser.add_argument('--dec', nargs='+', type=float, help='declinations (deg)')
+    parser.add_argument('--lat', nargs='+', type=float, dest='obslatitude', help='observatory latitudes (deg)')
+    parser.add_argument('--has', nargs='+', type=parseRange, help='hour angle ranges (h), as start,end or [start,end]')
+    parser.add_argument('--bwr', nargs='+', type=parseRange, help='frequency ranges (GHz), as start,end or [start,end]')
+    parser.add_argument('--inttime', nargs='+', type=float, help='integration times (sec)')
+    parser.add_argument('--nchan', nargs='+', type=int, help='numbers of channels across the band (0 : one every chanwidth)')
+    parser.add_argument('--chanwidth', nargs='+', type=float, help='channel widths (GHz)')
+    parser.add_argument('--specmode', nargs='+', choices=['mfs','cube'], help='image of all channels (mfs), or also a cube (save it with --save cube)')
+    parser.add_argument('--weighting', nargs='+', type=float, help='robustness values (0.5 uniform .. 3.7 natural)')
+    parser.add_argument('--source', nargs='+', dest='imtype', help='sky models : im1, im2, im3, im4 (with spectral indices)')
+    parser.add_argument('--dishdiam', nargs='+', type=float, help='dish diameters (m)')
+    parser.add_argument('--primarybeam', nargs='+', type=int, choices=[0,1], help='attenuate the sky by the primary beam (1) or not (0)')
+    parser.add_argument('--gaintype', nargs='+', choices=['offset','randomwalk','screen'], help='type of antenna gain errors')
+    parser.add_argument('--gainamp', nargs='+', type=float, help='rms fractional amplitude errors of the antenna gains')
+    parser.add_argument('--gainphase', nargs='+', type=float, help='rms phase errors of the antenna gains (deg)')
+    parser.add_argument('--gainseed', nargs='+', type=int)
+    parser.add_argument('--clean', nargs='+', dest='cleanalgo', choices=['none','hogbom','clark'], help='CLEAN deconvolution')
+    parser.add_argument('--cleaniter', nargs='+', type=int, help='CLEAN iterations')
+    parser.add_argument('--cleangain', nargs='+', type=float, help='CLEAN loop gain')
+    parser.add_argument('--cleanthresh', nargs='+', type=float, help='CLEAN threshold, as a fraction of the dirty image peak')
+    parser.add_argument('--tsys', nargs='+', type=float, help='system temperatures (K) for thermal noise (0 : none)')
+    parser.add_argument('--noisemode', nargs='+', choices=['gridded','visibility'])
+    parser.add_argument('--noiseseed', nargs='+', type=int)
+    parser.add_argument('--npix', nargs='+', type=int)
+    parser.add_argument('--cellsize', nargs='+', type=float, help='(arcsec)')
+    parser.add_argument('--padding', nargs='+', type=float)
+    parser.add_argument('--precision', nargs='+', choices=['double','single'])
+    parser.add_argument('--save', default='psf,uvcov,image',
+                        help='comma separated arrays to save per simulation, from : '+','.join(products)+' (empty : metrics only)')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes (default : all cores)')
+    parser.add_argument('--cache-dir', default=None, help='on-disk product cache shared by the workers (e.g. the web app\'s .simmer_cache)')
+    parser.add_argument('--resume', action='store_true', help='skip the simulations already in outdir/results.jsonl')
+    args = parser.parse_args(argv)
+
+    spec = {}
+    if args.spec:
+        with open(args.spec) as fp:
+            spec = json.load(fp)
+    for par in sweep_order:
+        if getattr(args, par, None) is not None:
+            spec[par] = getattr(args, par)
+    if 'primarybeam' in spec:
+        spec['primarybeam'] = [bool(val) for val in spec['primarybeam']]
+    save = [name for name in args.save.split(',') if name]
+
+    njobs = len(expandSweep(spec))
+    print('Running %d simulations into %s'%(njobs, args.outdir))
+    tim1 = time.time()
+    ndone = 0
+    for record in runSweep(spec, args.outdir, processes=args.processes, save=save, resume=args.resume, cachedir=args.cache_dir):
+        ndone += 1
+        print('[%d/%d] #%d %s : sidelobe %.3f, beam %d pix (%.2f s)'%(ndone, njobs, record['index'],
+              ' '.join('%s=%s'%(par, record['params'][par]) for par in record['params']),
+              record['metrics']['psf_sidelobe'], record['metrics']['beam_area'], record['time']))
+    print('Done in %.1f s'%(time.time()-tim1))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+
+"""benchmark.py: Wall time and peak memory of each simulator stage, across array size, image size and track length."""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import tracemalloc
+
+import numpy as np
+
+import antconfig
+from calcsim import CalcSim
+from fftbackend import getBackend
+
+
+## The benchmark matrix
+nants = [12, 32, 60, 256, 1024]
+npixs = [256, 512, 1024, 2048]
+tracks = {'short':[-1.0,+1.0], 'full':[-6.0,+6.0]}
+
+## A smaller matrix, for a quick check.
+quick_nants = [12, 60, 256]
+quick_npixs = [256, 1024]
+
+## Where result files go by default (not under version control).
+results_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks')
+
+
+def forget(sim, stages):
+    """
+    Drop the memoized products of these stages, so that the next call recomputes them.
+    """
+    for stage in stages:
+        sim.stages.pop(stage, None)
+
+
+def measure(func, setup=None, repeat=3, memory=True):
+    """
+    Minimum and median wall time (sec) of func() over 'repeat' runs (each after setup()),
+    and the peak memory (bytes) allocated during one more run, traced separately
+    (tracemalloc slows things down, so it is not on while timing).
+    """
+    times = []
+    for rep in range(repeat):
+        if setup is not None:
+            setup()
+        tim1 = time.perf_counter()
+        func()
+        times.append(time.perf_counter()-tim1)
+    peak = None
+    if memory:
+        if setup is not None:
+            setup()
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {'wall_min':min(times), 'wall_median':float(np.median(times)), 'repeat':repeat, 'peak_bytes':peak}
+
+
+def stageBenchmarks(nant, npix, track):
+    """
+    (name, setup, func) for each of the simulator's steps, on one simulator set up for these
+    parameters. Each setup() makes its func() recompute the step (and only that step, where possible).
+    """
+    has = tracks[track]
+    sim = CalcSim(npix=npix)
+    sim.simulate(configtype='SpiralConfig', nant=nant, has=has, imtype='im3')
+    cen = npix//2
+
+    def makeUVcov():
+        sim.makeUVcov(has=has, dec=sim.params['dec'], obslatitude=sim.params['obslatitude'],
+                      weighting=sim.params['weighting'], bwr=sim.params['bwr'])
+    def setsky():
+        sim.setsky('im3')
+        sim.drawGaussian(cen, cen, 1.0, 4.0)
+
+    return [
+        ('calcAntList',    lambda : forget(sim, ['antennas']),
+                           lambda : sim.calcAntList(configtype='SpiralConfig', nant=nant)),
+        ('getAntUVWs',     None,
+                           lambda : sim.getAntUVWs(hourangle=0.0, declination=60.0, obslatitude=34.0)),
+        ('loadLayout',     lambda : antconfig.loaded.clear(),
+                           lambda : antconfig.loadLayout('large_array_1024.cfg')),
+        ('calcAntUVWList', None,
+                           lambda : sim.calcAntUVWList(has=has, dec=60.0, obslatitude=34.0)),
+        ('stage_uvws',     lambda : forget(sim, ['uvws']),      lambda : sim.runStage('uvws')),
+        ('stage_sampling', lambda : forget(sim, ['sampling']),  lambda : sim.runStage('sampling')),
+        ('stage_weighting',lambda : forget(sim, ['weighting']), lambda : sim.runStage('weighting')),
+        ('stage_psf',      lambda : forget(sim, ['psf']),       lambda : sim.runStage('psf')),
+        ('makeUVcov',      lambda : forget(sim, ['uvws','sampling','weighting','psf']), makeUVcov),
+        ('setsky',         lambda : forget(sim, ['sky']), setsky),
+        ('makeImage',      lambda : forget(sim, ['image']), sim.makeImage),
+        ('simulate',       lambda : sim.stages.clear(), lambda : sim.simulate()),
+        ('clean_hogbom',   lambda : (sim.setParams(cleanalgo='hogbom', cleaniter=500), forget(sim, ['clean'])),
+                           lambda : sim.runStage('clean')),
+        ('clean_clark',    lambda : (sim.setParams(cleanalgo='clark', cleaniter=500), forget(sim, ['clean'])),
+                           lambda : sim.runStage('clean')),
+        ## Last, as they leave gain errors, and then 16 channels of a spectral sky, switched on.
+        ('stage_corruption', lambda : (sim.setParams(gaintype='screen', gainphase=10.0, gainamp=0.05),
+                                       forget(sim, ['gains','corruption'])), lambda : sim.runStage('corruption')),
+        ('stage_skyvis',   lambda : (sim.setParams(imtype='im4', bwr=[1.0,2.0], nchan=16), sim.runStage('psf'),
+                                     sim.runStage('skyobs'), forget(sim, ['skyvis'])), lambda : sim.runStage('skyvis')),
+        ('stage_cube',     lambda : (sim.setParams(specmode='cube'), forget(sim, ['cube'])), lambda : sim.runStage('cube')),
+        ## The uv tracks of 2 s integrations (rasterised : as fast as the default 15 min ones, for the same grid).
+        ('tracks_2s',      lambda : (sim.setParams(nchan=0, specmode='mfs', inttime=2.0), forget(sim, ['uvws','sampling'])),
+                           lambda : sim.runStage('sampling')),
+    ]
+
+
+def callbackBenchmark(nant, npix, track):
+    """
+    (name, setup, func) for the web app's callback chain (antennas -> uv coverage -> image),
+    as the browser would call it after a change of array, through the Flask test client.
+    """
+    ## Without the on-disk cache or the startup warmup, so that every run computes (unless it is already imported).
+    os.environ.setdefault('SIMMER_CACHE_DIR', '')
+    os.environ.setdefault('SIMMER_WARMUP', '0')
+    import simmer
+
+    ## No background prefetching, which would compete with the timed requests.
+    simmer.prefetcher.budget = 0
+    client = simmer.app.server.test_client()
+    values = {'config-dropdown':'SpiralConfig', 'nant-dropdown':str(nant), 'zoom-slider':0.0, 'dishdiam-dropdown':25.0,
+              'timerange-slider':tracks[track], 'freqrange-slider':[1.5,1.5],
+              'declination-picker':60, 'latitude-picker':34, 'weighting-picker':3.5,
+              'npix-dropdown':npix, 'cellsize-dropdown':5.0, 'padding-dropdown':1.0,
+              'source-dropdown':'im3', 'noise-slider':0, 'primarybeam-checklist':[],
+              'gaintype-dropdown':'offset', 'gainphase-slider':0, 'gainamp-slider':0,
+              'cleanalgo-dropdown':'none', 'cleaniter-slider':500, 'cleangain-slider':0.1, 'cleanthresh-slider':0,
+              'channels-dropdown':0, 'chanwidth-dropdown':0.1, 'specmode-dropdown':'mfs', 'cubechan-slider':0,
+              'inttime-dropdown':900.0,
+              'colorscale-dropdown':'RdBu', 'session-id':'benchmark'}
+    chain = [dep for dep in client.get('/_dash-dependencies').get_json()
+             if dep.get('clientside_function') is None and 'allow_duplicate' not in str(dep)
+             and '@' not in dep['output']]
+    order = ['antenna-store', 'uvcov-image', 'observed-image']
+    chain = sorted([dep for dep in chain if any(name in dep['output'] for name in order)],
+                   key=lambda dep : [name in dep['output'] for name in order].index(True))
+
+    def request(dep, stores):
+        def prop(item):
+            return {'id':item['id'], 'property':item['property'],
+                    'value':stores.get(item['id'], values.get(item['id']))}
+        outputs = [ {'id':out.split('.')[0], 'property':out.split('.')[1]}
+                    for out in dep['output'].strip('.').split('...') ]
+        body = {'output':dep['output'], 'outputs':outputs if len(outputs)>1 else outputs[0],
+                'inputs':[prop(item) for item in dep['inputs']],
+                'state':[prop(item) for item in dep.get('state',[])],
+                'changedPropIds':[dep['inputs'][0]['id']+'.'+dep['inputs'][0]['property']]}
+        resp = client.post('/_dash-update-component', json=body)
+        if resp.status_code!=200:
+            raise RuntimeError("Callback failed : "+resp.get_data(as_text=True)[0:500])
+        return resp
+
+    def run():
+        ## Each step's stores feed the next, as in the browser (with nothing sent before).
+        stores = {}
+        nbytes = 0
+        for dep in chain:
+            resp = request(dep, stores)
+            nbytes += len(resp.data)
+            for cid, props in resp.get_json()['response'].items():
+                if 'data' in props:
+                    stores[cid] = props['data']
+        run.nbytes = nbytes
+
+    def setup():
+        simmer.results.clear()
+        simmer.sessions.get('benchmark')[0].stages.clear()
+
+    return [('callbacks', setup, run)]
+
+
+## Run in a new interpreter by startupBenchmark : times the import of the web app, and the first
+## page load and callback chain (as a browser's first visit) after it. Prints them as JSON.
+startup_script = '''
+import time, json
+tim0 = time.perf_counter()
+import simmer
+tim1 = time.perf_counter()
+import benchmark
+name, setup, run = benchmark.callbackBenchmark(%d, %d, %r)[0]
+simmer.app.server.test_client().get('/')
+run()
+tim2 = time.perf_counter()
+print(json.dumps({'import':tim1-tim0, 'first_response':tim2-tim0}))
+'''
+
+def startupBenchmark(nant=12, npix=256, track='short', repeat=3):
+    """
+    Cold start of the web app, each time in a new process (without the on-disk cache, with the startup warmup) :
+    'import_simmer' is the time to import simmer.py, and 'first_response' the time from then until the
+    page and its first callbacks (antennas, uv coverage, image) have been served.
+    """
+    env = dict(os.environ, SIMMER_CACHE_DIR='', SIMMER_WARMUP='1')
+    times = {'import':[], 'first_response':[]}
+    for rep in range(repeat):
+        proc = subprocess.run([sys.executable, '-c', startup_script%(nant, npix, track)], env=env,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+        if proc.returncode!=0:
+            raise RuntimeError("Startup benchmark failed : "+proc.stderr[-500:])
+        for name, val in json.loads(proc.stdout.strip().splitlines()[-1]).items():
+            times[name].append(val)
+    return [ {'name':name, 'nant':nant, 'npix':npix, 'track':track,
+              'wall_min':min(times[key]), 'wall_median':float(np.median(times[key])), 'repeat':repeat, 'peak_bytes':None}
+             for name, key in [('import_simmer','import'), ('first_response','first_response')] ]
+
+
+def getMeta():
+    try:
+        revision = subprocess.run(['git','rev-parse','HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                  capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        revision = None
+    return {'revision':revision, 'date':time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python':platform.python_version(), 'numpy':np.__version__, 'platform':platform.platform(),
+            'cpus':os.cpu_count(), 'fft':getBackend().getName()}
+
+
+def runBenchmarks(nants=nants, npixs=npixs, tracknames=list(tracks), repeat=3, memory=True, callbacks=True,
+                  startup=True, select=None, log=None):
+    """
+    Run the benchmark matrix (and the startup benchmarks, once). Returns {'meta':..., 'results':[one dict
+    per (benchmark, nant, npix, track)]}. 'select' is an optional list of benchmark names to run.
+    """
+    results = []
+    if startup and (select is None or 'import_simmer' in select or 'first_response' in select):
+        for result in startupBenchmark(repeat=repeat):
+            if select is None or result['name'] in select:
+                results.append(result)
+                if log is not None:
+                    log(result)
+    for nant in nants:
+        for npix in npixs:
+            for track in tracknames:
+                benches = stageBenchmarks(nant, npix, track)
+                if callbacks:
+                    benches = benches + callbackBenchmark(nant, npix, track)
+                for name, setup, func in benches:
+                    if select is not None and name not in select:
+                        continue
+                    result = {'name':name, 'nant':nant, 'npix':npix, 'track':track}
+                    result.update( measure(func, setup, repeat=repeat, memory=memory) )
+                    if hasattr(func, 'nbytes'):
+                        result['response_bytes'] = func.nbytes
+                    results.append(result)
+                    if log is not None:
+                        log(result)
+    return {'meta':getMeta(), 'results':results}
+
+
+def compareResults(old, new, threshold=1.2):
+    """
+    Ratios new/old of the median wall time and peak memory for the benchmarks in both runs.
+    Returns a list of (key, time ratio, memory ratio, regressed), where regressed means a ratio above threshold.
+    """
+    def bykey(run):
+        return {(res['name'], res['nant'], res['npix'], res['track']):res for res in run['results']}
+    oldres, newres = bykey(old), bykey(new)
+    rows = []
+    for key in newres:
+        if key not in oldres:
+            continue
+        tratio = newres[key]['wall_median']/max(oldres[key]['wall_median'], 1e-9)
+        mratio = None
+        if newres[key]['peak_bytes'] is not None and oldres[key]['peak_bytes']:
+            mratio = newres[key]['peak_bytes']/float(oldres[key]['peak_bytes'])
+        rows.append( (key, tratio, mratio, tratio > threshold or (mratio is not None and mratio > threshold)) )
+    return rows
+
+
+def printResult(result):
+    print('%-16s nant=%-5d npix=%-5d %-5s : %9.2f ms (min %9.2f)  peak %s'%(result['name'], result['nant'],
+          result['npix'], result['track'], 1000*result['wall_median'], 1000*result['wall_min'],
+          '%8.1f MB'%(result['peak_bytes']/1e6) if result['peak_bytes'] is not None else '-'))
+    sys.stdout.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the simulator stages. Results are written as JSON.')
+    parser.add_argument('-o', '--output', default=None, help='JSON file for the results (default : benchmarks/bench_<revision>.json)')
+    parser.add_argument('--quick', action='store_true', help='smaller matrix : nant '+str(quick_nants)+', npix '+str(quick_npixs))
+    parser.add_argument('--nant', nargs='+', type=int, help='array sizes (default : '+str(nants)+')')
+    parser.add_argument('--npix', nargs='+', type=int, help='image sizes (default : '+str(npixs)+')')
+    parser.add_argument('--track', nargs='+', choices=list(tracks), help='track lengths (default : all)')
+    parser.add_argument('--bench', nargs='+', help='only these benchmarks (e.g. makeUVcov callbacks)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-memory', action='store_true', help='skip the (slower) peak memory measurements')
+    parser.add_argument('--no-callbacks', action='store_true', help='skip the web app callback benchmark')
+    parser.add_argument('--no-startup', action='store_true', help='skip the web app cold start benchmarks (import, first response)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD','NEW'), help='compare two result files instead')
+    parser.add_argument('--threshold', type=float, default=1.2, help='ratio reported as a regression (with --compare)')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as fp:
+            old = json.load(fp)
+        with open(args.compare[1]) as fp:
+            new = json.load(fp)
+        print('Comparing %s (%s) -> %s (%s)'%(args.compare[0], old['meta']['revision'], args.compare[1], new['meta']['revision']))
+        nregressed = 0
+        for key, tratio, mratio, regressed in compareResults(old, new, args.threshold):
+            nregressed += regressed
+            print('%-16s nant=%-5d npix=%-5d %-5s : time x%.2f  memory %s %s'%(key + (tratio,
+                  'x%.2f'%mratio if mratio is not None else '-', '<-- REGRESSION' if regressed else '')))
+        return 1 if nregressed > 0 else 0
+
+    run = runBenchmarks(nants=args.nant or (quick_nants if args.quick else nants),
+                        npixs=args.npix or (quick_npixs if args.quick else npixs),
+                        tracknames=args.track or list(tracks),
+                        repeat=args.repeat, memory=not args.no_memory, callbacks=not args.no_callbacks,
+                        startup=not args.no_startup,
+                        select=args.bench, log=printResult)
+    output = args.output
+    if output is None:
+        os.makedirs(results_dir, exist_ok=True)
+        output = os.path.join(results_dir, 'bench_%s.json'%((run['meta']['revision'] or 'norev')[0:10]))
+    with open(output, 'w') as fp:
+        json.dump(run, fp, indent=1)
+    print('Results written to '+output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+
+"""bufferpool.py: Reusable scratch arrays for the simulator's hot path."""
+
+import numpy as np
+
+
+class BufferPool:
+    """
+    Named scratch arrays that are allocated once and reused across calls, as long as the
+    requested shape and dtype stay the same (i.e. once per image geometry and precision).
+    A pool belongs to one CalcSim, and its buffers must never be handed out as results.
+    """
+
+    def __init__(self):
+        self.buffers = {}
+
+    def get(self, name, shape, dtype):
+        """
+        Uninitialised buffer of this shape and dtype.
+        """
+        shape = tuple(shape)
+        dtype = np.dtype(dtype)
+        buf = self.buffers.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = np.empty(shape, dtype)
+            self.buffers[name] = buf
+        return buf
+
+    def zeros(self, name, shape, dtype):
+        buf = self.get(name, shape, dtype)
+        buf.fill(0)
+        return buf
+
+    def clear(self):
+        self.buffers = {}
+
+    def getSize(self):
+        """
+        Total size (bytes) of all buffers held.
+        """
+        return sum(buf.nbytes for buf in self.buffers.values())
@@ -5,39 +5,345 @@
 __author__      = "Urvashi R.V."
 __email__ = "rurvashi@nrao.edu"
 
-import pylab as pl
 import numpy as np
 import copy
 import time
 
-class CalcSim:
+from gridder import gridVisibilities, gridChannels
+from skymodel import SkyModel, ARCSEC
+from fftbackend import getCentredFT
+from bufferpool import BufferPool
+from primarybeam import apparentBeam
+import deconvolver
+from antconfig import loadLayout, parseLayout, layoutStamp
+from metrics import registry
+
+class SimulationCancelled(Exception):
+    """
+    Raised between pipeline stages when a CalcSim's cancelcheck() reports that its result is no longer wanted.
+    """
+    pass
 
-    def __init__(self):
-        self.npix= 256
+class CalcSim:
 
-        self.antennalist={'EastLoc':[], 'NorthLoc':[], 'ElevLoc':[], 'AntName':[]}
+    clight = 299792458.0
+
+    ## The simulation is a chain of memoized stages :
+    ##   antennas -> uvws -> sampling -> weighting -> psf -> image <- skyvis <- skyobs <- sky
+    ##                          sampling -> noise -> image,   sampling -> skyvis
+    ##   antennas -> beam -> skyobs
+    ##   antennas -> gains -> corruption <- sampling,   corruption -> image
+    ##   image -> clean
+    ##   weighting, skyobs, gains -> cube
+    ## Each stage is keyed by its own parameters and by the keys of the stages it depends on, 
+    ## and is recomputed only when that key changes.
+    ## The stages that grid explicit visibilities also depend on uvws directly : the sample times of the
+    ## uvw tracks are a lazy stage, brought up to date only when a stage that uses them is computed (see runStage).
+    stagedeps = { 'antennas'  : [],
+                  'uvws'      : ['antennas'],
+                  'sampling'  : ['uvws'],
+                  'weighting' : ['sampling'],
+                  'psf'       : ['weighting'],
+                  'sky'       : [],
+                  'beam'      : ['antennas'],
+                  'skyobs'    : ['sky','beam'],
+                  'skyvis'    : ['skyobs','sampling','uvws'],
+                  'noise'     : ['sampling','uvws'],
+                  'gains'     : ['antennas'],
+                  'corruption': ['sampling','gains','uvws'],
+                  'image'     : ['psf','skyvis','noise','corruption'],
+                  'clean'     : ['image'],
+                  'cube'      : ['weighting','skyobs','gains','uvws'] }
+    lazy_stages = ['uvws']
+    stageparams = { 'antennas'  : ['configtype','nant','zoom','randseed'],
+                    'uvws'      : ['has','inttime','dec','obslatitude','bwr','nchan','chanwidth','npix','cellsize','padding'],
+                    'sampling'  : ['npix','cellsize','padding','precision'],
+                    'weighting' : ['weighting'],
+                    'psf'       : [],
+                    'sky'       : ['imtype','npix','cellsize','padding','precision'],
+                    'beam'      : ['primarybeam','dishdiam','bwr','nchan','chanwidth','npix','cellsize','padding','precision'],
+                    'skyobs'    : [],
+                    'skyvis'    : [],
+                    'noise'     : ['tsys','noisemode','noiseseed','dishdiam','chanwidth','inttime'],
+                    'gains'     : ['has','inttime','gaintype','gainamp','gainphase','gainseed'],
+                    'corruption': [],
+                    'image'     : [],
+                    'clean'     : ['cleanalgo','cleaniter','cleangain','cleanthresh'],
+                    'cube'      : ['specmode','tsys','noiseseed','dishdiam'] }
+
+    ## Thermal noise : Boltzmann's constant, and the aperture efficiency of all antennas.
+    ## (Dish diameters are per antenna : see getDishDiams.)
+    kboltzmann = 1.380649e-23
+    apereff = 0.7
+
+    ## Array types for each precision mode : (real, complex)
+    dtypes = { 'double' : ('float64','complex128'),
+               'single' : ('float32','complex64') }
+
+    ## Largest size (bytes) of the per-channel uv grids held at once, when channels are gridded separately.
+    chanchunk_bytes = 64*1024*1024
+
+    ## Largest distance (uv cells) that a baseline's uv track moves between samples, when tracks are rasterised.
+    raster_cells = 0.5
+
+    ## Work space (bytes) that gridding takes per visibility (uvws, scaled coordinates, values, their Hermitian copies
+    ## and int64 cell indices), and the largest work space used at once : the baseline uvws are made and gridded a chunk
+    ## of time samples at a time (see iterSampleChunks), so that gridding needs at most gridchunk_bytes, however long the tracks.
+    vis_bytes = 256
+    gridchunk_bytes = 64*1024*1024
+
+    def __init__(self, cache=None, npix=256, cellsize=5.0, padding=1.0, precision='double'):
+        ## Optional shared cache of stage products (e.g. a resultcache.ResultCache), keyed by stage keys.
+        self.cache=cache
+
+        ## Scratch arrays reused across calls (never handed out as products).
+        self.buffers=BufferPool()
+
+        ## Stage timings and memo/cache hit counts go to this metrics.Metrics registry.
+        self.metrics=registry
+
+        self.params={'configtype':'YConfig', 'nant':20, 'zoom':1.0, 'dishdiam':25.0, 'primarybeam':False,
+                     'has':[-1.0,+1.0], 'inttime':900.0, 'dec':+60.0, 'obslatitude':34.0, 'bwr':[1.5,1.5],
+                     'nchan':0, 'chanwidth':0.1, 'specmode':'mfs',
+                     'weighting':+3.5, 'imtype':'im1',
+                     'tsys':0.0, 'noisemode':'gridded', 'noiseseed':1,
+                     'gaintype':'offset', 'gainamp':0.0, 'gainphase':0.0, 'gainseed':1,
+                     'cleanalgo':'none', 'cleaniter':100, 'cleangain':0.1, 'cleanthresh':0.0,
+                     'npix':npix, 'cellsize':cellsize, 'padding':padding,
+                     'precision':precision}
+        self.setPrecision(precision)
+        self.setGeometry(npix=npix, cellsize=cellsize, padding=padding)
+        self.stages={}
+        self.recomputed=[]
+
+        ## Optional callable, polled before each stage is computed. If it returns True, 
+        ## the pipeline stops with SimulationCancelled (completed stages stay memoized).
+        self.cancelcheck=None
+
+        ## Optional callable, called with a stage's name just before it is computed (for progress reports).
+        self.progress=None
+
+        ## Nothing is computed here : the products of the default parameters are made (or found in the cache)
+        ## by the first simulate() or other stage call, so that constructing a simulator is cheap.
+        self.antennalist={'EastLoc':[], 'NorthLoc':[], 'ElevLoc':[], 'AntName':[], 'DishDiam':[]}
         self.randseed=1
-        self.calcAntList() # default
 
         self.sky=None
         self.ftsky=None
-        self.setsky() # default
+        self.skymodel=None
 
         self.uvcov=None
         self.psf=None
         self.sumwt=None
-        self.makeUVcov() # default
 
 #        self.padded_arr=None
 #        self.padded_arr=np.zeros( [npix*2, npix*2], 'complex')
 
+        self.pbimage=None
+        self.ftskyobs=None
+        self.gains=None
+        self.gaingrid=None
+        self.cleanimage=None
         self.obssky=None
+        self.cube=None
+
+    def simulate(self, changeseed=False, stage='image', **params):
+        """
+        Run the pipeline up to the given stage (default : the full pipeline) for the given parameters 
+        (any of those in self.params), recomputing only the stages whose inputs changed. 
+        Returns the list of stages that were recomputed.
+        """
+        self.recomputed=[]
+        self.setParams(**params)
+        if changeseed==True and self.params['configtype'] in ['RandomConfig','RandomCoreConfig']:
+            self.randseed=int(time.time())
+        self.runStage(stage)
+        return self.getRecomputed()
+
+    def setParams(self, **params):
+        for par in params:
+            if par not in self.params:
+                raise ValueError("Unknown simulation parameter : "+str(par))
+        geom = {par:params.pop(par) for par in ['npix','cellsize','padding'] if par in params}
+        if len(geom)>0:
+            self.setGeometry(**geom)
+        if 'precision' in params:
+            self.setPrecision(params.pop('precision'))
+        self.params.update(params)
+
+    def setPrecision(self, precision='double'):
+        """
+        'double' (float64/complex128) or 'single' (float32/complex64) arrays for the uv grids, 
+        FFTs and images. Single precision halves the memory and FFT bandwidth per simulator.
+        """
+        if precision not in self.dtypes:
+            raise ValueError("Unknown precision : "+str(precision))
+        self.params['precision'] = precision
+        self.realtype, self.complextype = self.dtypes[precision]
+
+    def setGeometry(self, npix=None, cellsize=None, padding=None):
+        """
+        Image size (pixels, even), cell size (arcsec) and the padding factor of the uv grid.
+        The uv grid (and all FFTs) are ngrid = npix*padding on a side, and the PSF and 
+        image are the central npix x npix of the padded image plane.
+        """
+        npix = self.params['npix'] if npix is None else npix
+        cellsize = self.params['cellsize'] if cellsize is None else cellsize
+        padding = self.params['padding'] if padding is None else padding
+        if npix < 2 or cellsize <= 0 or padding < 1.0:
+            raise ValueError("Invalid image geometry : npix=%s cellsize=%s padding=%s"%(npix,cellsize,padding))
+
+        self.npix = 2*int(npix/2)
+        self.cellsize = float(cellsize)
+        self.padding = float(padding)
+        ngrid = 2*int(round(self.npix*self.padding/2))
+        if ngrid != getattr(self, 'ngrid', ngrid):
+            self.buffers.clear()
+        self.ngrid = ngrid
+        self.params.update({'npix':self.npix, 'cellsize':self.cellsize, 'padding':self.padding})
+
+        ## FFT sign patterns and index tables are built once per grid size, here.
+        getCentredFT((self.ngrid,self.ngrid))
+
+    def getUVCellSize(self):
+        """
+        Size of a uv-grid cell, in wavelengths.
+        """
+        return 1.0/(self.ngrid*self.cellsize*ARCSEC)
+
+    def cropCentre(self, arr, nout):
+        """
+        Central nout x nout section of a (centred) grid.
+        """
+        cen = int(arr.shape[0]/2)
+        return arr[cen-int(nout/2):cen-int(nout/2)+nout, cen-int(nout/2):cen-int(nout/2)+nout]
+
+    def getRecomputed(self):
+        """
+        Names of the stages recomputed by the most recent simulate() call
+        (or accumulated since then, by the individual stage methods).
+        """
+        return list(self.recomputed)
+
+    def getStageKey(self, stage):
+        """
+        Key of a stage : its own parameters, plus the keys of the stages it depends on.
+        """
+        vals = []
+        for par in self.stageparams[stage]:
+            if par=='randseed':
+                ## Only the random layouts depend on the seed
+                val = self.randseed if self.params['configtype'] in ['RandomConfig','RandomCoreConfig'] else None
+            elif par=='dishdiam' and self.params['configtype'].startswith('file:'):
+                ## Layout files have their own dish diameters
+                val = None
+            elif par=='configtype' and self.params[par].startswith('file:'):
+                ## Layout files are keyed by their contents' stamp too, so that edited files are re-read.
+                val = (self.params[par],) + layoutStamp(self.params[par][len('file:'):])[1:]
+            else:
+                val = self.params[par]
+            vals.append( (par, self.getKeyValue(val)) )
+        return (stage, tuple(vals)) + tuple( self.getStageKey(dep) for dep in self.stagedeps[stage] )
+
+    def getKeyValue(self, val):
+        """
+        A parameter value as it goes into stage keys : numbers as floats (so that 60 from a slider and 60.0
+        from the defaults give the same key, in memory and on disk), and sequences as tuples.
+        """
+        if isinstance(val, (bool, np.bool_)):
+            return bool(val)
+        if isinstance(val, (int, float, np.integer, np.floating)):
+            ## (Integers too large for a float, such as file modification times, stay exact.)
+            return float(val) if float(val)==val else int(val)
+        if isinstance(val, np.ndarray):
+            val = val.tolist()
+        if isinstance(val, (list, tuple)):
+            return tuple(self.getKeyValue(item) for item in val)
+        return val
+
+    def runStage(self, stage):
+        """
+        Bring a stage (and everything upstream of it) up to date with the current parameters.
+        Lazy dependencies (lazy_stages) are only brought up to date if the stage has to be computed,
+        so that products found in the cache (e.g. on disk) do not need their (large) inputs.
+        """
+        for dep in self.stagedeps[stage]:
+            if dep not in self.lazy_stages:
+                self.runStage(dep)
+
+        key = self.getStageKey(stage)
+        if stage in self.stages and self.stages[stage][0]==key:
+            self.metrics.count('simmer_stage_lookups', stage=stage, source='memo')
+            return self.stages[stage][1]
+
+        products = self.cache.get(key) if self.cache is not None else None
+        if products is None:
+            for dep in self.stagedeps[stage]:
+                if dep in self.lazy_stages:
+                    self.runStage(dep)
+            if self.cancelcheck is not None and self.cancelcheck():
+                self.metrics.count('simmer_stage_cancelled', stage=stage)
+                raise SimulationCancelled(stage)
+            if self.progress is not None:
+                self.progress(stage)
+            with self.metrics.timer('simmer_stage_seconds', stage=stage):
+                products = getattr(self, 'calcStage_'+stage)()
+            self.metrics.count('simmer_stage_lookups', stage=stage, source='computed')
+            self.recomputed.append(stage)
+            if self.cache is not None:
+                self.cache.put(key, products)
+        else:
+            self.metrics.count('simmer_stage_lookups', stage=stage, source='cache')
+        self.stages[stage] = (key, products)
+
+        ## Mirror the products onto the attributes that the rest of the code uses.
+        for name in products:
+            setattr(self, name, products[name])
+        return products
 
     def calcAntList(self, configtype='YConfig',changeseed=True, zoom=1.0, nant=20):
-        self.antennalist={'EastLoc':[], 'NorthLoc':[], 'ElevLoc':[], 'AntName':[]}
+        if changeseed==True and configtype in ['RandomConfig','RandomCoreConfig']:
+            self.randseed=int(time.time())
+        self.setParams(configtype=configtype, zoom=zoom, nant=nant)
+        self.runStage('antennas')
+
+    def calcStage_antennas(self):
+        """
+        The antenna list, from a layout file for configtype 'file:<name>' (all of its antennas, with their
+        own dish diameters), else generated for the configuration type. Generated layouts have no DishDiam :
+        their dishes are all 'dishdiam' (see getDishDiams), which only the stages that use it depend on.
+        """
+        configtype = self.params['configtype']
+        if configtype.startswith('file:'):
+            layout = loadLayout(configtype[len('file:'):])
+            eastlocs = layout['east'] * self.params['zoom']
+            northlocs = layout['north'] * self.params['zoom']
+            elevlocs = np.array(layout['elev'])
+            antnames = layout['name'].tolist()
+            dishdiams = np.array(layout['diam'])
+            return {'antennalist' : {'EastLoc':eastlocs, 'NorthLoc':northlocs, 'ElevLoc':elevlocs, 'AntName':antnames,
+                                     'DishDiam':dishdiams} }
+
+        eastlocs, northlocs, elevlocs, antnames = self.makeAntLayout(configtype=configtype,
+                                                                     zoom=self.params['zoom'],
+                                                                     nant=self.params['nant'],
+                                                                     randseed=self.randseed)
+        return {'antennalist' : {'EastLoc':eastlocs, 'NorthLoc':northlocs, 'ElevLoc':elevlocs, 'AntName':antnames,
+                                 'DishDiam':None} }
+
+    def getDishDiams(self):
+        """
+        Dish diameter (m) of each antenna : those of the layout file, else 'dishdiam' for all of them.
+        """
+        if self.antennalist['DishDiam'] is not None:
+            return np.asarray(self.antennalist['DishDiam'],'float')
+        return np.full(len(self.antennalist['EastLoc']), float(self.params['dishdiam']))
+
+    def makeAntLayout(self, configtype='YConfig', zoom=1.0, nant=20, randseed=1):
+        """
+        East, North, Elevation locations (m) and names of the antennas, for a given configuration type.
+        """
         N = nant
-#        if configtype=='YConfig':
-#            eastlocs, northlocs, elevlocs, antnames = self.readAntListFile('vla_ants.txt')
         if 1.0: #configtype in ['YConfig','CircleConfig','SpiralConfig','RandomConfig','RandomCoreConfig']:
             antnames = []
             for aa in range(0,N):
@@ -102,31 +408,23 @@ class CalcSim:
                             break
                             
             elif configtype=='RandomCoreConfig':
-                if changeseed==True:
-                    self.randseed=int(time.time())
-                np.random.seed(self.randseed)
-                eastlocs = np.random.randn(N) * 200
-                northlocs = np.random.randn(N) * 200
-                elevlocs = np.random.randn(N) * 0.3
+                rng = np.random.RandomState(randseed)
+                eastlocs = rng.randn(N) * 200
+                northlocs = rng.randn(N) * 200
+                elevlocs = rng.randn(N) * 0.3
                 eastlocs[0:int(N/5)] = eastlocs[0:int(N/5)] * 0.1
                 northlocs[0:int(N/5)] = northlocs[0:int(N/5)] * 0.1
 
             else:
-                if changeseed==True:
-                    self.randseed=int(time.time())
-                np.random.seed(self.randseed)
-                eastlocs = np.random.randn(N) * 200
-                northlocs = np.random.randn(N) * 200
-                elevlocs = np.random.randn(N) * 0.3
+                rng = np.random.RandomState(randseed)
+                eastlocs = rng.randn(N) * 200
+                northlocs = rng.randn(N) * 200
+                elevlocs = rng.randn(N) * 0.3
 
         eastlocs = eastlocs * zoom
         northlocs = northlocs * zoom
 
-        for aa in range(0, len(eastlocs)):
-            self.antennalist['EastLoc'].append(eastlocs[aa])
-            self.antennalist['NorthLoc'].append(northlocs[aa])
-            self.antennalist['ElevLoc'].append(elevlocs[aa])
-            self.antennalist['AntName'].append(antnames[aa])
+        return eastlocs, northlocs, elevlocs, antnames
 
 #    def scaleAntList(self,zoom):
 #        print "Zoom : ", zoom
@@ -171,138 +469,372 @@ class CalcSim:
         """
         For the given timerange, gather a list of rotated antUVWs.
         For the given bandwidth ratio, gather a list of scaled antUVWs. 
+        Returns a (nfreq*ntime*nant, 2) array, ordered by frequency, then time, then antenna,
+        in units of half the uv-grid width.
         """
-        locs=[]
-        maxval=4000.0
-        ##  cell size : 1/(4000.0/(3e+8/1e+9)) * 180.0/3.14 * 60 * 60 = 15.47 arcsec
-        
-        for hourangle in np.arange(has[0],has[1]+0.1,0.25):
-                alocs = self.getAntUVWs(hourangle=hourangle, 
-                                        declination=dec, 
-                                        obslatitude=obslatitude)
-                for aloc in alocs:
-                    locs.append( [ aloc[0]/maxval, aloc[1]/maxval ] )
+        maxval = self.getUVCellSize() * self.ngrid/2
+
+        antuvws = self.calcAntUVWs(hourangles=self.getHourAngles(has),
+                                   declination=dec,
+                                   obslatitude=obslatitude)
+        fratios = self.getFrequencies(bwr)/self.clight
+        flocs = antuvws[np.newaxis,:,:,0:2] * (fratios[:,np.newaxis,np.newaxis,np.newaxis]/maxval)
+        return flocs.reshape(-1,2)
+
+    def getHourAngles(self, has=[-1.0,+1.0], hastep=0.25):
+        """
+        Hour angles (in hours) sampled across the given timerange, every hastep hours (one per integration).
+        """
+        return np.arange(has[0],has[1]+0.4*hastep,hastep)
+
+    def getIntegrationTimes(self):
+        """
+        Hour angles (h) of the integrations, for the current time range and integration time ('inttime', sec).
+        """
+        return self.getHourAngles(self.params['has'], self.params['inttime']/3600.0)
 
-        flocs=[]
-        for bwratio in np.arange(bwr[0],bwr[1]+0.001,0.1):
-            for loc in locs:
-                flocs.append([ loc[0]*bwratio/1.5, loc[1]*bwratio/1.5 ] ) 
+    def getRasterStep(self):
+        """
+        Longest hour angle step (h) over which no baseline's uv track moves more than raster_cells uv cells
+        (at the highest frequency). A track turns at 2 pi/24 rad/h, so moves at most 2 pi/24 times the
+        baseline length (in wavelengths) per hour.
+        """
+        axyz = np.stack( [ np.asarray(self.antennalist['EastLoc'],'float'),
+                           np.asarray(self.antennalist['NorthLoc'],'float'),
+                           np.asarray(self.antennalist['ElevLoc'],'float') ], axis=-1 )
+        ## The longest baseline (m), an antenna at a time.
+        maxlen = 0.0
+        for ant in range(len(axyz)-1):
+            maxlen = max(maxlen, np.max(np.sum((axyz[ant+1:]-axyz[ant])**2, axis=1)))
+        maxlen = np.sqrt(maxlen) * np.max(self.getChannelFrequencies())/self.clight
+        if maxlen <= 0:
+            return np.inf
+        return self.raster_cells*self.getUVCellSize() / (maxlen*2*np.pi/24.0)
+
+    def getSampleTimes(self):
+        """
+        Hour angles (h) at which the uv tracks are sampled, and the number of integrations that each sample stands for.
+        The integrations themselves are used while there are no more of them than it takes to trace the tracks at the
+        resolution of the uv grid (see getRasterStep). With shorter integrations, the tracks are rasterised instead :
+        sampled evenly at the raster step across the same time span (each integration centred on its hour angle),
+        each sample standing for its share of the integrations. So the cost of gridding depends on the grid,
+        and not on the number of integrations.
+        """
+        hastep = self.params['inttime']/3600.0
+        hourangles = self.getIntegrationTimes()
+        nint = len(hourangles)
+        nsamp = max(1, int(np.ceil(nint*hastep/self.getRasterStep())))
+        if nsamp >= nint:
+            return hourangles, np.ones(nint)
+        span = nint*hastep
+        samples = hourangles[0] - hastep/2 + (np.arange(nsamp)+0.5)*(span/nsamp)
+        return samples, np.full(nsamp, nint/float(nsamp))
+
+    def getGainIndices(self):
+        """
+        Index of the integration (the row of gains) that each uv track sample falls in.
+        """
+        hastep = self.params['inttime']/3600.0
+        hourangles = self.getIntegrationTimes()
+        idx = np.rint((self.hourangles - hourangles[0])/hastep).astype(int)
+        return np.clip(idx, 0, len(hourangles)-1)
 
-        return flocs
+    def getFrequencies(self, bwr=[1.5,1.5], nchan=0, chanwidth=0.1):
+        """
+        Channel frequencies (Hz) across the given band (GHz) : nchan channels evenly spread from bwr[0] to bwr[1],
+        or with nchan=0, one every chanwidth (GHz) from bwr[0].
+        """
+        if nchan > 0:
+            return np.linspace(bwr[0], bwr[1], int(nchan))*1e+9
+        if chanwidth <= 0:
+            raise ValueError("Invalid channel width : "+str(chanwidth))
+        return np.arange(bwr[0],bwr[1]+0.001,chanwidth)*1e+9
+
+    def getChannelFrequencies(self):
+        """
+        Frequencies (Hz) of the channels for the current parameters.
+        """
+        return self.getFrequencies(self.params['bwr'], self.params['nchan'], self.params['chanwidth'])
+
+    def getBaselineIndices(self, nant=None):
+        """
+        Antenna index pairs (ant1, ant2) with ant1 < ant2, one per baseline.
+        """
+        if nant is None:
+            nant = len(self.antennalist['EastLoc'])
+        return np.triu_indices(nant, k=1)
 
     def getAntUVWs(self,
                    hourangle=-3.5, 
                    declination=+20.0, 
                    obslatitude=34.0):
+        """
+        UVWs (nant, 3) of all antennas at a single hour angle.
+        """
+        return self.calcAntUVWs(hourangles=[hourangle],
+                                declination=declination,
+                                obslatitude=obslatitude)[0]
+
+    def calcAntUVWs(self,
+                    hourangles=[-3.5],
+                    declination=+20.0,
+                    obslatitude=34.0):
+        """
+        UVWs of all antennas at all hour angles, as a contiguous (ntime, nant, 3) array.
+        """
+        ## Assign x->East and x-North. This is the local geographic csys
+        axyz = np.stack( [ np.asarray(self.antennalist['EastLoc'],'float'),
+                           np.asarray(self.antennalist['NorthLoc'],'float'),
+                           np.asarray(self.antennalist['ElevLoc'],'float') ], axis=-1 )
+
+        ## Columns of the rotation matrices are the u,v,w axes in local xyz.
+        ## Projecting each antenna onto them is a single batched matrix product.
+        rots = self.uvwRotations(hourangles, declination, obslatitude)
+        return np.ascontiguousarray( np.matmul(axyz[np.newaxis,:,:], rots) )
+
+    def calcBaselineUVWs(self,
+                         hourangles=[-3.5],
+                         declination=+20.0,
+                         obslatitude=34.0,
+                         fratios=[1.0]):
+        """
+        UVWs of all baselines at all hour angles and frequencies,
+        as a contiguous (ntime, nbaseline, nchan, 3) array.
+        Baselines are ordered as in getBaselineIndices().
+        """
+        antuvws = self.calcAntUVWs(hourangles, declination, obslatitude)
+        ant1, ant2 = self.getBaselineIndices(antuvws.shape[1])
+        fratios = np.asarray(fratios,'float')
+        bluvws = np.empty((antuvws.shape[0], len(ant1), len(fratios), 3))
+        ## Filled a chunk of hour angles at a time, so that the only temporaries are a chunk's baseline differences.
+        step = max(1, self.gridchunk_bytes // max(1, bluvws[0].nbytes))
+        for tt in range(0, len(bluvws), step):
+            diffs = antuvws[tt:tt+step,ant1,:] - antuvws[tt:tt+step,ant2,:]
+            np.multiply(diffs[:,:,np.newaxis,:], fratios[np.newaxis,np.newaxis,:,np.newaxis], out=bluvws[tt:tt+step])
+        return bluvws
 
-        eastlocs = self.antennalist['EastLoc']
-        northlocs = self.antennalist['NorthLoc']
-        elevlocs = self.antennalist['ElevLoc']
-        antnames = self.antennalist['AntName']
+    def setsky(self, imtype='im1'):
+        """
+        Later, make this in world coords, so that changes in pixel size work ok. 
+        """
+        self.setParams(imtype=imtype)
+        self.runStage('sky')
 
-        ## Assign x->East and x-North. This is the local geographic csys
-        Xlocs = eastlocs
-        Ylocs = northlocs 
-
-        ################################ Construct XYZ
-        ## Start with  local xyz
-        AL = 1000.0
-        xdir1 = np.array( [AL,0,0], 'float' )
-        ydir1 = np.array( [0,AL,0], 'float' )
-        zdir1 = np.array( [0,0,AL], 'float' )
-
-        ################################ Construct uvw
-        ## Start with local xyz
-        ## Rotate to get 'z' pointed to where 'w' should be when HA=0, DEC=0
-        ## Rotate by HA and DEC in appropriate directions.
-        ## Rotate by observatory latitude.
-        latrot = -90+obslatitude
+    def calcStage_sky(self):
+        """
+        The sky image is rendered from an analytic component model, and ftsky is 
+        evaluated analytically on the (padded) uv grid. (Like every stage product, it is
+        kept by the stage memo and the shared cache, not by the simulator.)
+        """
+        model = self.getSkyModel(self.params['imtype'])
+        sky = model.render(self.npix, self.cellsize, dtype=self.realtype)
+        return {'skymodel':model, 'sky':sky, 'ftsky':self.getSkyFT(model)}
 
-        udir = self.localxyz2uvw( xdir1, hourangle, declination, latrot )
-        vdir = self.localxyz2uvw( ydir1, hourangle, declination, latrot )
-        wdir = self.localxyz2uvw( zdir1, hourangle, declination, latrot )
+    def getSkyFT(self, model):
+        """
+        Analytic transform of a sky model (at its reference fluxes) on the padded uv grid.
+        """
+        return model.ftGrid(self.ngrid, self.cellsize, dtype=self.complextype)
 
-        ################################
-        ## Calculate UVWs for all antennas.
-        axyz=np.array( [0.0,0.0,0.0], 'float')
-        antuvws = np.zeros( (len(Xlocs), 3) ,'float')
-        for ant in range(0,len(Xlocs)):
-            axyz[0] = Xlocs[ant]
-            axyz[1] = Ylocs[ant]
-            axyz[2] = elevlocs[ant]
-            # Project onto UVW axes.
-            antuvws[ant,0] = np.dot(axyz,udir)/np.linalg.norm(udir)
-            antuvws[ant,1] = np.dot(axyz,vdir)/np.linalg.norm(vdir)
-            antuvws[ant,2] = np.dot(axyz,wdir)/np.linalg.norm(wdir)
+    def calcStage_beam(self):
+        """
+        Primary beam (power) of the array on the padded image grid, averaged over the channels
+        in the bandwidth range, or None if primary beams are off. The voltage pattern of each
+        dish diameter and frequency is cached (see primarybeam.py), so a change of bandwidth
+        only evaluates the new frequencies.
+        """
+        if not self.params['primarybeam']:
+            return {'pbimage':None}
+        pbimage = apparentBeam(self.getDishDiams(), self.getChannelFrequencies(),
+                               self.ngrid, self.cellsize, dtype=self.realtype)
+        return {'pbimage':pbimage}
 
-        return antuvws
+    def calcStage_skyobs(self):
+        """
+        The visibilities of the sky as seen through the primary beam : ftsky itself without one, 
+        else the FT of the sky (rendered on the padded grid) times the beam.
+        For a sky with spectral indices, the same for each of its spectral groups (see SkyModel.getSpectralGroups), 
+        as a list of (spindex, reffreq, visibilities) in 'ftskyspec' (None for a flat spectrum sky).
+        """
+        groups = None
+        if not self.skymodel.isFlat():
+            groups = [(spindex, reffreq, self.getSkyObsFT(model)) for spindex, reffreq, model in self.skymodel.getSpectralGroups()]
+        if self.pbimage is None:
+            return {'ftskyobs':self.ftsky, 'ftskyspec':groups}
+        return {'ftskyobs':self.getSkyObsFT(self.skymodel), 'ftskyspec':groups}
+
+    def getSkyObsFT(self, model):
+        """
+        Visibilities of a sky model (at its reference fluxes) through the primary beam, if any.
+        """
+        if self.pbimage is None:
+            return self.getSkyFT(model)
+        sky = model.render(self.ngrid, self.cellsize, dtype=self.realtype)
+        sky *= self.pbimage
+        return self.ft2d(sky).astype(self.complextype, copy=False)
 
+    def getChannelSkyFT(self, freq):
+        """
+        Visibilities (on the padded uv grid) of the observed sky at one frequency (Hz) : a new array.
+        """
+        if self.ftskyspec is None:
+            return np.array(self.ftskyobs, copy=True)
+        skyvis = np.zeros(self.ftskyobs.shape, self.complextype)
+        for spindex, reffreq, ftgroup in self.ftskyspec:
+            skyvis += ftgroup * ((freq/reffreq)**spindex)
+        return skyvis
+
+    def iterSampleChunks(self, chan1=0, chan2=None):
+        """
+        Generator of (time slice, channel slice, uvws) blocks of the baseline uvws (in wavelengths, as from
+        calcBaselineUVWs) at the sample times (see calcStage_uvws), over all the samples and the channels from
+        chan1 to chan2 (default : all). Each block is made when it is needed, and takes at most gridchunk_bytes of
+        gridding work space (vis_bytes per visibility) : as many channels as fit with one time sample, and as many
+        time samples as fit with those.
+        """
+        freqs = self.getChannelFrequencies()
+        ntime, nbase, nchan = len(self.hourangles), len(self.getBaselineIndices()[0]), len(freqs)
+        chan2 = nchan if chan2 is None else chan2
+        nvis = max(1, self.gridchunk_bytes // self.vis_bytes)
+        cstep = int(max(1, min(chan2-chan1, nvis // max(1, nbase))))
+        tstep = int(max(1, nvis // max(1, nbase*cstep)))
+        for chan in range(chan1, chan2, cstep):
+            chans = slice(chan, min(chan+cstep, chan2))
+            for tt in range(0, ntime, tstep):
+                times = slice(tt, min(tt+tstep, ntime))
+                uvws = self.calcBaselineUVWs(hourangles=self.hourangles[times],
+                                             declination=self.params['dec'],
+                                             obslatitude=self.params['obslatitude'],
+                                             fratios=freqs[chans]/self.clight)
+                yield times, chans, uvws
+
+    def iterChannelCounts(self):
+        """
+        Generator of (first channel, last channel + 1, counts) over chunks of channels, where counts is
+        an (nchunk, ngrid, ngrid) array of the number of visibilities of each channel in each uv cell.
+        Chunks are at most chanchunk_bytes of grids, so that however many channels there are, only one chunk 
+        of channel grids is held at a time, and each is gridded in blocks of visibilities (see iterSampleChunks).
+        (The counts array is reused for the next chunk.)
+        """
+        nchan = len(self.getChannelFrequencies())
+        scale = 1.0/self.getUVCellSize()
+        step = int(max(1, min(nchan, self.chanchunk_bytes // (self.ngrid*self.ngrid*np.dtype(self.realtype).itemsize))))
+        planes = self.buffers.get('chanplanes', (step,self.ngrid,self.ngrid), self.realtype)
+        for chan in range(0, nchan, step):
+            if self.cancelcheck is not None and self.cancelcheck():
+                raise SimulationCancelled('channels')
+            nchunk = min(step, nchan-chan)
+            counts = planes[0:nchunk]
+            counts[:] = 0.0
+            for times, chans, chunk in self.iterSampleChunks(chan, chan+nchunk):
+                gridChannels(chunk[...,0]*scale, chunk[...,1]*scale, self.ngrid, weight=self.tweights[times,np.newaxis,np.newaxis],
+                             hermitian=True, out=counts[chans.start-chan:chans.stop-chan])
+            yield chan, chan+nchunk, counts
+
+    def calcStage_skyvis(self):
+        """
+        The sky visibilities seen by the gridded (multi-frequency synthesis) data : in each uv cell, the mean, 
+        over the visibilities in it, of the sky's visibility at the frequency of their channel.
+        For a flat spectrum sky, that is just ftskyobs. Otherwise, each spectral group's visibilities are
+        weighted by sum_c n_c (freq_c/reffreq)^spindex / n, from the counts n_c of each channel, 
+        accumulated over chunks of channels.
+        """
+        if self.ftskyspec is None:
+            return {'ftskyvis':self.ftskyobs}
+        freqs = self.getChannelFrequencies()
+        scales = np.zeros((len(self.ftskyspec),)+self.uvcounts.shape, self.realtype)
+        for chan1, chan2, counts in self.iterChannelCounts():
+            for group, (spindex, reffreq, ftgroup) in enumerate(self.ftskyspec):
+                flux = ((freqs[chan1:chan2]/reffreq)**spindex).astype(self.realtype)
+                scales[group] += np.tensordot(flux, counts, axes=1)
+        sampled = self.uvcounts > 0
+        skyvis = np.zeros(self.uvcounts.shape, self.complextype)
+        for group, (spindex, reffreq, ftgroup) in enumerate(self.ftskyspec):
+            np.divide(scales[group], self.uvcounts, out=scales[group], where=sampled)
+            skyvis += ftgroup * scales[group]
+        return {'ftskyvis':skyvis}
+
+    def getPrimaryBeam(self):
+        """
+        The primary beam over the (unpadded) image, for display, or None if primary beams are off.
+        """
+        if self.pbimage is None:
+            return None
+        return np.rot90(np.fliplr(self.cropCentre(self.pbimage, self.npix)))
 
-    def setsky(self, imtype='im1'):
+    def getSkyModel(self, imtype='im1'):
         """
-        Later, make this in world coords, so that changes in pixel size work ok. 
+        Component lists for the predefined skies, in arcsec from the phase centre.
         """
-        npix = self.npix
-        self.sky = np.zeros((npix,npix),'float')
+        model = SkyModel()
 
-        ### Stay between 0.25 and 0.75
+        ### Stay within +/- 320 arcsec
 
         if imtype=='im1':
             
-            self.sky[int(npix*0.5),int(npix*0.6)] = 4.0
+            model.addPoint( 0.0, 125.0, 4.0 )
             
-            self.sky[int(npix*0.5),int(npix*0.63)] = 1.0
-            self.sky[int(npix*0.5),int(npix*0.64)] = 1.0
-            self.sky[int(npix*0.5),int(npix*0.65)] = 1.0
-            self.sky[int(npix*0.5),int(npix*0.66)] = 2.0
-            self.sky[int(npix*0.5),int(npix*0.67)] = 1.0
+            model.addPoint( 0.0, 165.0, 1.0 )
+            model.addPoint( 0.0, 175.0, 1.0 )
+            model.addPoint( 0.0, 190.0, 1.0 )
+            model.addPoint( 0.0, 200.0, 2.0 )
+            model.addPoint( 0.0, 215.0, 1.0 )
             
-            self.sky[int(npix*0.53),int(npix*0.57)] = 1.0
-            self.sky[int(npix*0.54),int(npix*0.56)] = 1.0
-            self.sky[int(npix*0.55),int(npix*0.55)] = 2.0
-            self.sky[int(npix*0.56),int(npix*0.54)] = 1.0
+            model.addPoint( 35.0, 85.0, 1.0 )
+            model.addPoint( 50.0, 75.0, 1.0 )
+            model.addPoint( 60.0, 60.0, 2.0 )
+            model.addPoint( 75.0, 50.0, 1.0 )
             
-            self.sky[int(npix*0.3),int(npix*0.3)] = 4.0
-            self.sky[int(npix*0.7),int(npix*0.45)] = 5.0
+            model.addPoint( -260.0, -260.0, 4.0 )
+            model.addPoint( 255.0, -65.0, 5.0 )
 
         elif imtype=='im3':
 
-            self.sky[int(npix*0.3),int(npix*0.3)] = 5.0
-            self.sky[int(npix*0.5),int(npix*0.65)] = 2.0
-            self.drawGaussian( int(npix*0.5),  int(npix*0.5) , 0.02, npix*0.08)
-            self.drawGaussian( int(npix*0.4),  int(npix*0.65) , 0.02, npix*0.12)
-            self.drawGaussian( int(npix*0.6),  int(npix*0.6) , 0.02, npix*0.06)
+            model.addPoint( -260.0, -260.0, 5.0 )
+            model.addPoint( 0.0, 190.0, 2.0 )
+            model.addGaussian( 0.0, 0.0, 52.7, 102.4 )
+            model.addGaussian( -130.0, 190.0, 118.6, 153.6 )
+            model.addGaussian( 125.0, 125.0, 29.6, 76.8 )
             
 
+        elif imtype=='im4':
+
+            ## Sources of different spectra (reference frequency 1.5 GHz) : steep (synchrotron),
+            ## flat, and rising (thermal). Their relative brightness changes across a wide band.
+            model.addPoint( -260.0, -260.0, 4.0, spindex=-0.8 )
+            model.addPoint( 255.0, -65.0, 3.0, spindex=+2.0 )
+            model.addPoint( 0.0, 125.0, 2.0 )
+            model.addGaussian( 0.0, 0.0, 40.0, 60.0, spindex=-0.7 )
+            model.addGaussian( 125.0, 125.0, 20.0, 40.0, spindex=+1.0 )
+
         else:  # type im2
-            self.sky[int(npix*0.5), int(npix*0.5)] = 1.0
+            model.addPoint( 0.0, 0.0, 1.0 )
             
-     
-        self.ftsky = self.ft2d(self.sky)
+        return model
 
 
-    def drawdisk(self, xpos, ypos, rad):
+    def drawdisk(self, xpos, ypos, rad, arr=None):
+        if arr is None:
+            arr = self.uvcov
         for xx in range(xpos-rad,xpos+rad):
             for yy in range(ypos-rad,ypos+rad):
                 if (xx-xpos)**2 + (yy-ypos)**2 < rad**2:
 #                    if action=='add':
 #                        self.uvcov[xx,yy] = self.uvcov[xx,yy]+1.0
 #                    if action=='blank':
-                    self.uvcov[xx,yy] = 0.0
+                    arr[xx,yy] = 0.0
         return 
 
     def drawGaussian(self,  xpos, ypos, amp, sigma):
-        rad = sigma*5
-        shp = self.sky.shape
-        #print shp[0], shp[1]
-        #        for xx in range( np.max(xpos-rad,0), np.min(xpos+rad,shp[0]-1)):
-        #           for yy in range( np.max(ypos-rad,0),np.min(ypos+rad,shp[1]-1)):
-        for xx in range(0,shp[0]):
-            for yy in range(0,shp[1]):
-                self.sky[xx,yy] = self.sky[xx,yy] + amp * np.exp(-0.5* ( (xx-xpos)**2 + (yy-ypos)**2 ) / (sigma**2) )
+        ## Pixel position, peak amplitude and width, converted to world coordinates.
+        cen = int(self.sky.shape[0]/2)
+        SkyModel([{'type':'gaussian', 'xoff':(xpos-cen)*self.cellsize, 'yoff':(ypos-cen)*self.cellsize,
+                   'flux':amp*2*np.pi*sigma**2, 'sigma':sigma*self.cellsize}]).render(self.sky.shape[0], self.cellsize, out=self.sky)
         return 
 
     def ft2d(self, inpdat):
+        if inpdat.shape[0]%2==0 and inpdat.shape[1]%2==0:
+            return getCentredFT(inpdat.shape).ft(inpdat)
         idata = np.fft.ifftshift(inpdat)
         fdata=(np.fft.fftn(idata));
         outdat=np.fft.fftshift(fdata);
@@ -314,93 +846,420 @@ class CalcSim:
     #    outdat = padded_outdat[int(self.npix*0.5):int(self.npix*1.5), int(self.npix*0.5):int(self.npix*1.5)]
         return outdat
 
+    def ft2dHermitian(self, uvgrid):
+        """
+        Same as np.real(self.ft2d(uvgrid)), for a Hermitian-symmetric uv grid (whose transform is real),
+        using a half-plane complex-to-real FFT (with a pooled half-plane buffer).
+        """
+        if uvgrid.shape[0]%2==0 and uvgrid.shape[1]%2==0:
+            work = self.buffers.get('fthalf', (uvgrid.shape[0], uvgrid.shape[1]//2+1), np.result_type(uvgrid.dtype, 'complex64'))
+            return getCentredFT(uvgrid.shape).ftHermitian(uvgrid, work=work)
+        return np.real(self.ft2d(uvgrid))
+
     def makeUVcov(self,
                   has=[-1.0,+1.0],
                   dec=+60.0, 
                   obslatitude=34.0,
                   weighting=+3.5,
                   bwr=[1.5,1.5]):
-        
-        locs = self.calcAntUVWList(has=has, 
-                                   dec=dec, 
-                                   obslatitude=obslatitude,
-                                   bwr=bwr)
+        self.setParams(has=has, dec=dec, obslatitude=obslatitude, weighting=weighting, bwr=bwr)
+        self.runStage('psf')
 
-        rad=1.5
-        aparr = np.zeros((self.npix,self.npix),'float')
-        dcarr = np.zeros((self.npix,self.npix),'float')
-        for loc in locs:
-            xloc = int(self.npix/2)+int(loc[0]*self.npix/2)
-            yloc = int(self.npix/2)+int(loc[1]*self.npix/2)
-            aparr[xloc,yloc] = aparr[xloc,yloc]+1.0
+    def calcStage_uvws(self):
+        """
+        The sample times of the uv tracks : the hour angles of getSampleTimes(), and the number of integrations 
+        that each sample stands for ('tweights'). The baseline uvws themselves are made a block at a time, 
+        as they are gridded (see iterSampleChunks).
+        """
+        hourangles, tweights = self.getSampleTimes()
+        return {'hourangles':hourangles, 'tweights':tweights}
 
+    def calcStage_sampling(self):
+        """
+        Number of visibilities (integrations) per uv cell, and the zero-spacing (autocorrelation) count.
+        """
+        ## Explicit baseline uvws, in uv-grid pixels. 
+        nchan = len(self.getChannelFrequencies())
+        scale = 1.0/self.getUVCellSize()
+        counts = np.zeros((self.ngrid,self.ngrid), self.realtype)
+        for times, chans, chunk in self.iterSampleChunks():
+            gridVisibilities(chunk[...,0]*scale, chunk[...,1]*scale, self.ngrid, weight=self.tweights[times,np.newaxis,np.newaxis],
+                             hermitian=True, out=counts)
+
+        ## One autocorrelation per antenna per integration.
+        zerospacing = len(self.antennalist['EastLoc'])*np.sum(self.tweights)*nchan
+        return {'uvcounts':counts, 'zerospacing':zerospacing}
+
+    def calcStage_weighting(self):
+        return {'uvcov':self.weightGrid(self.uvcounts, self.zerospacing)}
+
+    def weightGrid(self, uvcounts, zerospacing):
+        """
+        The weights of the uv cells, for the given counts of visibilities (and of autocorrelations) in them.
+        """
+        rad=1.5
 
-        varr = self.ft2d(aparr)
-        parr = np.real(varr * np.conj(varr))
-        self.uvcov = np.real(self.ft2d(parr))
-        
-        wmax = np.max(np.real(self.uvcov))
-        self.uvcov = self.uvcov/wmax
+        ## Normalise by the zero-spacing weight, i.e. the peak that the aperture autocorrelation used to produce.
+        ## This is the one new array : everything after it is computed in place.
+        uvcov = uvcounts/np.array(zerospacing, uvcounts.dtype)
         
 #        if weighting=='uniform':
 #            self.uvcov = self.uvcov/ (self.uvcov+0.0001)
 #        elif weighting=='robust':
 #            #self.uvcov = (self.uvcov)**2/ ( (self.uvcov)**2 + 0.005 )
 
-        R = weighting
-        F = ( (5* (10.0**(-R)) )**2 ) / ( (np.sum((self.uvcov)**2))/np.prod(self.uvcov.shape) ) 
-        self.uvcov = self.uvcov/ (1 + F*(self.uvcov) ) 
-
-        self.drawdisk(int(self.npix/2),int(self.npix/2),int(rad))
-        self.psf = np.real(self.ft2d(self.uvcov))
-        self.sumwt = np.max(self.psf)
-        #print 'Max of psf : ', np.max(self.psf)
-        self.psf = self.psf / self.sumwt
-        #ftsky = ft2d(self.sky)
-
+        ## The (unit) zero-spacing weight is included in the mean, as it was in the autocorrelation.
+        ## The mean is over npix^2 cells (not the padded grid), which keeps it independent of the padding.
+        R = self.params['weighting']
+        F = ( (5* (10.0**(-R)) )**2 ) / ( (np.dot(uvcov.ravel(),uvcov.ravel())+1.0)/(self.npix**2) ) 
+        denom = self.buffers.get('weightden', uvcov.shape, uvcov.dtype)
+        np.multiply(uvcov, F, out=denom)
+        denom += 1
+        uvcov /= denom
+
+        self.drawdisk(int(self.ngrid/2),int(self.ngrid/2),int(rad),arr=uvcov)
+        return uvcov
+
+    def calcStage_psf(self):
+        psf = self.ft2dHermitian(self.uvcov)
+        sumwt = np.max(psf)
         #print 'Max of psf : ', np.max(self.psf)
+        psf = self.cropCentre(psf, self.npix) / sumwt
+        return {'psf':psf, 'sumwt':sumwt}
 
     def makeImage(self):
+        self.runStage('image')
+
+    def getSEFD(self, tsys, diam=None):
+        """
+        System equivalent flux density (Jy) of each antenna (or of a dish of diameter 'diam', m),
+        for a system temperature (K).
+        """
+        if diam is None:
+            diam = self.getDishDiams()
+        area = np.pi*(np.asarray(diam,'float')/2.0)**2
+        return 2*self.kboltzmann*tsys/(self.apereff*area) / 1e-26
+
+    def getVisNoise(self, tsys, inttime=0.25*3600.0, chanwidth=0.1e+9):
+        """
+        Noise (Jy, rms of the real and of the imaginary part) of one visibility on each baseline 
+        (ordered as in getBaselineIndices()), from the radiometer equation sqrt(SEFD_i SEFD_j)/sqrt(2 dnu tau),
+        for one integration (sec, 'inttime') and one frequency channel (Hz) as in getIntegrationTimes() and getFrequencies().
+        """
+        sefd = self.getSEFD(tsys)
+        ant1, ant2 = self.getBaselineIndices(len(sefd))
+        return np.sqrt(sefd[ant1]*sefd[ant2])/np.sqrt(2*chanwidth*inttime)
 
-        obsvis = self.uvcov * self.ftsky
-        self.obssky = np.real(self.ft2d(obsvis)) / self.sumwt
+    def calcStage_noise(self):
+        """
+        Thermal noise of the gridded data : the mean noise of the visibilities in each uv cell 
+        (Hermitian, like the data), or None without noise. With more time samples or channels, 
+        cells average more visibilities, so the noise goes down as it should. Modes :
+          gridded    : drawn per cell, with the variance of the mean of the cell's visibilities
+                       (sigma^2/n, for n visibilities of noise sigma).
+          visibility : drawn per visibility and gridded, a chunk of time samples at a time.
+        Both use a generator seeded by 'noiseseed', so a setting always gives the same noise.
+        Also returns the noise variance per cell (for getNoiseRMS) and the mean visibility noise.
+        """
+        tsys = self.params['tsys']
+        if tsys <= 0:
+            return {'noisevis':None, 'noisevar':None, 'visnoise':0.0}
+        sigmas = self.getVisNoise(tsys, inttime=self.params['inttime'], chanwidth=self.params['chanwidth']*1e+9)
+        rng = np.random.default_rng(self.params['noiseseed'])
+        counts = self.uvcounts
+        sampled = counts > 0
+        scale = 1.0/self.getUVCellSize()
+
+        ## Per cell variance : sigma^2/n for identical dishes, else the sum of the sigma^2 of the cell's visibilities / n^2.
+        noisevar = np.zeros(counts.shape, self.realtype)
+        if np.all(sigmas==sigmas[0]):
+            np.divide(sigmas[0]**2, counts, out=noisevar, where=sampled)
+        else:
+            for times, chans, chunk in self.iterSampleChunks():
+                gridVisibilities(chunk[...,0]*scale, chunk[...,1]*scale, self.ngrid,
+                                 weight=self.tweights[times,np.newaxis,np.newaxis]*(sigmas**2)[np.newaxis,:,np.newaxis],
+                                 hermitian=True, out=noisevar)
+            np.divide(noisevar, counts.astype(self.realtype)**2, out=noisevar, where=sampled)
+
+        if self.params['noisemode']=='gridded':
+            noise = self.drawGriddedNoise(rng, noisevar)
+        elif self.params['noisemode']=='visibility':
+            noise = np.zeros(counts.shape, self.complextype)
+            ## A chunk of time samples at a time (see iterSampleChunks), however long the observation.
+            for times, chans, chunk in self.iterSampleChunks():
+                vis = rng.standard_normal(chunk.shape[0:-1]+(2,), dtype=self.realtype).view(self.complextype)[...,0]
+                ## A sample standing for w integrations holds their sum, of variance w sigma^2.
+                vis *= (np.sqrt(self.tweights[times,np.newaxis,np.newaxis])*sigmas[np.newaxis,:,np.newaxis]).astype(self.realtype)
+                gridVisibilities(chunk[...,0]*scale, chunk[...,1]*scale, self.ngrid, vis=vis, hermitian=True, out=noise)
+            np.divide(noise, counts, out=noise, where=sampled)
+        else:
+            raise ValueError("Unknown noise mode : "+str(self.params['noisemode']))
+        noise[~sampled] = 0.0
+        return {'noisevis':noise, 'noisevar':noisevar, 'visnoise':float(np.sqrt(np.mean(sigmas**2)))}
+
+    def drawGriddedNoise(self, rng, noisevar):
+        """
+        Hermitian complex noise on the uv grid, with the given variance (of the real and of the imaginary part) per cell.
+        """
+        noise = np.zeros(noisevar.shape, self.complextype)
+        noise.real = rng.standard_normal(noisevar.shape, dtype=self.realtype)
+        noise.imag = rng.standard_normal(noisevar.shape, dtype=self.realtype)
+        ## Cells k and -k hold conjugate visibilities : cell -k of a centred grid is at [(n-i)%n, (n-j)%n].
+        noise += np.conj(np.roll(noise[::-1,::-1], 1, axis=(0,1)))
+        noise *= 1.0/np.sqrt(2.0)
+        noise *= np.sqrt(noisevar)
+        return noise
+
+    def getNoiseRMS(self):
+        """
+        Expected rms (Jy/beam) of the noise in the image, from the weights and the noise variance
+        of each cell : sqrt( 2 sum(w^2 var) ) / sum(w).
+        """
+        if self.noisevar is None:
+            return 0.0
+        sampled = self.uvcounts > 0
+        wts = self.uvcov[sampled].astype('float64')
+        return float(np.sqrt(2*np.sum(wts**2 * self.noisevar[sampled])) / self.sumwt)
+
+    def calcStage_gains(self):
+        """
+        Complex gains (ntime, nant) of each antenna in each integration, or None without errors.
+        'gainamp' is the rms fractional amplitude error and 'gainphase' the rms phase error (deg), of type :
+          offset     : constant per antenna,
+          randomwalk : drifting from 1.0 at the first sample, reaching that rms by the last one,
+          screen     : phases from a frozen phase screen (Kolmogorov-like spectrum) blowing across the array,
+                       so that nearby antennas see similar phases; amplitude errors are constant offsets.
+        Seeded by 'gainseed', so a setting always gives the same gains.
+        """
+        amperr, phaseerr = self.params['gainamp'], self.params['gainphase']*np.pi/180.0
+        if amperr==0.0 and phaseerr==0.0:
+            return {'gains':None}
+        rng = np.random.default_rng(self.params['gainseed'])
+        ntime = len(self.getIntegrationTimes())
+        nant = len(self.antennalist['EastLoc'])
+        gaintype = self.params['gaintype']
+
+        if gaintype=='offset':
+            amps = rng.standard_normal((1,nant)) * amperr
+            phases = rng.standard_normal((1,nant)) * phaseerr
+        elif gaintype=='randomwalk':
+            steps = rng.standard_normal((2,ntime,nant)) / np.sqrt(max(ntime-1,1))
+            steps[:,0,:] = 0.0
+            walks = np.cumsum(steps, axis=1)
+            amps, phases = walks[0]*amperr, walks[1]*phaseerr
+        elif gaintype=='screen':
+            amps = rng.standard_normal((1,nant)) * amperr
+            phases = self.getPhaseScreen(rng, ntime) * phaseerr
+        else:
+            raise ValueError("Unknown gain error type : "+str(gaintype))
+
+        gains = np.empty((ntime,nant), self.complextype)
+        gains[:] = (1.0+amps) * np.exp(1j*phases)
+        return {'gains':gains}
+
+    def getPhaseScreen(self, rng, ntime, nwaves=64, windspeed=10.0, scales=[100.0,20000.0]):
+        """
+        Unit-rms phases (ntime, nant) at the antennas from a frozen screen moving East at windspeed (m/s),
+        made of plane waves of random directions with wavelengths (m) across 'scales', 
+        and amplitudes that follow a Kolmogorov (k^-11/6) spectrum.
+        """
+        kmag = 2*np.pi/np.exp(rng.uniform(np.log(scales[0]), np.log(scales[1]), nwaves))
+        angle = rng.uniform(0, 2*np.pi, nwaves)
+        amp = kmag**(-11.0/6)
+        amp *= np.sqrt(2.0/np.sum(amp**2))
+        offset = rng.uniform(0, 2*np.pi, nwaves)
+        times = np.arange(ntime) * self.params['inttime']
+        xpos = np.asarray(self.antennalist['EastLoc'],'float')[np.newaxis,:] - windspeed*times[:,np.newaxis]
+        ypos = np.asarray(self.antennalist['NorthLoc'],'float')
+        ## (ntime, nant, nwave) wave phases, summed over the waves, a chunk of (short) integrations at a time.
+        phases = np.empty((ntime, xpos.shape[1]))
+        step = max(1, 2**20 // (xpos.shape[1]*nwaves))
+        for tt in range(0, ntime, step):
+            arg = (xpos[tt:tt+step,:,np.newaxis]*(kmag*np.cos(angle)) + ypos[np.newaxis,:,np.newaxis]*(kmag*np.sin(angle)) + offset)
+            phases[tt:tt+step] = np.dot(np.cos(arg), amp)
+        return phases
+
+    def calcStage_corruption(self):
+        """
+        The mean of the gain products g_i conj(g_j) of the visibilities in each uv cell (Hermitian), or None
+        without gain errors. Gridding is nearest-cell, so every visibility in a cell sees the same sky visibility,
+        and gridding corrupted visibilities is the same as multiplying the gridded sky by this grid.
+        The products are formed per (time sample, baseline), from the gains of the integration the sample falls in,
+        and broadcast over channels, a chunk of time samples at a time.
+        """
+        if self.gains is None:
+            return {'gaingrid':None}
+        counts = self.uvcounts
+        sampled = counts > 0
+        scale = 1.0/self.getUVCellSize()
+        ant1, ant2 = self.getBaselineIndices(self.gains.shape[1])
+        gainidx = self.getGainIndices()
+
+        gaingrid = np.zeros(counts.shape, self.complextype)
+        for times, chans, chunk in self.iterSampleChunks():
+            gains = self.gains[gainidx[times]]
+            prods = (gains[:,ant1] * np.conj(gains[:,ant2]) * self.tweights[times,np.newaxis])[:,:,np.newaxis]
+            gridVisibilities(chunk[...,0]*scale, chunk[...,1]*scale, self.ngrid, vis=prods, hermitian=True, out=gaingrid)
+        np.divide(gaingrid, counts, out=gaingrid, where=sampled)
+        ## Unsampled cells (including the zero spacing drawn in by the weighting) are left uncorrupted.
+        gaingrid[~sampled] = 1.0
+        return {'gaingrid':gaingrid}
+
+    def calcStage_image(self):
+        obsvis = self.buffers.get('obsvis', self.ftskyvis.shape, self.ftskyvis.dtype)
+        skyvis = self.ftskyvis
+        if self.gaingrid is not None:
+            np.multiply(self.ftskyvis, self.gaingrid, out=obsvis)
+            skyvis = obsvis
+        if self.noisevis is None:
+            np.multiply(self.uvcov, skyvis, out=obsvis)
+        else:
+            np.add(skyvis, self.noisevis, out=obsvis)
+            obsvis *= self.uvcov
+        obssky = self.cropCentre(self.ft2dHermitian(obsvis), self.npix) / self.sumwt
+        return {'obssky':obssky, 'noiserms':self.getNoiseRMS()}
+
+    def calcStage_clean(self):
+        """
+        CLEAN deconvolution of the dirty image (see deconvolver.py) with 'cleanalgo' ('none', 'hogbom' or 'clark'),
+        up to 'cleaniter' components of loop gain 'cleangain', down to 'cleanthresh' times the dirty image peak.
+        Both use the exact PSF of every offset in the image (see getCleanPSF), and Clark major cycles recompute
+        the residual exactly, from the model on the uv grid (see convolveModel).
+        The restored image (model convolved with a Gaussian fitted to the PSF, plus the residual) is 'cleanimage'.
+        """
+        algo = self.params['cleanalgo']
+        if algo=='none':
+            return {'cleanimage':self.obssky, 'cleanmodel':None, 'cleanresidual':None, 'cleaniterdone':0}
+        threshold = self.params['cleanthresh']*float(np.max(np.abs(self.obssky)))
+        if algo=='hogbom':
+            model, residual, niter = deconvolver.hogbom(self.obssky, self.getCleanPSF(), niter=self.params['cleaniter'],
+                                                        gain=self.params['cleangain'], threshold=threshold)
+        elif algo=='clark':
+            model, residual, niter = deconvolver.clark(self.obssky, self.getCleanPSF(), self.convolveModel, niter=self.params['cleaniter'],
+                                                       gain=self.params['cleangain'], threshold=threshold, period=self.ngrid)
+        else:
+            raise ValueError("Unknown CLEAN algorithm : "+str(algo))
+        cleanimage = deconvolver.restore(model, residual, deconvolver.fitBeam(self.psf))
+        return {'cleanimage':cleanimage, 'cleanmodel':model, 'cleanresidual':residual, 'cleaniterdone':niter}
+
+    def getCleanPSF(self):
+        """
+        The PSF for CLEAN : (2 npix, 2 npix), centred, so that it gives the response at every offset between
+        two image pixels. The dirty image is cut from a periodic one (of ngrid pixels, the uv grid's transform),
+        so the PSF is taken from the full (ngrid) PSF with wraparound : sidelobes that leave one edge of the
+        padded image come back in at the other, as they do in the dirty image.
+        """
+        fullpsf = self.ft2dHermitian(self.uvcov) / self.sumwt
+        idx = self.ngrid//2 - self.npix + np.arange(2*self.npix)
+        return np.take(np.take(fullpsf, idx, axis=0, mode='wrap'), idx, axis=1, mode='wrap').astype(self.realtype, copy=False)
+
+    def convolveModel(self, model):
+        """
+        A model image (npix x npix) convolved with the PSF : the dirty image it would give, 
+        from its transform on the (padded) uv grid times the weights.
+        """
+        padded = self.buffers.zeros('modelpad', (self.ngrid,self.ngrid), self.realtype)
+        self.cropCentre(padded, self.npix)[:] = model
+        ## The image is the forward transform of the uv grid, which is itself the forward transform of the sky,
+        ## so the image is the sky mirrored about the centre : the model is mirrored the same way here.
+        ftmodel = self.ft2d(np.roll(padded[::-1,::-1], 1, axis=(0,1)))
+        ftmodel *= self.uvcov
+        return self.cropCentre(self.ft2dHermitian(ftmodel), self.npix) / self.sumwt
+
+    def calcStage_cube(self):
+        """
+        Image cube (nchan, npix, npix), or None unless 'specmode' is 'cube' ('mfs' : only the image of all channels together).
+        Each plane is the dirty image of one channel : from its own uv coverage (weighted as for the image), 
+        the sky at its frequency, the gain errors and (gridded) noise. Channels are gridded a chunk at a time 
+        (see iterChannelCounts) and imaged one by one, so only the cube itself grows with the number of channels.
+        """
+        if self.params['specmode']=='mfs':
+            return {'cube':None}
+        if self.params['specmode']!='cube':
+            raise ValueError("Unknown spectral mode : "+str(self.params['specmode']))
+        freqs = self.getChannelFrequencies()
+        scale = 1.0/self.getUVCellSize()
+        zerospacing = len(self.antennalist['EastLoc'])*np.sum(self.tweights)
+        tweights = self.tweights[:,np.newaxis,np.newaxis]
+        tsys = self.params['tsys']
+        if tsys > 0:
+            sigmas = self.getVisNoise(tsys, inttime=self.params['inttime'], chanwidth=self.params['chanwidth']*1e+9)
+            rng = np.random.default_rng(self.params['noiseseed'])
+        if self.gains is not None:
+            ant1, ant2 = self.getBaselineIndices(self.gains.shape[1])
+            gains = self.gains[self.getGainIndices()]
+            prods = (gains[:,ant1] * np.conj(gains[:,ant2]))[:,:,np.newaxis] * tweights
+
+        cube = np.zeros((len(freqs), self.npix, self.npix), self.realtype)
+        for chan1, chan2, counts in self.iterChannelCounts():
+            gaingrids, vargrids = None, None
+            if self.gains is not None:
+                gaingrids = np.zeros(counts.shape, self.complextype)
+            if tsys > 0 and not np.all(sigmas==sigmas[0]):
+                vargrids = np.zeros(counts.shape, self.realtype)
+            for times, chans, chunk in self.iterSampleChunks(chan1, chan2):
+                planes = slice(chans.start-chan1, chans.stop-chan1)
+                if gaingrids is not None:
+                    gridChannels(chunk[...,0]*scale, chunk[...,1]*scale, self.ngrid, vis=prods[times], hermitian=True, out=gaingrids[planes])
+                if vargrids is not None:
+                    gridChannels(chunk[...,0]*scale, chunk[...,1]*scale, self.ngrid, weight=tweights[times]*(sigmas**2)[:,np.newaxis],
+                                 hermitian=True, out=vargrids[planes])
+            for idx in range(chan2-chan1):
+                count = counts[idx]
+                sampled = count > 0
+                uvcov = self.weightGrid(count, zerospacing)
+                sumwt = float(np.sum(uvcov))
+                if sumwt <= 0:
+                    continue
+                ## As in the gain, noise and image stages, for this channel alone.
+                obsvis = self.getChannelSkyFT(freqs[chan1+idx])
+                if gaingrids is not None:
+                    np.divide(gaingrids[idx], count, out=gaingrids[idx], where=sampled)
+                    obsvis *= gaingrids[idx]
+                if tsys > 0:
+                    noisevar = np.zeros(count.shape, self.realtype)
+                    if vargrids is None:
+                        np.divide(sigmas[0]**2, count, out=noisevar, where=sampled)
+                    else:
+                        np.divide(vargrids[idx], count**2, out=noisevar, where=sampled)
+                    obsvis += self.drawGriddedNoise(rng, noisevar)
+                obsvis *= uvcov
+                ## The PSF peak (the weights' sum), which normalises the image.
+                cube[chan1+idx] = self.cropCentre(self.ft2dHermitian(obsvis), self.npix) / sumwt
+        return {'cube':cube}
+
+    def getCubeImage(self, chan):
+        """
+        One channel of the image cube, for display.
+        """
+        return np.rot90(np.fliplr(self.cube[chan]))
+
+    def getCleanImage(self):
+        return np.rot90(np.fliplr(self.cleanimage))
+
+    def getPSF(self):
+        return np.rot90(np.fliplr(self.psf))
 
     def getImage(self):
         return np.rot90(np.fliplr(self.obssky))
 
     def getUVcov(self):
-        p1=int(self.npix*0.35)
-        p2=int(self.npix*0.65)
-        themax = np.max(self.uvcov[p1:p2,p1:p2])
-        return np.rot90(np.fliplr(np.real(np.sqrt(self.uvcov[p1:p2,p1:p2]/themax+0.001))))
+        ## The central 30% of the (unpadded) uv extent
+        nshow = int(self.ngrid*0.3)
+        uvc = self.cropCentre(self.uvcov, nshow)
+        themax = np.max(uvc)
+        return np.rot90(np.fliplr(np.real(np.sqrt(uvc/themax+0.001))))
         #return np.rot90(np.fliplr(np.real((self.uvcov[p1:p2,p1:p2]/themax))))
 
 
     #############################################
 
     def readAntListFile(self, antfile=''):
-        fp = open(antfile,'r')
-        thelines = fp.readlines()
-
-        eastlocs=[]
-        northlocs=[]
-        elevlocs=[]
-        antnames=[]
-        for aline in thelines:
-            if aline[0] != '#':
-                words = aline.split()
-                antnames.append( words[1] )
-                ## make the indices 6,7,8 for listobs files that do not contain pad/station info !!
-                ## make the indices 7,8,9 for listobs files that contain antenna pad info !!
-                eastlocs.append( eval( words[7] ) )
-                northlocs.append( eval( words[8] ) )
-                elevlocs.append( eval( words[9] ) )
-
-        #print 'Antenna names : ', antnames
-        #print 'East : ', eastlocs
-        #print 'North :', northlocs
-        #print 'Elev : ',elevlocs
-        return np.array(eastlocs), np.array(northlocs), np.array(elevlocs), antnames
+        """
+        East, North, Elevation locations (m) and names of the antennas in a layout file (see antconfig.parseLayout).
+        """
+        layout = parseLayout(antfile)
+        return np.array(layout['east']), np.array(layout['north']), np.array(layout['elev']), layout['name'].tolist()
 
     ###################################################
 
@@ -438,6 +1297,22 @@ class CalcSim:
         newxyz[2] = xyz[2]
         return newxyz
 
+    ## Stacked rotation matrices (n, 3, 3) about one axis, counter-clockwise, 
+    ## for an array of angles (in degrees). Same conventions as rotx/roty/rotz.
+    def rotmat(self, axis, angles ):
+        ang = np.atleast_1d(np.asarray(angles,'float'))*np.pi/180.0
+        cs = np.cos(ang)
+        sn = np.sin(ang)
+        mats = np.zeros( (len(ang),3,3), 'float' )
+        i, j = {'x':(1,2), 'y':(2,0), 'z':(0,1)}[axis]
+        k = 3-i-j
+        mats[:,k,k] = 1.0
+        mats[:,i,i] = cs
+        mats[:,i,j] = -sn
+        mats[:,j,i] = sn
+        mats[:,j,j] = cs
+        return mats
+
     ## Three rotations. 
     ## Start with uvw aligned with local xyz
     ## Rotate about x by 90 deg, to get 'w' to point HA=0, DEC=0
@@ -452,6 +1327,16 @@ class CalcSim:
         uvwdir = self.rotx( uvwdir, latrot )
         return uvwdir
 
+    ## The same chain of rotations as localxyz2uvw, for many hour angles at once.
+    ## Returns (ntime, 3, 3) matrices M such that uvw = xyz @ M 
+    ## (i.e. the columns of M are the u, v and w directions in local xyz).
+    def uvwRotations(self, hourangles, declination, obslatitude ):
+        latrot = -90+obslatitude
+        has = np.atleast_1d(np.asarray(hourangles,'float'))
+        fixed = np.matmul( self.rotmat('x', -1*declination), self.rotmat('x', 90) )
+        rots = np.matmul( self.rotmat('x', latrot), np.matmul( self.rotmat('z', -1*has*15), fixed ) )
+        return rots
+
 
 
 
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+"""deconvolver.py: Hogbom and Clark CLEAN deconvolution of dirty images, and restoration with a fitted clean beam."""
+
+import numpy as np
+
+
+def findPeak(image, mask=None):
+    """
+    Position (y, x) and value of the largest absolute value in an image (optionally within a boolean mask).
+    """
+    if mask is None:
+        ## The largest and the most negative values, without making an |image| copy.
+        imax, imin = np.argmax(image), np.argmin(image)
+        flat = imax if np.abs(image.flat[imax]) >= np.abs(image.flat[imin]) else imin
+    else:
+        absim = np.abs(image)
+        absim[~mask] = 0.0
+        flat = np.argmax(absim)
+    pos = np.unravel_index(flat, image.shape)
+    return pos, image[pos]
+
+
+def subtractPSF(image, psf, pos, scale):
+    """
+    Subtract scale * psf, with its centre (npsf/2) moved to pos, from the image in place.
+    Only the window where the shifted PSF overlaps the image is touched.
+    """
+    ny, nx = image.shape
+    cy, cx = psf.shape[0]//2, psf.shape[1]//2
+    y0, y1 = max(0, pos[0]-cy), min(ny, pos[0]-cy+psf.shape[0])
+    x0, x1 = max(0, pos[1]-cx), min(nx, pos[1]-cx+psf.shape[1])
+    if y1 > y0 and x1 > x0:
+        image[y0:y1, x0:x1] -= scale * psf[y0-pos[0]+cy:y1-pos[0]+cy, x0-pos[1]+cx:x1-pos[1]+cx]
+
+
+def hogbom(dirty, psf, niter=100, gain=0.1, threshold=0.0, mask=None):
+    """
+    Hogbom CLEAN : repeatedly find the peak of the residual and subtract gain times the (whole) PSF there,
+    until niter components or a peak below threshold (absolute). The PSF has its peak (1.0) at its centre,
+    and should be twice the image size, so that wherever it is subtracted, it covers the whole image
+    (e.g. with the sidelobes that wrap around a periodic image : see CalcSim.getCleanPSF).
+    Returns the model (component) image, the residual image and the number of iterations done.
+    """
+    residual = np.array(dirty, copy=True)
+    model = np.zeros_like(residual)
+    for itr in range(niter):
+        pos, peak = findPeak(residual, mask)
+        if np.abs(peak) <= threshold:
+            return model, residual, itr
+        model[pos] += gain*peak
+        subtractPSF(residual, psf, pos, gain*peak)
+    return model, residual, niter
+
+
+def psfPatch(psf, halfsize):
+    """
+    The central (2*halfsize+1)^2 patch of the PSF, and the largest |PSF| outside it.
+    """
+    cy, cx = psf.shape[0]//2, psf.shape[1]//2
+    patch = psf[max(0,cy-halfsize):cy+halfsize+1, max(0,cx-halfsize):cx+halfsize+1]
+    outside = np.abs(np.array(psf, copy=True))
+    outside[max(0,cy-halfsize):cy+halfsize+1, max(0,cx-halfsize):cx+halfsize+1] = 0.0
+    return patch, float(np.max(outside))
+
+
+def clark(dirty, psf, convolve, niter=100, gain=0.1, threshold=0.0, mask=None,
+          patchsize=None, maxactive=20000, cyclefactor=1.0, maxcycles=50, period=None):
+    """
+    Clark CLEAN. Each major cycle selects the residual pixels above a cycle threshold (set by the largest
+    PSF sidelobe outside the PSF patch), and a minor cycle cleans only those pixels, subtracting gain times
+    the PSF patch from their values. The residual image is then recomputed from the whole model as
+    dirty - convolve(model), where convolve(model) gives the model convolved with the full PSF
+    (e.g. by FFTs, see psfConvolver, or exactly on the uv grid). For an image cut from a periodic one
+    (e.g. a dirty image from a uv grid of 'period' pixels), offsets between pixels wrap around the period.
+    A major cycle that raises the residual peak halves the gain for the next ones.
+    Stops at niter components in all, or a peak below threshold (absolute).
+    Returns the model image, the residual image and the number of iterations done.
+    """
+    dirty = np.asarray(dirty)
+    if patchsize is None:
+        patchsize = min(dirty.shape[0]//4, 64)
+    if period is not None and period < psf.shape[0]:
+        ## One period of offsets (beyond it, the PSF repeats, main lobe included).
+        cy, cx = psf.shape[0]//2, psf.shape[1]//2
+        psf = psf[cy-period//2:cy-period//2+period, cx-period//2:cx-period//2+period]
+    patch, sidelobe = psfPatch(psf, patchsize)
+    hy, hx = patch.shape[0]//2, patch.shape[1]//2
+
+    residual = np.array(dirty, copy=True)
+    model = np.zeros_like(residual)
+    itr = 0
+    lastpeak = np.inf
+    for cycle in range(maxcycles):
+        pos, peak = findPeak(residual, mask)
+        if itr >= niter or np.abs(peak) <= threshold:
+            break
+        if np.abs(peak) > lastpeak:
+            gain = 0.5*gain
+        lastpeak = np.abs(peak)
+        cyclethresh = max(threshold, np.abs(peak)*min(0.95, cyclefactor*sidelobe))
+
+        ## The active pixels : the largest ones above the cycle threshold.
+        absres = np.abs(residual)
+        if mask is not None:
+            absres[~mask] = 0.0
+        active = np.flatnonzero(absres > cyclethresh)
+        if len(active) > maxactive:
+            active = active[np.argpartition(absres.ravel()[active], -maxactive)[-maxactive:]]
+            cyclethresh = max(cyclethresh, float(np.min(absres.ravel()[active])))
+        if len(active)==0:
+            active = np.array([np.ravel_multi_index(pos, residual.shape)])
+        ay, ax = np.unravel_index(active, residual.shape)
+        vals = residual.ravel()[active]
+
+        ## Minor cycle, on the active pixels only (at least one component per cycle).
+        start = itr
+        while itr < niter:
+            idx = np.argmax(np.abs(vals))
+            if np.abs(vals[idx]) <= threshold or (np.abs(vals[idx]) <= cyclethresh and itr > start):
+                break
+            comp = gain*vals[idx]
+            model[ay[idx], ax[idx]] += comp
+            dy = ay - ay[idx]
+            dx = ax - ax[idx]
+            if period is not None:
+                dy = (dy + period//2) % period - period//2
+                dx = (dx + period//2) % period - period//2
+            inside = np.flatnonzero( (np.abs(dy) <= hy) & (np.abs(dx) <= hx) )
+            vals[inside] -= comp*patch[dy[inside]+hy, dx[inside]+hx]
+            itr += 1
+
+        ## Major cycle : the residual from the whole model.
+        residual = dirty - convolve(model)
+    return model, residual, itr
+
+
+def psfConvolver(psf):
+    """
+    A function that convolves an image (of the PSF's shape) with the PSF, by zero-padded FFTs.
+    """
+    ny, nx = psf.shape
+    shape = (2*ny, 2*nx)
+    ftpsf = np.fft.rfft2(np.roll(np.pad(psf, ((0,ny),(0,nx))), (-(ny//2), -(nx//2)), axis=(0,1)))
+    def convolve(image):
+        conv = np.fft.irfft2(np.fft.rfft2(image, s=shape) * ftpsf, s=shape)
+        return conv[0:ny, 0:nx]
+    return convolve
+
+
+def fitBeam(psf):
+    """
+    Elliptical Gaussian (2x2 covariance, pixels^2) fitted to the PSF main lobe. The half power region
+    of a Gaussian is an ellipse whose uniform second moments are ln(2)/2 times the Gaussian's covariance.
+    """
+    cy, cx = psf.shape[0]//2, psf.shape[1]//2
+    ## The main lobe : pixels above half power, near the centre.
+    rad = max(2, int(3*np.sqrt(np.count_nonzero(psf >= 0.5)/np.pi)))
+    box = psf[max(0,cy-rad):cy+rad+1, max(0,cx-rad):cx+rad+1]
+    yy, xx = np.nonzero(box >= 0.5)
+    yy = yy - (cy - max(0,cy-rad))
+    xx = xx - (cx - max(0,cx-rad))
+    if len(yy) < 2:
+        return np.eye(2)*0.25
+    cov = np.array([[np.mean(yy*yy), np.mean(yy*xx)], [np.mean(yy*xx), np.mean(xx*xx)]]) * 2/np.log(2)
+    return cov + np.eye(2)*1e-3
+
+
+def restore(model, residual, beam):
+    """
+    The restored image : the model convolved with the clean beam (a covariance from fitBeam,
+    with unit peak, so the image is in Jy/beam), plus the residual.
+    """
+    ny, nx = model.shape
+    shape = (2*ny, 2*nx)
+    ## The beam on the zero-padded grid, centred on pixel (0,0) (negative offsets wrap around).
+    yy = (np.fft.fftfreq(shape[0])*shape[0])[:,np.newaxis]
+    xx = (np.fft.fftfreq(shape[1])*shape[1])[np.newaxis,:]
+    icov = np.linalg.inv(beam)
+    kernel = np.exp(-0.5*(icov[0,0]*yy**2 + 2*icov[0,1]*yy*xx + icov[1,1]*xx**2))
+    conv = np.fft.irfft2(np.fft.rfft2(model, s=shape) * np.fft.rfft2(kernel), s=shape)
+    return (conv[0:ny, 0:nx] + residual).astype(residual.dtype, copy=False)
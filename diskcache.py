@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+
+"""diskcache.py: Persistent, content-addressed cache of simulator stage products, as memory-mapped .npy files."""
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+
+import numpy as np
+
+from skymodel import SkyModel
+
+
+## The stages whose products are kept on disk : the antennas, the derived uv products (counts, uv coverage,
+## PSF) and the sky. (The raw uvw tracks are large and quick to recompute, and the later stages depend
+## on display-level settings and are cheap given these.)
+disk_stages = ['antennas', 'sampling', 'weighting', 'psf', 'sky']
+
+## Modules whose code computes the cached products. Their source is part of every key,
+## so that a changed implementation never reads products made by the old one.
+code_modules = ['calcsim.py', 'gridder.py', 'skymodel.py', 'fftbackend.py', 'antconfig.py', 'primarybeam.py']
+
+
+def isSeeded(key):
+    """
+    Whether a stage key depends on the seed of a random layout (directly, or through the stages it depends on).
+    """
+    if any(par=='randseed' and val is not None for par, val in key[1]):
+        return True
+    return any(isSeeded(dep) for dep in key[2:])
+
+
+def codeVersion():
+    """
+    Digest of the source of the modules in code_modules.
+    """
+    digest = hashlib.sha1()
+    here = os.path.dirname(os.path.abspath(__file__))
+    for fname in code_modules:
+        with open(os.path.join(here, fname), 'rb') as fp:
+            digest.update(fp.read())
+    return digest.hexdigest()[0:12]
+
+
+def encodeProducts(value, arrays):
+    """
+    A JSON-able description of a stage's products. Arrays are replaced by references
+    to entries added to the 'arrays' dict (saved separately). Raises TypeError for other objects.
+    """
+    if isinstance(value, np.ndarray):
+        name = 'a%d'%(len(arrays))
+        arrays[name] = value
+        return {'__array__':name}
+    if isinstance(value, dict):
+        return {'__dict__':{str(key):encodeProducts(val, arrays) for key, val in value.items()}}
+    if isinstance(value, (list, tuple)):
+        return {'__list__':[encodeProducts(val, arrays) for val in value]}
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, SkyModel):
+        return {'__skymodel__':value.components}
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    raise TypeError("Cannot store a "+type(value).__name__+" on disk")
+
+
+def decodeProducts(desc, entrydir, mapped=None):
+    """
+    Inverse of encodeProducts. Arrays are memory-mapped (read-only) from the entry's directory,
+    and also appended to the 'mapped' list if one is given.
+    """
+    if isinstance(desc, dict):
+        if '__array__' in desc:
+            arr = np.load(os.path.join(entrydir, desc['__array__']+'.npy'), mmap_mode='r')
+            if mapped is not None:
+                mapped.append(arr)
+            return arr
+        if '__dict__' in desc:
+            return {key:decodeProducts(val, entrydir, mapped) for key, val in desc['__dict__'].items()}
+        if '__list__' in desc:
+            return [decodeProducts(val, entrydir, mapped) for val in desc['__list__']]
+        if '__skymodel__' in desc:
+            return SkyModel(desc['__skymodel__'])
+    return desc
+
+
+class DiskCache:
+    """
+    Two-level cache of stage products for CalcSim (same get/put interface as ResultCache) :
+    an in-memory cache in front (e.g. a ResultCache), backed by a directory of entries that
+    persists across restarts and is shared by all processes using the same directory.
+
+    Each entry is a directory named by a digest of the stage key (and of the code version),
+    holding one .npy file per array and a meta.json for everything else. Entries are written
+    to a temporary directory and renamed into place, so readers only ever see complete entries.
+    Arrays are memory-mapped when read, so loading costs no copies, and pages are shared between processes.
+    Beyond maxbytes, the least recently used entries (by the time of their meta.json, touched on every read) are deleted.
+    """
+
+    def __init__(self, directory, maxbytes=4*1024*1024*1024, front=None, stages=disk_stages):
+        self.directory = directory
+        self.maxbytes = maxbytes
+        self.front = front
+        self.stages = list(stages)
+        self.version = codeVersion()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        self.nbytes = self.getUsage()
+
+    def getEntryDir(self, key):
+        digest = hashlib.sha1(repr((self.version, key)).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest[0:2], digest)
+
+    def get(self, key, default=None):
+        if self.front is not None:
+            value = self.front.get(key)
+            if value is not None:
+                return value
+        value = self.load(key)
+        if value is None:
+            return default
+        if self.front is not None:
+            self.front.put(key, value)
+        return value
+
+    def put(self, key, value):
+        if self.front is not None:
+            self.front.put(key, value)
+        self.store(key, value)
+
+    def load(self, key):
+        """
+        The products stored for a key (arrays memory-mapped), or None.
+        """
+        if not self.onDisk(key):
+            return None
+        entrydir = self.getEntryDir(key)
+        mapped = []
+        try:
+            with open(os.path.join(entrydir, 'meta.json')) as fp:
+                meta = json.load(fp)
+            if meta['key']!=repr(key):
+                raise ValueError("Digest collision")
+            value = decodeProducts(meta['products'], entrydir, mapped)
+            os.utime(os.path.join(entrydir, 'meta.json'))
+        except (OSError, ValueError, KeyError):
+            ## Missing (e.g. just evicted by another process) or unreadable : a miss.
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.attach(entrydir, mapped)
+        return value
+
+    def attach(self, entrydir, mapped):
+        """
+        Called with the arrays just mapped from an entry (for SharedStore's reference counts).
+        """
+        pass
+
+    def store(self, key, value):
+        """
+        Write a key's products as a new entry (unless its stage is not kept, or it is already there).
+        """
+        if not self.onDisk(key):
+            return
+        entrydir = self.getEntryDir(key)
+        if os.path.exists(entrydir):
+            return
+        arrays = {}
+        try:
+            desc = encodeProducts(value, arrays)
+        except TypeError:
+            return
+        tmpdir = entrydir+'.%d.%d.tmp'%(os.getpid(), id(value))
+        try:
+            os.makedirs(tmpdir)
+            nbytes = 0
+            for name, arr in arrays.items():
+                np.save(os.path.join(tmpdir, name+'.npy'), arr)
+                nbytes += arr.nbytes
+            with open(os.path.join(tmpdir, 'meta.json'), 'w') as fp:
+                json.dump({'key':repr(key), 'products':desc, 'bytes':nbytes}, fp)
+            os.rename(tmpdir, entrydir)
+        except OSError:
+            ## Already written by another process, or no space : keep going without it.
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            return
+        self.nbytes += nbytes
+        if self.nbytes > self.maxbytes:
+            self.evict()
+
+    def onDisk(self, key):
+        """
+        Whether a key's stage is one of those kept on disk (stage keys start with the stage name).
+        Products of random layouts are not : the web app seeds them from the clock, so they are never asked for again.
+        """
+        return isinstance(key, tuple) and len(key) > 0 and key[0] in self.stages and not isSeeded(key)
+
+    def __contains__(self, key):
+        if self.front is not None and key in self.front:
+            return True
+        return self.onDisk(key) and os.path.exists(os.path.join(self.getEntryDir(key), 'meta.json'))
+
+    def listEntries(self):
+        """
+        (last use time, size in bytes, directory) of every complete entry.
+        """
+        entries = []
+        for sub in os.listdir(self.directory):
+            subdir = os.path.join(self.directory, sub)
+            if not os.path.isdir(subdir):
+                continue
+            for name in os.listdir(subdir):
+                entrydir = os.path.join(subdir, name)
+                try:
+                    used = os.stat(os.path.join(entrydir, 'meta.json')).st_mtime
+                    size = sum(ent.stat().st_size for ent in os.scandir(entrydir))
+                except OSError:
+                    continue
+                entries.append( (used, size, entrydir) )
+        return entries
+
+    def getUsage(self):
+        return sum(size for used, size, entrydir in self.listEntries())
+
+    def evict(self):
+        """
+        Delete the least recently used entries, until the cache is below 90% of maxbytes.
+        Other processes share the directory, so its contents are rescanned first.
+        (Arrays already memory-mapped from a deleted entry stay readable.)
+        """
+        entries = sorted(self.listEntries())
+        total = sum(size for used, size, entrydir in entries)
+        for used, size, entrydir in entries:
+            if total <= 0.9*self.maxbytes:
+                break
+            shutil.rmtree(entrydir, ignore_errors=True)
+            total -= size
+        self.nbytes = total
+
+    def clear(self):
+        if self.front is not None:
+            self.front.clear()
+        for used, size, entrydir in self.listEntries():
+            shutil.rmtree(entrydir, ignore_errors=True)
+        self.nbytes = 0
+
+    def getStats(self):
+        return {'items':len(self.listEntries()), 'bytes':self.nbytes, 'maxbytes':self.maxbytes,
+                'hits':self.hits, 'misses':self.misses}
+
+    def warmup(self, sim, paramsets, stages=('psf','sky')):
+        """
+        Map the stored products of these parameter sets (dicts of CalcSim parameters) into the
+        front cache, without computing anything : each stage and the stages it depends on are looked up
+        by key on the given simulator. Returns the number of stage products found on disk.
+        """
+        found = 0
+        for params in paramsets:
+            sim.setParams(**params)
+            todo = list(stages)
+            while todo:
+                stage = todo.pop()
+                todo.extend(sim.stagedeps[stage])
+                if stage in self.stages and self.get(sim.getStageKey(stage)) is not None:
+                    found += 1
+        return found
+
+
+## The standard configurations : those offered by the web app, at its default observation settings.
+standard_configs = ['YConfig', 'SpiralConfig', 'CircleConfig', 'TConfig']
+standard_nants = [12, 32, 60]
+standard_skies = ['im1', 'im2', 'im3']
+
+def standardParams():
+    return [{'configtype':config, 'nant':nant, 'imtype':sky}
+            for config in standard_configs for nant in standard_nants for sky in standard_skies]
+
+
+def precompute(cache, paramsets=None, precision='double'):
+    """
+    Compute (and so store) the products of the standard configurations, or of the given parameter sets.
+    """
+    from calcsim import CalcSim
+    sim = CalcSim(cache=cache, precision=precision)
+    paramsets = standardParams() if paramsets is None else paramsets
+    for params in paramsets:
+        sim.simulate(stage='psf', **params)
+        sim.simulate(stage='sky', **params)
+    return len(paramsets)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fill or inspect the on-disk cache of simulator products.')
+    parser.add_argument('directory', help='cache directory (as SIMMER_CACHE_DIR for the web app)')
+    parser.add_argument('--precompute', action='store_true', help='compute the standard configurations into the cache')
+    parser.add_argument('--precision', default='double', choices=['double','single'])
+    parser.add_argument('--clear', action='store_true', help='delete all cached products')
+    args = parser.parse_args(argv)
+
+    cache = DiskCache(args.directory)
+    if args.clear:
+        cache.clear()
+    if args.precompute:
+        tim1 = time.time()
+        count = precompute(cache, precision=args.precision)
+        print('Computed %d configurations in %.1f s'%(count, time.time()-tim1))
+    stats = cache.getStats()
+    print('%s : %d entries, %.1f MB'%(args.directory, stats['items'], stats['bytes']/1e6))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
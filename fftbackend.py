@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+"""fftbackend.py: Pluggable 2D FFTs (pyFFTW, scipy.fft or numpy) with real-to-complex transforms and plan reuse."""
+
+import os
+import threading
+
+import numpy as np
+
+
+class FFTBackend:
+    """
+    2D FFTs through the fastest available library :
+      pyfftw : FFTW plans built once per (transform, shape, dtype) and reused (per thread),
+      scipy  : scipy.fft with worker threads (it caches its own plans),
+      numpy  : numpy.fft (single threaded).
+    The library is imported on first use.
+    """
+
+    def __init__(self, name=None, workers=None):
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.name = name
+        self.lib = None
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def getName(self):
+        self.load()
+        return self.name
+
+    def load(self):
+        if self.lib is not None:
+            return
+        with self.lock:
+            if self.lib is not None:
+                return
+            for name in ([self.name] if self.name is not None else ['pyfftw','scipy','numpy']):
+                try:
+                    if name=='pyfftw':
+                        import pyfftw.builders
+                        lib = pyfftw.builders
+                    elif name=='scipy':
+                        import scipy.fft
+                        lib = scipy.fft
+                    elif name=='numpy':
+                        lib = np.fft
+                    else:
+                        raise ValueError("Unknown FFT backend : "+str(name))
+                except ImportError:
+                    if self.name is not None:
+                        raise
+                    continue
+                self.name = name
+                self.lib = lib
+                return
+
+    def getPlan(self, kind, arr, shape=None):
+        """
+        FFTW plan for this transform, from the calling thread's plan cache
+        (plans own their buffers, so they are not shared between threads).
+        """
+        plans = getattr(self.local, 'plans', None)
+        if plans is None:
+            plans = self.local.plans = {}
+        key = (kind, arr.shape, arr.dtype.str, shape)
+        if key not in plans:
+            builder = getattr(self.lib, kind)
+            args = {'threads':self.workers, 'planner_effort':'FFTW_MEASURE', 'avoid_copy':False}
+            if shape is not None:
+                args['s'] = shape
+            plans[key] = builder(np.empty_like(arr), **args)
+        return plans[key]
+
+    def transform(self, kind, arr, shape=None, overwrite=False):
+        """
+        Run one transform. With overwrite=True the input may be used as scratch space.
+        """
+        self.load()
+        if self.name=='pyfftw':
+            ## The plan's output buffer is reused by the next call, so hand back a copy.
+            return self.getPlan(kind, arr, shape)(arr).copy()
+        args = {} if shape is None else {'s':shape}
+        if self.name=='scipy':
+            args['workers'] = self.workers
+            args['overwrite_x'] = overwrite
+        return getattr(self.lib, kind)(arr, **args)
+
+    def fft2(self, arr):
+        return self.transform('fft2', arr)
+
+    def rfft2(self, arr):
+        return self.transform('rfft2', arr)
+
+    def irfft2(self, arr, shape, overwrite=False):
+        return self.transform('irfft2', arr, tuple(shape), overwrite)
+
+
+default_backend = None
+
+def getBackend():
+    """
+    The process-wide default backend (best available library, all cores).
+    The SIMMER_FFT and SIMMER_FFT_THREADS environment variables override the choice.
+    """
+    global default_backend
+    if default_backend is None:
+        workers = os.environ.get('SIMMER_FFT_THREADS')
+        default_backend = FFTBackend(name=os.environ.get('SIMMER_FFT'),
+                                     workers=int(workers) if workers else None)
+    return default_backend
+
+
+def setBackend(name=None, workers=None):
+    global default_backend
+    default_backend = FFTBackend(name=name, workers=workers)
+    return default_backend
+
+
+class CentredFT:
+    """
+    Centred 2D transforms (the CalcSim.ft2d convention : fftshift(fft2(ifftshift(x))) ) for one
+    grid shape, with the shifts folded into (-1)^(i+j) sign patterns (built once per precision) and 
+    slice-wise gathers. Even grid sizes only.
+    """
+
+    def __init__(self, shape, backend=None):
+        self.shape = tuple(shape)
+        self.backend = backend
+        nx, ny = self.shape
+        if nx%2 or ny%2:
+            raise ValueError("CentredFT needs even grid sizes, not "+str(self.shape))
+        ## Sign patterns, by real type
+        self.checkers = {}
+
+    def getCheckers(self, dtype):
+        """
+        The sign patterns (checker, outchecker, halfchecker) in the real type of an array type (float32
+        for float32 and complex64 data), so that applying them keeps the data's precision.
+        """
+        dtype = np.dtype(dtype)
+        real = np.finfo(dtype).dtype if dtype.kind in 'fc' else np.dtype('float64')
+        if real not in self.checkers:
+            nx, ny = self.shape
+            ## Sign pattern that moves the origin to the grid centre : (-1)^(i+j)
+            checker = np.where( (np.arange(nx)[:,np.newaxis] + np.arange(ny)[np.newaxis,:]) % 2, -1.0, 1.0 ).astype(real)
+            ## ... and the overall sign (-1)^(nx/2+ny/2) that moves it back on the output side.
+            outchecker = checker * real.type(-1.0 if (nx//2 + ny//2)%2 else 1.0)
+            halfchecker = np.ascontiguousarray(checker[:, 0:ny//2+1])
+            self.checkers[real] = (checker, outchecker, halfchecker)
+        return self.checkers[real]
+
+    def getFFT(self):
+        return self.backend if self.backend is not None else getBackend()
+
+    def ft(self, inpdat):
+        """
+        Full centred transform. Real inputs use a real-to-complex FFT and Hermitian symmetry.
+        """
+        nx, ny = self.shape
+        checker, outchecker, halfchecker = self.getCheckers(inpdat.dtype)
+        if np.iscomplexobj(inpdat):
+            return outchecker * self.getFFT().fft2(checker * inpdat)
+        half = self.getFFT().rfft2(checker * inpdat)
+        full = np.empty(self.shape, half.dtype)
+        full[:, 0:ny//2+1] = half
+        ## Y[r, ny-k] = conj(Y[-r, k])
+        full[:, ny//2+1:] = np.conj(half[(-np.arange(nx)) % nx, 1:ny//2][:, ::-1])
+        full *= outchecker
+        return full
+
+    def ftHermitian(self, uvgrid, work=None):
+        """
+        Real part of the centred transform of a Hermitian-symmetric uv grid (e.g. uvcov, or uvcov*ftsky),
+        which is real. Uses a half-plane complex-to-real FFT. 
+        'work' is an optional (nx, ny/2+1) scratch array (of uvgrid's dtype) for the half-plane.
+        """
+        nx, ny = self.shape
+        cx, cy = nx//2, ny//2
+        half = np.empty((nx, cy+1), uvgrid.dtype) if work is None else work
+
+        ## Gather the unshifted half-plane (rows cx..nx-1,0..cx-1 and columns cy..ny-1,0) with plain slices
+        half[0:nx-cx, 0:ny-cy] = uvgrid[cx:, cy:]
+        half[0:nx-cx, ny-cy] = uvgrid[cx:, 0]
+        half[nx-cx:, 0:ny-cy] = uvgrid[0:cx, cy:]
+        half[nx-cx:, ny-cy] = uvgrid[0:cx, 0]
+
+        ## fft2(H) = N^2 irfft2(conj(H)) for Hermitian H
+        np.conj(half, out=half)
+        half *= self.getCheckers(half.dtype)[2]
+        out = self.getFFT().irfft2(half, self.shape, overwrite=True)
+        out *= (nx*ny)
+        return out
+
+
+centred_fts = {}
+
+def getCentredFT(shape):
+    """
+    Shared CentredFT for a grid shape (its tables are only read once built, so threads can share it).
+    """
+    shape = tuple(shape)
+    if shape not in centred_fts:
+        centred_fts[shape] = CentredFT(shape)
+    return centred_fts[shape]
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""gridder.py: Grid explicit visibilities onto a regular uv-plane."""
+
+import numpy as np
+
+
+def gridIndices(u, v, npix):
+    """
+    Nearest grid cell (x, y) for visibilities at (u, v), in units of uv-grid pixels
+    relative to the grid centre at (npix/2, npix/2).
+    """
+    xloc = np.rint(np.asarray(u,'float')).astype(np.int64) + int(npix/2)
+    yloc = np.rint(np.asarray(v,'float')).astype(np.int64) + int(npix/2)
+    return xloc, yloc
+
+
+def kernelTaps(kernel='nearest', support=None):
+    """
+    Tap offsets (relative to the nearest cell) and the 1D kernel function for a gridding kernel.
+      nearest  : a single cell
+      linear   : bilinear interpolation over the nearest cells
+      gaussian : truncated Gaussian (FWHM of one cell) over +/-support cells
+    """
+    if kernel=='nearest':
+        return np.array([0]), None
+    if kernel=='linear':
+        support = 1 if support is None else support
+        func = lambda d: np.clip(1.0-np.abs(d), 0.0, None)
+    elif kernel=='gaussian':
+        support = 3 if support is None else support
+        sig = 1.0/np.sqrt(8.0*np.log(2.0))
+        func = lambda d: np.exp(-0.5*(d/sig)**2) * (np.abs(d)<=support)
+    else:
+        raise ValueError("Unknown gridding kernel : "+str(kernel))
+    return np.arange(-support,support+1), func
+
+
+def gridVisibilities(u, v, npix,
+                     weight=None,
+                     vis=None,
+                     kernel='nearest',
+                     support=None,
+                     hermitian=True,
+                     out=None):
+    """
+    Grid visibilities with a scatter-add (np.add.at, straight into the grid) onto an npix x npix uv grid.
+    The cost and the work space scale with the number of visibilities (times the kernel size), not with npix.
+
+    u, v      : coordinates in uv-grid pixels relative to the grid centre (grid[x,y] has x along u).
+    weight    : per-visibility weights (default 1.0).
+    vis       : complex visibilities. If given, the grid holds sum(weight*vis) and is complex,
+                otherwise it holds sum(weight) and is real.
+    kernel    : 'nearest', 'linear' or 'gaussian'. Kernel taps are normalised per visibility,
+                so that the total gridded weight is conserved.
+    hermitian : also grid the conjugate visibility at (-u,-v), as for a real sky.
+    out       : optional (contiguous) npix x npix array to add into, e.g. for single precision grids.
+
+    Visibilities that fall off the grid are dropped.
+    """
+    shape = np.broadcast(u, v).shape
+    u = np.broadcast_to(np.asarray(u,'float'),shape).ravel()
+    v = np.broadcast_to(np.asarray(v,'float'),shape).ravel()
+    vals = np.ones(len(u),'float') if weight is None else np.broadcast_to(np.asarray(weight),shape).ravel()
+    if vis is not None:
+        vals = vals * np.broadcast_to(np.asarray(vis),shape).ravel()
+
+    if hermitian:
+        u = np.concatenate([u, -u])
+        v = np.concatenate([v, -v])
+        vals = np.concatenate([vals, np.conj(vals)])
+
+    taps, func = kernelTaps(kernel, support)
+    xcen, ycen = gridIndices(u, v, npix)
+
+    if func is not None:
+        xfrac = u + int(npix/2) - xcen
+        yfrac = v + int(npix/2) - ycen
+        kx = func(taps[np.newaxis,:] - xfrac[:,np.newaxis])
+        ky = func(taps[np.newaxis,:] - yfrac[:,np.newaxis])
+        norm = np.sum(kx,axis=1) * np.sum(ky,axis=1)
+        norm[norm==0.0] = 1.0
+
+    if out is None:
+        out = np.zeros((npix,npix), np.result_type(vals.dtype,'float'))
+    grid = out.reshape(npix*npix)
+    for ix, dx in enumerate(taps):
+        for iy, dy in enumerate(taps):
+            xloc = xcen + dx
+            yloc = ycen + dy
+            ongrid = (xloc>=0) & (xloc<npix) & (yloc>=0) & (yloc<npix)
+            idx = (xloc*npix + yloc)[ongrid]
+            tapvals = vals[ongrid]
+            if func is not None:
+                tapvals = tapvals * (kx[ongrid,ix] * ky[ongrid,iy] / norm[ongrid])
+            np.add.at(grid, idx, tapvals)
+
+    return out
+
+
+def gridChannels(u, v, npix, weight=None, vis=None, hermitian=True, out=None):
+    """
+    Grid the visibilities of several channels, each onto its own uv grid, in a single scatter-add
+    (nearest cell, np.add.at straight into the grids, so without temporaries of their size). The last axis of u and v (in uv-grid pixels, as for gridVisibilities) is the channel,
+    and weight and vis broadcast against them. Returns an (nchan, npix, npix) grid, or adds into 'out'.
+    """
+    shape = np.broadcast(u, v).shape
+    nchan = shape[-1]
+    u = np.broadcast_to(np.asarray(u,'float'),shape).ravel()
+    v = np.broadcast_to(np.asarray(v,'float'),shape).ravel()
+    chan = np.broadcast_to(np.arange(nchan),shape).ravel()
+    vals = None if weight is None else np.broadcast_to(np.asarray(weight),shape).ravel()
+    if vis is not None:
+        vals = np.broadcast_to(np.asarray(vis),shape).ravel() if vals is None else vals * np.broadcast_to(np.asarray(vis),shape).ravel()
+
+    if hermitian:
+        u = np.concatenate([u, -u])
+        v = np.concatenate([v, -v])
+        chan = np.concatenate([chan, chan])
+        if vals is not None:
+            vals = np.concatenate([vals, np.conj(vals)])
+
+    xloc, yloc = gridIndices(u, v, npix)
+    ongrid = (xloc>=0) & (xloc<npix) & (yloc>=0) & (yloc<npix)
+    idx = ((chan*npix + xloc)*npix + yloc)[ongrid]
+
+    if out is None:
+        out = np.zeros((nchan,npix,npix), 'float' if vals is None else np.result_type(vals.dtype,'float'))
+    grid = out.reshape(nchan*npix*npix)
+    np.add.at(grid, idx, 1.0 if vals is None else vals[ongrid])
+    return out
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+"""jobqueue.py: Per-session queue of simulator jobs, run in a thread pool, that keeps only the latest request."""
+
+import time
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from calcsim import SimulationCancelled
+from metrics import registry
+
+
+class JobSuperseded(Exception):
+    """
+    Raised by Job.wait() when a newer request (for the same owner and lane) replaced the job,
+    either before it started or while it was running.
+    """
+    pass
+
+
+class Job:
+    """
+    One request : func(job) is run by the queue, and its result (or error) handed to wait().
+    While it runs, 'stage' is the pipeline stage being computed and 'done' those finished.
+    """
+
+    def __init__(self, owner, lane, func):
+        self.owner = owner
+        self.lane = lane
+        self.func = func
+        self.cancelled = False
+        self.result = None
+        self.error = None
+        self.stage = None
+        self.done = []
+        self.submitted = time.time()
+        self.started = None
+        self.finished = threading.Event()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def setStage(self, stage):
+        """
+        Progress report, from CalcSim.progress : a stage is about to be computed.
+        """
+        if self.stage is not None:
+            self.done.append(self.stage)
+        self.stage = stage
+
+    def wait(self, timeout=None):
+        """
+        The job's result, once it has run. Raises JobSuperseded if it was replaced,
+        or the error that func raised.
+        """
+        if not self.finished.wait(timeout):
+            raise TimeoutError("Job still running : "+str(self.lane))
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class JobQueue:
+    """
+    Runs the simulator work of interactive requests in a thread pool, one job at a time per owner
+    (e.g. a session, whose simulator the jobs share), so that request threads only wait for results.
+
+    Requests coalesce : each owner has at most one pending job per lane (e.g. per figure). A new
+    request replaces the pending one, and cancels the running one if it is in the same lane, which then
+    stops at its next pipeline stage (see CalcSim.cancelcheck). Both raise JobSuperseded in their waiters.
+    So however fast a slider sends values, an owner has no backlog : the job running now, and the latest
+    request of each lane after it. Jobs of one owner run in the order of their (latest) requests.
+    """
+
+    def __init__(self, maxworkers=8):
+        self.executor = ThreadPoolExecutor(max_workers=maxworkers, thread_name_prefix='jobs')
+        self.running = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def submit(self, owner, lane, func):
+        """
+        Queue func(job) as the owner's latest request in this lane. Returns the Job.
+        """
+        job = Job(owner, lane, func)
+        with self.lock:
+            queue = self.pending.setdefault(owner, collections.OrderedDict())
+            old = queue.pop(lane, None)
+            if old is not None:
+                self.finish(old, error=JobSuperseded(lane), outcome='superseded')
+            running = self.running.get(owner)
+            if running is not None and running.lane==lane:
+                running.cancel()
+            queue[lane] = job
+            start = owner not in self.running
+            if start:
+                self.running[owner] = None
+        registry.count('simmer_jobs', outcome='submitted', lane=lane)
+        if start:
+            self.executor.submit(self.runOwner, owner)
+        return job
+
+    def run(self, owner, lane, func, timeout=None):
+        """
+        Submit func(job) and wait for its result (see Job.wait).
+        """
+        return self.submit(owner, lane, func).wait(timeout)
+
+    def runOwner(self, owner):
+        """
+        Run the owner's pending jobs, oldest request first, until there are none.
+        """
+        while True:
+            with self.lock:
+                queue = self.pending.get(owner)
+                if not queue:
+                    self.pending.pop(owner, None)
+                    self.running.pop(owner, None)
+                    return
+                lane, job = queue.popitem(last=False)
+                self.running[owner] = job
+            job.started = time.time()
+            registry.observe('simmer_job_wait_seconds', job.started-job.submitted, lane=lane)
+            try:
+                with registry.timer('simmer_job_seconds', lane=lane):
+                    result = job.func(job)
+            except SimulationCancelled:
+                self.finish(job, error=JobSuperseded(lane), outcome='cancelled')
+            except Exception as err:
+                self.finish(job, error=err, outcome='failed')
+            else:
+                if job.stage is not None:
+                    job.done.append(job.stage)
+                    job.stage = None
+                if job.cancelled:
+                    ## Finished before it reached a stage where it could stop, but the newer request is queued.
+                    self.finish(job, error=JobSuperseded(lane), outcome='cancelled')
+                else:
+                    self.finish(job, result=result, outcome='done')
+
+    def finish(self, job, result=None, error=None, outcome='done'):
+        job.result = result
+        job.error = error
+        job.finished.set()
+        registry.count('simmer_jobs', outcome=outcome, lane=job.lane)
+
+    def cancel(self, owner):
+        """
+        Drop all of the owner's pending jobs, and stop its running one.
+        """
+        with self.lock:
+            queue = self.pending.get(owner) or {}
+            jobs = list(queue.values())
+            queue.clear()
+            running = self.running.get(owner)
+        for job in jobs:
+            self.finish(job, error=JobSuperseded(job.lane), outcome='superseded')
+        if running is not None:
+            running.cancel()
+
+    def getProgress(self, owner):
+        """
+        What the owner's queue is doing : the running job's lane, stage, stages done and time so far,
+        and the lanes of the pending jobs. None when idle.
+        """
+        with self.lock:
+            job = self.running.get(owner)
+            pending = list((self.pending.get(owner) or {}).keys())
+        if job is None:
+            return None if not pending else {'lane':None, 'stage':None, 'done':[], 'elapsed':0.0, 'pending':pending}
+        return {'lane':job.lane, 'stage':job.stage, 'done':list(job.done),
+                'elapsed':time.time()-(job.started or job.submitted), 'pending':pending}
+
+    def shutdown(self):
+        with self.lock:
+            owners = list(self.pending.keys())
+        for owner in owners:
+            self.cancel(owner)
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+"""metrics.py: Timers, counters and latency histograms for the simulator and web app, with text and JSON exports."""
+
+import os
+import json
+import time
+import threading
+import functools
+import contextlib
+
+
+## Histogram bucket upper bounds, for durations (sec) and sizes (bytes)
+time_buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+size_buckets = [1e3, 3e3, 1e4, 3e4, 1e5, 3e5, 1e6, 3e6, 1e7]
+
+
+class Histogram:
+    """
+    Counts of observed values in fixed buckets (cumulative on export), with their sum and count.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = list(buckets)
+        self.counts = [0]*(len(self.buckets)+1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        idx = 0
+        while idx < len(self.buckets) and value > self.buckets[idx]:
+            idx += 1
+        self.counts[idx] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, frac):
+        """
+        Estimate of a quantile : the upper bound of the bucket it falls in.
+        """
+        if self.count==0:
+            return None
+        target = frac*self.count
+        running = 0
+        for idx in range(len(self.counts)):
+            running += self.counts[idx]
+            if running >= target:
+                return self.buckets[idx] if idx < len(self.buckets) else float('inf')
+
+    def snapshot(self):
+        return {'count':self.count, 'sum':self.total,
+                'mean':self.total/self.count if self.count else None,
+                'p50':self.quantile(0.5), 'p95':self.quantile(0.95),
+                'buckets':dict(zip([str(bnd) for bnd in self.buckets]+['+Inf'], self.counts))}
+
+
+class Metrics:
+    """
+    A thread-safe registry of named counters, histograms and gauges, each optionally with labels
+    (e.g. stage='psf'). Exported as Prometheus-style text (render) or a dict (snapshot).
+    If a log file is given, every timed event is also appended to it as a line of JSON.
+    """
+
+    def __init__(self, logfile=None):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+        self.logfile = logfile
+        self.started = time.time()
+
+    def count(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, buckets=time_buckets, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets)
+            self.histograms[key].observe(value)
+
+    def addGauge(self, name, func, **labels):
+        """
+        A value read (by calling func()) at export time, e.g. the size of a cache.
+        """
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = func
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """
+        Time a block into the 'name' histogram (sec).
+        The yielded dict can be given extra fields for the log entry.
+        """
+        extra = {}
+        tim1 = time.perf_counter()
+        try:
+            yield extra
+        finally:
+            elapsed = time.perf_counter()-tim1
+            self.observe(name, elapsed, **labels)
+            self.log(name, elapsed, labels, extra)
+
+    def timed(self, name, **labels):
+        """
+        Decorator form of timer().
+        """
+        def decorate(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def log(self, name, elapsed, labels, extra=None):
+        if self.logfile is None:
+            return
+        entry = {'time':round(time.time(),3), 'metric':name, 'seconds':round(elapsed,6)}
+        entry.update(labels)
+        if extra:
+            entry.update(extra)
+        line = json.dumps(entry, default=str)+'\n'
+        with self.lock:
+            with open(self.logfile, 'a') as fp:
+                fp.write(line)
+
+    def snapshot(self):
+        """
+        All metrics as a dict (for JSON) : name -> list of {labels..., value or histogram summary}.
+        """
+        out = {'uptime':time.time()-self.started, 'counters':{}, 'histograms':{}, 'gauges':{}}
+        with self.lock:
+            counters = list(self.counters.items())
+            histograms = [(key, hist.snapshot()) for key, hist in self.histograms.items()]
+            gauges = list(self.gauges.items())
+        for (name, labels), value in counters:
+            out['counters'].setdefault(name, []).append( dict(labels, value=value) )
+        for (name, labels), summary in histograms:
+            out['histograms'].setdefault(name, []).append( dict(labels, **summary) )
+        for (name, labels), func in gauges:
+            out['gauges'].setdefault(name, []).append( dict(labels, value=func()) )
+        return out
+
+    def render(self):
+        """
+        All metrics in the Prometheus text exposition format.
+        """
+        def labelstr(labels, extra=()):
+            items = list(labels) + list(extra)
+            if len(items)==0:
+                return ''
+            return '{' + ','.join('%s="%s"'%(key, str(val).replace('"','\\"')) for key, val in items) + '}'
+
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, hist.snapshot()) for key, hist in self.histograms.items())
+            gauges = sorted(self.gauges.items(), key=lambda item : item[0])
+        for (name, labels), value in counters:
+            lines.append('%s_total%s %s'%(name, labelstr(labels), value))
+        for (name, labels), summary in histograms:
+            running = 0
+            for bound, count in summary['buckets'].items():
+                running += count
+                lines.append('%s_bucket%s %d'%(name, labelstr(labels, [('le', bound)]), running))
+            lines.append('%s_sum%s %g'%(name, labelstr(labels), summary['sum']))
+            lines.append('%s_count%s %d'%(name, labelstr(labels), summary['count']))
+        for (name, labels), func in gauges:
+            lines.append('%s%s %s'%(name, labelstr(labels), func()))
+        return '\n'.join(lines)+'\n'
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+
+## The process-wide registry. SIMMER_METRICS_LOG names an optional JSON-lines log of timed events.
+registry = Metrics(logfile=os.environ.get('SIMMER_METRICS_LOG'))
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+"""prefetch.py: Background computation of neighbouring parameter settings into the shared result cache."""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from calcsim import SimulationCancelled
+from metrics import registry
+
+
+class Prefetcher:
+    """
+    After each interactive request, compute the results for a few nearby parameter
+    settings (e.g. one slider step either way) in a thread pool, so that they are
+    already in the shared cache when the user nudges a slider.
+
+    Work is tracked per owner (e.g. a session id). Scheduling a new batch for an owner
+    cancels its previous batch : queued jobs are dropped, and running ones stop at
+    the next pipeline stage.
+    """
+
+    def __init__(self, factory, cache, maxworkers=2, budget=8):
+        self.factory = factory
+        self.cache = cache
+        self.budget = budget
+        self.executor = ThreadPoolExecutor(max_workers=maxworkers, thread_name_prefix='prefetch')
+        self.local = threading.local()
+        self.batches = {}
+        self.lock = threading.Lock()
+
+    def getSim(self):
+        """
+        One simulator per worker thread, so that its stage memo is reused between jobs.
+        """
+        if not hasattr(self.local, 'sim'):
+            self.local.sim = self.factory(cache=self.cache)
+        return self.local.sim
+
+    def schedule(self, owner, paramsets, randseed=1, stages=['image']):
+        """
+        Replace the owner's pending prefetch work with the given list of parameter dicts
+        (highest priority first), truncated to the budget. Each setting is computed up to
+        the given stages : those that the request being anticipated would run (e.g. 'clean').
+        """
+        self.cancel(owner)
+        batch = {'cancelled':False, 'futures':[], 'stages':list(stages)}
+        for params in paramsets[0:self.budget]:
+            batch['futures'].append( self.executor.submit(self.runJob, batch, params, randseed) )
+        with self.lock:
+            self.batches[owner] = batch
+        return batch['futures']
+
+    def cancel(self, owner):
+        with self.lock:
+            batch = self.batches.pop(owner, None)
+        if batch is not None:
+            batch['cancelled'] = True
+            for fut in batch['futures']:
+                fut.cancel()
+
+    def runJob(self, batch, params, randseed):
+        stages = batch['stages']
+        label = ','.join(stages)
+        if batch['cancelled']:
+            registry.count('simmer_prefetch_jobs', outcome='dropped', stage=label)
+            return None
+        sim = self.getSim()
+        sim.randseed = randseed
+        sim.cancelcheck = lambda : batch['cancelled']
+        try:
+            with registry.timer('simmer_prefetch_seconds', stage=label):
+                sim.simulate(stage=stages[0], **params)
+                for stage in stages[1:]:
+                    sim.runStage(stage)
+                recomputed = sim.getRecomputed()
+            registry.count('simmer_prefetch_jobs', outcome='done' if recomputed else 'cached', stage=label)
+            return recomputed
+        except SimulationCancelled:
+            registry.count('simmer_prefetch_jobs', outcome='cancelled', stage=label)
+            return None
+        finally:
+            sim.cancelcheck = None
+
+    def shutdown(self):
+        with self.lock:
+            owners = list(self.batches.keys())
+        for owner in owners:
+            self.cancel(owner)
+        self.executor.shutdown(wait=False)
+
+
+def neighbourSettings(values, sliders, first=None):
+    """
+    Slider values one step either side of the current ones, for each slider.
+
+    values  : dict of current control values (by control id).
+    sliders : dict of control id -> (step, min, max) for the sliders to explore.
+    first   : control id to explore first (e.g. the one that was just moved).
+
+    Returns a list of value dicts, each differing from 'values' in one slider.
+    Values are rounded to the step's precision, so that they match what the slider itself sends.
+    """
+    order = [first] if first in sliders else []
+    order = order + [sid for sid in sliders if sid not in order]
+    settings = []
+    for sid in order:
+        step, vmin, vmax = sliders[sid]
+        ndec = max(0, len(repr(float(step)).split('.')[1].rstrip('0')))
+        for sign in [+1, -1]:
+            newval = round(values[sid] + sign*step, ndec)
+            if vmin <= newval <= vmax:
+                newvalues = dict(values)
+                newvalues[sid] = newval
+                settings.append(newvalues)
+    return settings
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+"""primarybeam.py: Airy-disk primary beams of finite dishes, evaluated per frequency and cached."""
+
+import numpy as np
+
+from skymodel import besselj1, ARCSEC
+from resultcache import ResultCache
+
+
+## Voltage patterns, shared by all simulators (and threads) in the process, keyed by
+## (dish diameter, frequency, npix, cellsize, dtype). Each is an npix x npix image.
+beam_cache = ResultCache(maxbytes=256*1024*1024)
+
+## Largest number of pixel values evaluated at once (all frequencies together)
+max_evaluate = 4*1024*1024
+
+
+def airyVoltage(diam, freqs, npix, cellsize, dtype='float'):
+    """
+    Voltage patterns 2 J1(x)/x, x = pi D sin(theta)/lambda, of a uniformly illuminated dish of
+    diameter 'diam' (m), at each frequency (Hz), on an npix x npix grid of cellsize (arcsec) pixels
+    centred on npix/2. Returns an (nfreq, npix, npix) array, from the cache where possible.
+    The radius image is computed once, and all the missing frequencies are evaluated together.
+    """
+    freqs = np.atleast_1d(np.asarray(freqs,'float'))
+    dtype = np.dtype(dtype)
+    keys = [(float(diam), float(freq), int(npix), float(cellsize), dtype.str) for freq in freqs]
+    beams = [beam_cache.get(key) for key in keys]
+    missing = [idx for idx in range(len(freqs)) if beams[idx] is None]
+
+    if len(missing) > 0:
+        cen = npix//2
+        offs = (np.arange(npix) - cen) * cellsize * ARCSEC
+        radius = np.sin( np.sqrt(offs[:,np.newaxis]**2 + offs[np.newaxis,:]**2) ).ravel()
+        scales = np.pi*diam*freqs[missing]/299792458.0
+        step = max(1, max_evaluate//radius.size)
+        for first in range(0, len(missing), step):
+            xx = scales[first:first+step, np.newaxis] * radius[np.newaxis,:]
+            safe = np.where(xx>0, xx, 1.0)
+            vbeams = np.where(xx>0, 2*besselj1(safe)/safe, 1.0).astype(dtype).reshape(-1, npix, npix)
+            for idx, vbeam in zip(missing[first:first+step], vbeams):
+                vbeam.setflags(write=False)
+                beam_cache.put(keys[idx], vbeam)
+                beams[idx] = vbeam
+    return np.stack(beams)
+
+
+def apparentBeam(diams, freqs, npix, cellsize, dtype='float'):
+    """
+    Band-averaged primary beam (power) seen by an array of dishes with the given diameters :
+    the mean over frequencies and over baselines (i,j) of V_i * V_j. Only the distinct
+    diameters are evaluated, and the baselines are counted per pair of diameters.
+    The mean is accumulated over chunks of frequencies (of at most max_evaluate pixel values
+    per diameter), so that only a chunk of voltage patterns is held at a time, whatever the band.
+    """
+    udiams, counts = np.unique(np.asarray(diams,'float'), return_counts=True)
+    freqs = np.atleast_1d(np.asarray(freqs,'float'))
+    ## Number of baselines of each pair of diameters
+    pairs = {}
+    for ia in range(len(udiams)):
+        for ib in range(ia, len(udiams)):
+            npair = counts[ia]*(counts[ia]-1)//2 if ia==ib else counts[ia]*counts[ib]
+            if npair > 0:
+                pairs[(ia,ib)] = int(npair)
+    pbeam = np.zeros((npix,npix), dtype)
+    step = max(1, max_evaluate//(npix*npix))
+    for first in range(0, len(freqs), step):
+        vbeams = [ airyVoltage(diam, freqs[first:first+step], npix, cellsize, dtype) for diam in udiams ]
+        for (ia, ib), npair in pairs.items():
+            pbeam += npair * np.sum(vbeams[ia]*vbeams[ib], axis=0)
+    pbeam /= max(sum(pairs.values()),1) * len(freqs)
+    return pbeam
+
+
+def beamFWHM(diam, freq):
+    """
+    Approximate half power width (arcsec) of the primary beam : 1.02 lambda/D.
+    """
+    return 1.02*(299792458.0/freq)/diam / ARCSEC
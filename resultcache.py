@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+"""resultcache.py: Thread-safe, size-bounded LRU cache of simulator pipeline products."""
+
+import threading
+import collections
+
+import numpy as np
+
+
+def productSize(value):
+    """
+    Approximate memory footprint (bytes) of a stage's products : the sum of all array sizes.
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(productSize(val) for val in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(productSize(val) for val in value)
+    return 0
+
+
+class ResultCache:
+    """
+    LRU cache of computed products, keyed by (hashable) parameter tuples,
+    and bounded by the total size of the cached arrays.
+    One instance can be shared by many CalcSim objects, across threads.
+    Cached products are shared, so they must be treated as read-only.
+    """
+
+    def __init__(self, maxbytes=512*1024*1024):
+        self.maxbytes = maxbytes
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        size = productSize(value)
+        if size > self.maxbytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.nbytes += size
+            while self.nbytes > self.maxbytes and len(self.entries) > 1:
+                oldkey, (oldval, oldsize) = self.entries.popitem(last=False)
+                self.nbytes -= oldsize
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def getStats(self):
+        with self.lock:
+            return {'items':len(self.entries), 'bytes':self.nbytes, 'maxbytes':self.maxbytes,
+                    'hits':self.hits, 'misses':self.misses}
+
+
+class SessionStore:
+    """
+    Per-session simulator state. Each session id gets its own CalcSim (and a lock to
+    serialise callbacks within that session), and all of them share one ResultCache.
+    The least recently used sessions are dropped beyond maxsessions. Each simulator also
+    holds scratch buffers (its BufferPool), which are not in the shared cache : beyond
+    maxbytes of them in all, the least recently used sessions release theirs (which they
+    allocate again if they are used again), and dropped sessions release them at once.
+    """
+
+    def __init__(self, factory, cache=None, maxsessions=64, maxbytes=512*1024*1024):
+        self.factory = factory
+        self.cache = cache
+        self.maxsessions = maxsessions
+        self.maxbytes = maxbytes
+        self.sessions = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, sessionid):
+        """
+        Returns (simulator, lock) for a session, creating it on first use.
+        """
+        with self.lock:
+            if sessionid in self.sessions:
+                self.sessions.move_to_end(sessionid)
+                entry = self.sessions[sessionid]
+                self.releaseScratch(entry)
+                return entry
+        ## Construct outside the store lock : a new simulator computes its defaults.
+        entry = (self.factory(cache=self.cache), threading.Lock())
+        with self.lock:
+            entry = self.sessions.setdefault(sessionid, entry)
+            self.sessions.move_to_end(sessionid)
+            while len(self.sessions) > self.maxsessions:
+                sim, lock = self.sessions.popitem(last=False)[1]
+                sim.buffers.clear()
+            self.releaseScratch(entry)
+        return entry
+
+    def releaseScratch(self, current):
+        """
+        Clear the scratch buffers of the least recently used sessions (other than the current one)
+        while those of all sessions are more than maxbytes. Called with the store lock held.
+        """
+        total = sum(sim.buffers.getSize() for sim, lock in self.sessions.values())
+        for entry in list(self.sessions.values()):
+            if total <= self.maxbytes:
+                break
+            if entry is current:
+                continue
+            total -= entry[0].buffers.getSize()
+            entry[0].buffers.clear()
+
+    def getScratchSize(self):
+        """
+        Total size (bytes) of the sessions' scratch buffers.
+        """
+        with self.lock:
+            return sum(sim.buffers.getSize() for sim, lock in self.sessions.values())
+
+    def __len__(self):
+        with self.lock:
+            return len(self.sessions)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+"""sharedstore.py: Stage products in shared memory, published once and mapped by every server process."""
+
+import os
+import sys
+import shutil
+import weakref
+import argparse
+import threading
+
+from diskcache import DiskCache, disk_stages
+
+
+## Where the store lives : a RAM-backed (tmpfs) directory, so that its files are shared memory.
+shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+def defaultName():
+    return 'simmer-%d'%(os.getuid()) if hasattr(os, 'getuid') else 'simmer'
+
+
+def pidAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class SharedStore(DiskCache):
+    """
+    Cache of stage products (same get/put interface as ResultCache) in shared memory, for servers with
+    several worker processes : the first process to compute a product publishes its arrays, and every
+    process maps them from there, without a copy. So memory grows with the number of distinct products,
+    not with processes times products.
+
+    Entries are those of DiskCache (one .npy file per array, and a meta.json, published by a rename), in
+    a directory on a tmpfs file system (/dev/shm), whose pages are the shared memory itself. Entries can
+    also be read from and written through to a persistent DiskCache behind ('back'), which then has no front.
+
+    Each process keeps a reference file (ref.<pid>) in the entries whose arrays it has mapped, removed
+    once it has dropped all of them (e.g. when its front cache evicts them). Beyond maxbytes, the least
+    recently used entries that no live process refers to are deleted. (References of processes that have
+    exited are cleared then.)
+    """
+
+    def __init__(self, name=None, maxbytes=2*1024*1024*1024, front=None, back=None, stages=disk_stages, directory=None):
+        if directory is None:
+            if shm_dir is None:
+                raise ValueError("No shared memory file system (/dev/shm) : give a directory for the shared store")
+            directory = os.path.join(shm_dir, defaultName() if name is None else name)
+        self.back = back
+        self.attached = {}
+        self.reflock = threading.RLock()
+        DiskCache.__init__(self, directory, maxbytes=maxbytes, front=front, stages=stages)
+
+    def load(self, key):
+        """
+        The products of a key, mapped from shared memory. Products found only in the back cache
+        are published to shared memory first, so that the other processes map the same copy.
+        """
+        value = DiskCache.load(self, key)
+        if value is None and self.back is not None and self.onDisk(key):
+            value = self.back.get(key)
+            if value is not None:
+                DiskCache.store(self, key, value)
+                value = DiskCache.load(self, key) or value
+        return value
+
+    def put(self, key, value):
+        """
+        Publish a key's products, and keep the shared copy of them (rather than this process's own) in the front cache.
+        """
+        self.store(key, value)
+        if self.front is not None:
+            mapped = DiskCache.load(self, key) if self.onDisk(key) else None
+            self.front.put(key, value if mapped is None else mapped)
+
+    def store(self, key, value):
+        DiskCache.store(self, key, value)
+        if self.back is not None:
+            self.back.put(key, value)
+
+    def attach(self, entrydir, mapped):
+        """
+        Count this process's arrays mapped from an entry, with a reference file while there are any.
+        Each array's count is released when it (and every view of it) is garbage collected.
+        """
+        if len(mapped)==0:
+            return
+        with self.reflock:
+            count = self.attached.get(entrydir, 0)
+            if count==0:
+                try:
+                    open(os.path.join(entrydir, 'ref.%d'%(os.getpid())), 'w').close()
+                except OSError:
+                    pass
+            self.attached[entrydir] = count + len(mapped)
+        for arr in mapped:
+            weakref.finalize(arr, self.detach, entrydir)
+
+    def detach(self, entrydir):
+        with self.reflock:
+            count = self.attached.get(entrydir, 0) - 1
+            if count > 0:
+                self.attached[entrydir] = count
+                return
+            self.attached.pop(entrydir, None)
+            try:
+                os.remove(os.path.join(entrydir, 'ref.%d'%(os.getpid())))
+            except OSError:
+                pass
+
+    def getRefs(self, entrydir):
+        """
+        Process ids that refer to an entry. References of processes that no longer exist are removed.
+        """
+        pids = []
+        try:
+            names = os.listdir(entrydir)
+        except OSError:
+            return pids
+        for fname in names:
+            if not fname.startswith('ref.'):
+                continue
+            pid = int(fname[4:])
+            if pid==os.getpid() or pidAlive(pid):
+                pids.append(pid)
+            else:
+                try:
+                    os.remove(os.path.join(entrydir, fname))
+                except OSError:
+                    pass
+        return pids
+
+    def evict(self):
+        """
+        Delete the least recently used entries that no process refers to, until the store is
+        below 90% of maxbytes (or only referenced entries are left).
+        """
+        entries = sorted(self.listEntries())
+        total = sum(size for used, size, entrydir in entries)
+        for used, size, entrydir in entries:
+            if total <= 0.9*self.maxbytes:
+                break
+            if len(self.getRefs(entrydir)) > 0:
+                continue
+            shutil.rmtree(entrydir, ignore_errors=True)
+            total -= size
+        self.nbytes = total
+
+    def getStats(self):
+        stats = DiskCache.getStats(self)
+        stats['attached'] = len(self.attached)
+        return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Inspect or clear the shared memory store of simulator products.')
+    parser.add_argument('--name', default=None, help='store name, as SIMMER_SHARED_NAME for the web app (default : %s)'%(defaultName()))
+    parser.add_argument('--clear', action='store_true', help='delete all products (those still mapped stay readable by their processes)')
+    args = parser.parse_args(argv)
+
+    store = SharedStore(args.name)
+    if args.clear:
+        store.clear()
+    entries = store.listEntries()
+    inuse = sum(1 for used, size, entrydir in entries if len(store.getRefs(entrydir)) > 0)
+    print('%s : %d entries (%d in use), %.1f MB'%(store.directory, len(entries), inuse,
+                                                   sum(size for used, size, entrydir in entries)/1e6))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -8,7 +8,7 @@ __email__ = "rurvashi@nrao.edu"
 import dash
 from dash import dcc
 from dash import html
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State
 #import dash_daq as daq
 #import pandas as pd
 import plotly.graph_objs as go
@@ -16,19 +16,120 @@ import plotly.graph_objs as go
 import numpy as np
 import copy
 import time
+import uuid
+import os
+import functools
+import json
+import threading
+import plotly
+import flask
 
 from calcsim import CalcSim
+from resultcache import ResultCache, SessionStore
+from diskcache import DiskCache, standardParams
+from sharedstore import SharedStore
+from prefetch import Prefetcher, neighbourSettings
+from jobqueue import JobQueue, JobSuperseded
+from transport import heatmapTrace, contourTrace, payloadKey, colorscales
+from primarybeam import beamFWHM
+from antconfig import listConfigs
+from metrics import registry, size_buckets
 
-tel = CalcSim()
+## Computed products are shared by all sessions (bounded LRU, keyed by parameters),
+## while each browser session gets its own simulator state.
+## SIMMER_PRECISION=single runs all simulators in float32/complex64, at half the memory.
+newsim = functools.partial(CalcSim, precision=os.environ.get('SIMMER_PRECISION','double'))
+results = ResultCache(maxbytes=1024*1024*1024)
+
+## The uv coverage, PSF and sky products are also kept on disk (SIMMER_CACHE_DIR, '' to turn this off),
+## so they survive restarts and are shared with other server processes. Those of the standard
+## configurations are mapped in (not computed) at startup, in the background; see diskcache.py --precompute.
+## With several server processes (e.g. gunicorn -w 4 simmer:server), SIMMER_SHARED_GB (> 0) also keeps them in shared
+## memory (/dev/shm/SIMMER_SHARED_NAME), in front of the disk : each is computed once and mapped by every process.
+cache_dir = os.environ.get('SIMMER_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.simmer_cache'))
+shared_gb = float(os.environ.get('SIMMER_SHARED_GB','0'))
+diskcache = None
+sharedstore = None
+cache = results
+if cache_dir:
+    diskcache = DiskCache(cache_dir, maxbytes=int(float(os.environ.get('SIMMER_CACHE_GB','4'))*1024**3),
+                          front=None if shared_gb > 0 else results)
+    cache = diskcache
+if shared_gb > 0:
+    sharedstore = SharedStore(os.environ.get('SIMMER_SHARED_NAME') or None, maxbytes=int(shared_gb*1024**3),
+                              front=results, back=diskcache)
+    cache = sharedstore
+sessions = SessionStore(newsim, cache=cache, maxsessions=64,
+                        maxbytes=int(float(os.environ.get('SIMMER_SCRATCH_GB','0.5'))*1024**3))
+
+## The simulator work of each callback runs as a job on the session's queue. Requests for a figure that
+## arrive while it is busy (e.g. while a slider is dragged) replace each other, and a running job that
+## a newer one replaces stops at its next pipeline stage : only the latest settings are computed.
+jobs = JobQueue(maxworkers=int(os.environ.get('SIMMER_JOB_WORKERS','8')))
+
+## Results for one step either side of the current slider settings are computed in the
+## background after every update, so the next nudge of a slider is served from the cache.
+prefetcher = Prefetcher(newsim, cache=cache, maxworkers=2, budget=8)
+prefetch_sliders = { 'declination-picker' : (1, -90, +90),
+                     'latitude-picker'    : (1, -90, +90),
+                     'zoom-slider'        : (0.1, -1, 1),
+                     'weighting-picker'   : (0.05, 0.5, +3.7) }
+
+## Encoding of the images sent to the browser (see transport.py), and the size (pixels) 
+## they are reduced to before sending (0 : full resolution).
+image_transport = os.environ.get('SIMMER_TRANSPORT', 'uint8')
+image_maxsize = int(os.environ.get('SIMMER_DISPLAY_PIXELS', '400')) or None
 #prevconfig='YConfig'
 
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 
 app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
 
+## The Flask app, for WSGI servers (e.g. gunicorn -w 4 simmer:server).
+server = app.server
+
+## Instrumentation : per-stage and per-callback latency histograms, cache and prefetch counters and
+## payload sizes, at /metrics (Prometheus text format) and /metrics.json.
+registry.addGauge('simmer_result_cache_bytes', lambda : results.getStats()['bytes'])
+registry.addGauge('simmer_result_cache_items', lambda : results.getStats()['items'])
+registry.addGauge('simmer_result_cache_hits', lambda : results.getStats()['hits'])
+registry.addGauge('simmer_result_cache_misses', lambda : results.getStats()['misses'])
+registry.addGauge('simmer_sessions', lambda : len(sessions))
+registry.addGauge('simmer_session_scratch_bytes', lambda : sessions.getScratchSize())
+if diskcache is not None:
+    registry.addGauge('simmer_disk_cache_bytes', lambda : diskcache.nbytes)
+    registry.addGauge('simmer_disk_cache_hits', lambda : diskcache.hits)
+    registry.addGauge('simmer_disk_cache_misses', lambda : diskcache.misses)
+if sharedstore is not None:
+    registry.addGauge('simmer_shared_store_bytes', lambda : sharedstore.nbytes)
+    registry.addGauge('simmer_shared_store_attached', lambda : len(sharedstore.attached))
+    registry.addGauge('simmer_shared_store_hits', lambda : sharedstore.hits)
+
+@app.server.route('/metrics')
+def metrics_text():
+    return flask.Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+@app.server.route('/metrics.json')
+def metrics_json():
+    return flask.jsonify(registry.snapshot())
 
-#### Set up the Layout
-app.layout = html.Div([
+@app.server.route('/progress/<session_id>')
+def job_progress(session_id):
+    return flask.jsonify(jobs.getProgress(session_id))
+
+
+#### Set up the Layout. 
+#### This is a function, so that every page load gets a new session id.
+def serve_layout():
+    return html.Div([
+    dcc.Store(id='session-id', data=str(uuid.uuid4())),
+    dcc.Store(id='antenna-store'),
+    dcc.Store(id='uvcov-key'),
+    dcc.Store(id='observed-key'),
+    dcc.Store(id='psf-key'),
+    dcc.Store(id='uvcov-timing'),
+    dcc.Store(id='image-timing'),
+    dcc.Interval(id='progress-interval', interval=500),
     html.Div(
         children=[
             html.Div( [ 
@@ -42,7 +143,9 @@ app.layout = html.Div([
                         {'label': 'T', 'value': 'TConfig'},
                         {'label': 'Random', 'value': 'RandomConfig'},
                         {'label': 'Random with Compact Core', 'value': 'RandomCoreConfig'}
-                    ],
+                    ] + 
+                    ## Layout files in antconfigs/ (all their antennas, with their own dish sizes).
+                    [{'label': 'File : '+name, 'value': 'file:'+name} for name in listConfigs()],
                     value='YConfig'
                 ),
                 dcc.Dropdown(
@@ -110,6 +213,12 @@ app.layout = html.Div([
                     marks={str(ha): str(ha) for ha in range(-6,7,1)},
                     step=0.5
                 ) ,
+                dcc.Dropdown(
+                    id='inttime-dropdown',
+                    options=[{'label': '%g s integrations'%(inttime), 'value': inttime} for inttime in [2.0, 10.0, 60.0, 300.0, 900.0]],
+                    value=900.0,
+                    clearable=False
+                ),
                 html.Br(),
                html.H6(children='Observation Bandwidth'),
                 dcc.RangeSlider(
@@ -120,7 +229,25 @@ app.layout = html.Div([
                     value=[1.5,+1.5],
                     marks={str(ha): "%2.1f"%(ha) for ha in np.arange(1.0,2.1,0.1)},
                     step=0.1
-                )
+                ),
+                html.Br(),
+                html.Div( [
+                    dcc.Dropdown(
+                        id='channels-dropdown',
+                        options=[{'label': 'One channel per width', 'value': 0}] +
+                                [{'label': '%d channels'%(nchan), 'value': nchan} for nchan in [1, 4, 16, 64]],
+                        value=0,
+                        clearable=False
+                    )
+                ], style={'width': '55%', 'display': 'inline-block'}),
+                html.Div( [
+                    dcc.Dropdown(
+                        id='chanwidth-dropdown',
+                        options=[{'label': '%g MHz wide'%(1000*width), 'value': width} for width in [0.01, 0.05, 0.1, 0.2]],
+                        value=0.1,
+                        clearable=False
+                    )
+                ], style={'width': '45%', 'display': 'inline-block'})
                 ] , style={'width': '30%', 'display': 'inline-block','vertical-align':'top','padding':'20px'})
             
         ], 
@@ -196,7 +323,8 @@ app.layout = html.Div([
                     options=[
                         {'label': 'One Point Source', 'value': 'im2'},
                         {'label': 'Few Points', 'value': 'im1'},
-                        {'label': 'Multi-Scale', 'value': 'im3'}
+                        {'label': 'Multi-Scale', 'value': 'im3'},
+                        {'label': 'Spectral Mix', 'value': 'im4'}
                     ],
                     value='im1',
                     labelStyle={'display': 'inline-block'}
@@ -214,182 +342,649 @@ app.layout = html.Div([
 #                )
             ], style={'width': '30%', 'display': 'inline-block','vertical-align':'top','padding':'20px'}),
         ], 
+    ),
+
+    html.Div(
+        children=[
+            html.Div( [
+                html.H6(children='Image size (pixels)'),
+                dcc.Dropdown(
+                    id='npix-dropdown',
+                    options=[{'label': str(npix), 'value': npix} for npix in [256, 512, 1024, 2048, 4096]],
+                    value=256,
+                    clearable=False
+                )
+            ], style={'width': '30%', 'display': 'inline-block','vertical-align':'top','padding':'20px'}),
+            html.Div( [
+                html.H6(children='Cell size (arcsec)'),
+                dcc.Dropdown(
+                    id='cellsize-dropdown',
+                    options=[{'label': str(cell), 'value': cell} for cell in [0.5, 1.0, 2.0, 5.0, 10.0, 20.0]],
+                    value=5.0,
+                    clearable=False
+                )
+            ], style={'width': '30%', 'display': 'inline-block','vertical-align':'top','padding':'20px'}),
+            html.Div( [
+                html.H6(children='Padding of the uv grid'),
+                dcc.Dropdown(
+                    id='padding-dropdown',
+                    options=[{'label': 'None', 'value': 1.0},
+                             {'label': '1.5x', 'value': 1.5},
+                             {'label': '2x', 'value': 2.0}],
+                    value=1.0,
+                    clearable=False
+                )
+            ], style={'width': '30%', 'display': 'inline-block','vertical-align':'top','padding':'20px'}),
+        ],
+    ),
+
+    html.Div(
+        children=[
+            html.Div( [
+                html.H6(children='Colour scale'),
+                dcc.Dropdown(
+                    id='colorscale-dropdown',
+                    options=[{'label': name, 'value': name} for name in colorscales],
+                    value='RdBu',
+                    clearable=False
+                )
+            ], style={'width': '30%', 'display': 'inline-block','vertical-align':'top','padding':'20px'}),
+            html.Div( [
+                html.H6(children='System temperature (noise)'),
+                dcc.Slider(
+                    id='noise-slider',
+                    min=0,
+                    max=6,
+                    value=0,
+                    marks={0: {'label': 'None', 'style': {'color': 'black'}},
+                           2: '100 K', 3: '1000 K', 4: '1e4 K', 5: '1e5 K', 6: '1e6 K'},
+                    step=0.25,
+                    included=False,
+                    updatemode='mouseup'
+                )
+            ], style={'width': '30%', 'display': 'inline-block','vertical-align':'top','padding':'20px'}),
+            html.Div( [
+                html.Div(id='timing-report'),
+                html.Div(id='job-progress')
+            ], style={'width': '30%', 'display': 'inline-block','vertical-align':'top','padding':'20px',
+                      'color':'gray', 'fontSize':12})
+        ],
+    ),
+
+    html.Div(
+        children=[
+            html.Div( [ dcc.Graph(id='psf-image') ], 
+                      style={'width': '33%', 'display': 'inline-block','vertical-align':'top'}),
+            html.Div( [
+                html.H6(children='Dish diameter'),
+                dcc.Dropdown(
+                    id='dishdiam-dropdown',
+                    options=[{'label': '%d m'%(diam), 'value': diam} for diam in [6.0, 12.0, 15.0, 25.0, 50.0]],
+                    value=25.0,
+                    clearable=False
+                ),
+                html.Br(),
+                dcc.Checklist(
+                    id='primarybeam-checklist',
+                    options=[{'label': ' Attenuate the sky by the primary beam', 'value': 'on'}],
+                    value=[]
+                )
+            ], style={'width': '30%', 'display': 'inline-block','vertical-align':'top','padding':'20px'}),
+            html.Div( [
+                html.H6(children='Antenna gain errors'),
+                dcc.Dropdown(
+                    id='gaintype-dropdown',
+                    options=[{'label': 'Constant offsets', 'value': 'offset'},
+                             {'label': 'Random walk in time', 'value': 'randomwalk'},
+                             {'label': 'Phase screen (atmosphere)', 'value': 'screen'}],
+                    value='offset',
+                    clearable=False
+                ),
+                html.Br(),
+                html.Div(children='Phase error (deg rms)'),
+                dcc.Slider(
+                    id='gainphase-slider',
+                    min=0,
+                    max=90,
+                    value=0,
+                    marks={str(ph):str(ph) for ph in range(0,91,15)},
+                    step=1,
+                    included=False,
+                    updatemode='mouseup'
+                ),
+                html.Div(children='Amplitude error (fraction rms)'),
+                dcc.Slider(
+                    id='gainamp-slider',
+                    min=0,
+                    max=0.5,
+                    value=0,
+                    marks={str(amp):str(amp) for amp in [0, 0.1, 0.2, 0.3, 0.4, 0.5]},
+                    step=0.01,
+                    included=False,
+                    updatemode='mouseup'
+                )
+            ], style={'width': '30%', 'display': 'inline-block','vertical-align':'top','padding':'20px'}),
+        ],
+    ),
+
+    html.Div(
+        children=[
+            html.Div( [
+                html.H6(children='Deconvolution (CLEAN)'),
+                dcc.Dropdown(
+                    id='cleanalgo-dropdown',
+                    options=[{'label': 'None (dirty image)', 'value': 'none'},
+                             {'label': 'Hogbom', 'value': 'hogbom'},
+                             {'label': 'Clark', 'value': 'clark'}],
+                    value='none',
+                    clearable=False
+                ),
+                html.Br(),
+                html.Div(children='Loop gain'),
+                dcc.Slider(
+                    id='cleangain-slider',
+                    min=0.05,
+                    max=0.5,
+                    value=0.1,
+                    marks={str(gain):str(gain) for gain in [0.05, 0.1, 0.2, 0.3, 0.4, 0.5]},
+                    step=0.05,
+                    included=False,
+                    updatemode='mouseup'
+                )
+            ], style={'width': '30%', 'display': 'inline-block','vertical-align':'top','padding':'20px'}),
+            html.Div( [
+                html.H6(children='CLEAN iterations'),
+                dcc.Slider(
+                    id='cleaniter-slider',
+                    min=0,
+                    max=2000,
+                    value=500,
+                    marks={str(niter):str(niter) for niter in range(0,2001,500)},
+                    step=50,
+                    included=False,
+                    updatemode='mouseup'
+                )
+            ], style={'width': '30%', 'display': 'inline-block','vertical-align':'top','padding':'20px'}),
+            html.Div( [
+                html.H6(children='CLEAN threshold (fraction of the peak)'),
+                dcc.Slider(
+                    id='cleanthresh-slider',
+                    min=0,
+                    max=0.5,
+                    value=0,
+                    marks={str(frac):str(frac) for frac in [0, 0.1, 0.2, 0.3, 0.4, 0.5]},
+                    step=0.01,
+                    included=False,
+                    updatemode='mouseup'
+                )
+            ], style={'width': '30%', 'display': 'inline-block','vertical-align':'top','padding':'20px'}),
+        ],
+    ),
+
+    html.Div(
+        children=[
+            html.Div( [
+                html.H6(children='Spectral imaging'),
+                dcc.RadioItems(
+                    id='specmode-dropdown',
+                    options=[{'label': 'All channels together (MFS)', 'value': 'mfs'},
+                             {'label': 'Image cube', 'value': 'cube'}],
+                    value='mfs',
+                    labelStyle={'display': 'inline-block'}
+                )
+            ], style={'width': '30%', 'display': 'inline-block','vertical-align':'top','padding':'20px'}),
+            html.Div( [
+                html.H6(children='Cube channel shown'),
+                dcc.Slider(
+                    id='cubechan-slider',
+                    min=0,
+                    max=63,
+                    value=0,
+                    marks={str(chan):str(chan) for chan in range(0,64,8)},
+                    step=1,
+                    included=False,
+                    updatemode='mouseup'
+                )
+            ], style={'width': '30%', 'display': 'inline-block','vertical-align':'top','padding':'20px'}),
+        ],
     )
     
 ]) #, style={'columnCount': 2})
 
+app.layout = serve_layout
+
 #### Define all the callbacks here. 
 
-### Update the Antenna Layout plot
+## The ids of the controls that set the simulation parameters.
+control_ids = ['config-dropdown', 'nant-dropdown', 'zoom-slider', 'dishdiam-dropdown',
+               'timerange-slider', 'freqrange-slider', 'declination-picker', 'latitude-picker',
+               'weighting-picker', 'npix-dropdown', 'cellsize-dropdown', 'padding-dropdown',
+               'source-dropdown', 'noise-slider', 'primarybeam-checklist',
+               'gaintype-dropdown', 'gainphase-slider', 'gainamp-slider',
+               'cleanalgo-dropdown', 'cleaniter-slider', 'cleangain-slider', 'cleanthresh-slider',
+               'channels-dropdown', 'chanwidth-dropdown', 'specmode-dropdown', 'cubechan-slider',
+               'inttime-dropdown']
+
+## The controls that only change the observed image (not the uv coverage).
+image_ids = ['source-dropdown', 'noise-slider', 'primarybeam-checklist',
+             'gaintype-dropdown', 'gainphase-slider', 'gainamp-slider',
+             'cleanalgo-dropdown', 'cleaniter-slider', 'cleangain-slider', 'cleanthresh-slider',
+             'specmode-dropdown', 'cubechan-slider']
+
+def sim_params(values):
+    """
+    Convert the values of the controls (by id) into CalcSim.simulate() parameters.
+    (The cube channel shown is not one : see update_image.)
+    """
+    nant = int(values['nant-dropdown'])
+    configtype = values['config-dropdown']
+    if nant==2:
+        ## Using random locations for 2 antennas
+        configtype='RandomConfig'
+    return {'configtype':configtype,
+            'nant':nant,
+            'zoom':2**values['zoom-slider'],
+            'dishdiam':float(values['dishdiam-dropdown']),
+            'primarybeam':'on' in (values['primarybeam-checklist'] or []),
+            'has':values['timerange-slider'],
+            'inttime':float(values['inttime-dropdown']),
+            'dec':values['declination-picker'],
+            'obslatitude':values['latitude-picker'],
+            'weighting':values['weighting-picker'],
+            'bwr':values['freqrange-slider'],
+            'nchan':int(values['channels-dropdown']),
+            'chanwidth':float(values['chanwidth-dropdown']),
+            'imtype':values['source-dropdown'],
+            'npix':int(values['npix-dropdown']),
+            'cellsize':float(values['cellsize-dropdown']),
+            'padding':float(values['padding-dropdown']),
+            ## The slider is log10(Tsys), with 0 for no noise
+            'tsys':10**values['noise-slider'] if values['noise-slider'] > 0 else 0.0,
+            'gaintype':values['gaintype-dropdown'],
+            'gainphase':float(values['gainphase-slider']),
+            'gainamp':float(values['gainamp-slider']),
+            'cleanalgo':values['cleanalgo-dropdown'],
+            'cleaniter':int(values['cleaniter-slider']),
+            'cleangain':float(values['cleangain-slider']),
+            'cleanthresh':float(values['cleanthresh-slider']),
+            'specmode':values['specmode-dropdown']}
+
+def control_values(ctx):
+    """
+    Values of all the controls (by id), from a callback's inputs and states.
+    Every callback gets all of them (those it does not depend on, as states), so that the 
+    session's simulator is always given the full set of parameters.
+    """
+    allvalues = dict(ctx.inputs)
+    allvalues.update(ctx.states)
+    return {cid:allvalues[cid+'.value'] for cid in control_ids}
+
+def run_job(session_id, lane, func):
+    """
+    Run func(tel) on the session's simulator, as a job in the given lane of the session's queue,
+    and return its result. If a newer request in the lane replaces it, the callback makes no update.
+    """
+    tel, tel_lock = sessions.get(session_id)
+    def job_func(job):
+        with tel_lock:
+            tel.cancelcheck = lambda : job.cancelled
+            tel.progress = job.setStage
+            try:
+                return func(tel)
+            finally:
+                tel.cancelcheck = None
+                tel.progress = None
+    try:
+        return jobs.run(session_id, lane, job_func)
+    except JobSuperseded:
+        registry.count('simmer_callbacks_superseded', callback=lane)
+        raise dash.exceptions.PreventUpdate
+
+def image_layout(xtitle, ytitle, title):
+    dispsize = 400
+    return go.Layout(
+            xaxis={'title': xtitle},
+            yaxis={'title': ytitle, 'autorange':True},
+            title=title,
+            width = dispsize, height = dispsize,
+            autosize = True
+        ) 
+
+def image_figure(image, key, sent_key, layout, colorscale):
+    """
+    The figure (or partial update) for an image : the whole figure the first time, 
+    then only its trace (the layout is unchanged), and nothing if the key is unchanged.
+    Returns the update and its size (bytes).
+    """
+    if key==sent_key:
+        return dash.no_update, 0
+    trace = heatmapTrace(image, image_transport, image_maxsize, colorscale)
+    if sent_key is None:
+        figure = {'data':[trace], 'layout':layout}
+    else:
+        figure = dash.Patch()
+        figure['data'][0] = trace
+    return figure, len(json.dumps(trace, cls=plotly.utils.PlotlyJSONEncoder))
+
+## The callbacks form a chain, so that each figure is recomputed only when its own inputs change :
+##   array controls -> antenna-store -> (clientside) antenna-layout
+##   antenna-store + observation controls -> uvcov-image, uvcov-key
+##   uvcov-key + source, noise, primary beam, gain errors, CLEAN settings -> observed-image
+##   uvcov-key + primary beam toggle -> psf-image
+## Colour scale changes are partial (Patch) updates of the image figures.
+
+### Update the Antenna Layout
 @app.callback(
-    [Output('antenna-layout', 'figure'),
-     Output('uvcov-image', 'figure'),
-     Output('observed-image', 'figure')],
+    Output('antenna-store', 'data'),
     [Input('config-dropdown', 'value'),
-     Input('timerange-slider', 'value'),
-     Input('freqrange-slider', 'value'),
-     Input('source-dropdown', 'value'),
      Input('nant-dropdown', 'value'),
      Input('zoom-slider', 'value'),
-     Input('declination-picker', 'value'),
-     Input('latitude-picker', 'value'),
-     Input('weighting-picker','value')
-     ])
-def update_figure(selected_config, 
-                  selected_has,
-                  selected_fas,
-                  selected_im, 
-                  selected_nant, 
-                  selected_zoom,
-                  selected_declination, 
-                  selected_latitude,
-                  selected_weighting):
-
+     Input('dishdiam-dropdown', 'value')],
+    [State(cid, 'value') for cid in control_ids[4:]] +
+    [State('session-id','data')])
+@registry.timed('simmer_callback_seconds', callback='antennas')
+def update_antennas(*args):
     ctx = dash.callback_context
+    values = control_values(ctx)
  #   print 'Trig : ', ctx.triggered
-#    print 'States : ', ctx.states
-#    print 'Inputs : ', ctx.inputs
     
     #Trig :  [{'prop_id': u'config-dropdown.value', 'value': u'RandomConfig'}]
 
-    thischanged=None
-    if ctx.triggered[0]['prop_id'].count('config-dropdown'):
-        thischanged = 'config'
-    if ctx.triggered[0]['prop_id'].count('source-dropdown'):
-        thischanged = 'source'
-    if ctx.triggered[0]['prop_id'].count('timerange-slider'):
-        thischanged = 'timerange'
-    if ctx.triggered[0]['prop_id'].count('freqrange-slider'):
-        thischanged = 'freqrange'
-    if ctx.triggered[0]['prop_id'].count('zoom-slider'):
-        thischanged = 'antzoom'
-    if ctx.triggered[0]['prop_id'].count('nant-dropdown'):
-        thischanged = 'nant'
-    if ctx.triggered[0]['prop_id'].count('declination-picker'):
-        thischanged = 'declination'
-    if ctx.triggered[0]['prop_id'].count('latitude-picker'):
-        thischanged = 'latitude'
-    if ctx.triggered[0]['prop_id'].count('weighting-picker'):
-        thischanged = 'weighting'
-        
-    #print 'This changed : ', thischanged
+    ## A new random layout is drawn only when the configuration itself is (re)selected.
+    changeseed = ctx.triggered[0]['prop_id'].count('config-dropdown') > 0
+
+    ## Background work for this session's previous settings is now stale.
+    prefetcher.cancel(ctx.states['session-id.data'])
+
+    def compute(tel):
+        tel.simulate(changeseed=changeseed, stage='antennas', **sim_params(values))
+        return tel.getAntList(), payloadKey(tel.getStageKey('antennas'))
+    antlist, key = run_job(ctx.states['session-id.data'], 'antennas', compute)
+
+    ## Only the antenna positions are sent : the figure is drawn in the browser.
+    return {'x':np.asarray(antlist['EastLoc']).tolist(), 'y':np.asarray(antlist['NorthLoc']).tolist(),
+            'config':values['config-dropdown'], 'key':key}
+
+app.clientside_callback(
+    """
+    function(ants) {
+        if (!ants) { return window.dash_clientside.no_update; }
+        var dispsize = 400;
+        // Large layouts (e.g. from files) are shown whole.
+        var extent = 1000;
+        for (var i = 0; i < ants.x.length; i++) {
+            extent = Math.max(extent, 1.1*Math.abs(ants.x[i]), 1.1*Math.abs(ants.y[i]));
+        }
+        return {
+            'data': [{'type':'scatter', 'x':ants.x, 'y':ants.y, 'text':ants.config,
+                      'mode':'markers', 'opacity':0.7,
+                      'marker':{'size':15, 'line':{'width':0.5, 'color':'white'}}}],
+            'layout': {'xaxis':{'title':{'text':'X Position (m)'}, 'range':[-extent,extent]},
+                       'yaxis':{'title':{'text':'Y Position (m)'}, 'range':[-extent,extent]},
+                       'title':{'text':'ARRAY CONFIGURATION'},
+                       'width':dispsize, 'height':dispsize, 'autosize':true}
+        };
+    }
+    """,
+    Output('antenna-layout', 'figure'),
+    [Input('antenna-store', 'data')])
+
+
+### Update the Spatial Frequency Coverage
+@app.callback(
+    [Output('uvcov-image', 'figure'),
+     Output('uvcov-key', 'data'),
+     Output('uvcov-timing', 'data')],
+    [Input('antenna-store', 'data'),
+     Input('timerange-slider', 'value'),
+     Input('inttime-dropdown', 'value'),
+     Input('freqrange-slider', 'value'),
+     Input('channels-dropdown', 'value'),
+     Input('chanwidth-dropdown', 'value'),
+     Input('declination-picker', 'value'),
+     Input('latitude-picker', 'value'),
+     Input('weighting-picker','value'),
+     Input('npix-dropdown','value'),
+     Input('cellsize-dropdown','value'),
+     Input('padding-dropdown','value'),
+     Input('colorscale-dropdown','value')],
+    [State(cid, 'value') for cid in ['config-dropdown', 'nant-dropdown', 'zoom-slider', 'dishdiam-dropdown'] + image_ids] +
+    [State('session-id','data'),
+     State('uvcov-key','data')])
+@registry.timed('simmer_callback_seconds', callback='uvcov')
+def update_uvcov(*args):
+    ctx = dash.callback_context
+    session_id = ctx.states['session-id.data']
+    values = control_values(ctx)
+    colorscale = ctx.inputs['colorscale-dropdown.value']
+    sent = ctx.states['uvcov-key.data'] or {}
+
+    prefetcher.cancel(session_id)
+
+    def compute(tel):
+        recomputed = tel.simulate(stage='weighting', **sim_params(values))
+        ## The colour scale is only part of the image data itself for PNG images.
+        key = payloadKey(tel.getStageKey('weighting'), image_transport, image_maxsize,
+                         colorscale if image_transport=='png' else None)
+        return recomputed, key, (tel.getUVcov() if key!=sent.get('key') else None)
 
     tim1 = time.time()
-    if thischanged=='config' or thischanged=='antzoom' or thischanged=='nant':
-        changeseed=True
-        if thischanged=='antzoom' or thischanged=='nant':
-            changeseed=False
-        if eval(selected_nant)==2:
-            selected_config='RandomConfig'
-            print("Using random locations for 2 antennas")
-        tel.calcAntList(configtype = selected_config, 
-                        zoom=2**selected_zoom, 
-                        changeseed=changeseed, 
-                        nant=eval(selected_nant))
-
-#    if thischanged=='antzoom':
-#        tel.scaleAntList(zoom=selected_zoom)
-
-    antlist = tel.getAntList()
-    
-    antlocsX = antlist['EastLoc']
-    antlocsY = antlist['NorthLoc']
+    recomputed, key, uvcovimage = run_job(session_id, 'uvcov', compute)
+    tim2 = time.time()
+
+    if uvcovimage is None:
+        return dash.no_update, dash.no_update, dash.no_update
+
+    layout = image_layout('Spatial frequency : U (pixels)', 'Spatial frequency : V (pixels)', "SPATIAL FREQUENCY COVERAGE")
+    figure, nbytes = image_figure(uvcovimage, key, sent.get('key'), layout, colorscale)
+    tim3 = time.time()
+
+    registry.observe('simmer_simulate_seconds', tim2-tim1, callback='uvcov')
+    registry.observe('simmer_encode_seconds', tim3-tim2, figure='uvcov-image')
+    registry.observe('simmer_payload_bytes', nbytes, buckets=size_buckets, figure='uvcov-image')
+
+    ## The trigger is passed on, so that the image callback can prefetch around the slider that moved.
+    triggered = ctx.triggered[0]['prop_id'].split('.')[0]
+    timing = {'simulate':round(1000*(tim2-tim1),1), 'encode':round(1000*(tim3-tim2),1),
+              'bytes':nbytes, 'recomputed':recomputed}
+    return figure, {'key':key, 'trigger':triggered}, timing
+
 
+### Update the Observed Image
+@app.callback(
+    [Output('observed-image', 'figure'),
+     Output('observed-key', 'data'),
+     Output('image-timing', 'data')],
+    [Input('uvcov-key', 'data')] +
+    [Input(cid, 'value') for cid in image_ids] +
+    [Input('colorscale-dropdown','value')],
+    [State(cid, 'value') for cid in control_ids if cid not in image_ids] +
+    [State('session-id','data'),
+     State('observed-key','data')])
+@registry.timed('simmer_callback_seconds', callback='image')
+def update_image(uvkey, *args):
+    ctx = dash.callback_context
+    session_id = ctx.states['session-id.data']
+    values = control_values(ctx)
+    colorscale = ctx.inputs['colorscale-dropdown.value']
+    sent_key = ctx.states['observed-key.data']
+
+    prefetcher.cancel(session_id)
+
+    def compute(tel):
+        recomputed = tel.simulate(stage='clean', **sim_params(values))
+        if tel.params['specmode']=='cube':
+            ## One channel of the cube, instead of the (MFS, or CLEAN) image.
+            tel.runStage('cube')
+            recomputed = tel.getRecomputed()
+            chan = min(int(values['cubechan-slider']), tel.cube.shape[0]-1)
+            key = payloadKey(tel.getStageKey('cube'), chan, image_transport, image_maxsize,
+                             colorscale if image_transport=='png' else None)
+            obsimage = tel.getCubeImage(chan) if key!=sent_key else None
+            chanfreq = tel.getChannelFrequencies()[chan]
+        else:
+            chan, chanfreq = None, None
+            key = payloadKey(tel.getStageKey('clean'), image_transport, image_maxsize,
+                             colorscale if image_transport=='png' else None)
+            obsimage = tel.getCleanImage() if key!=sent_key else None
+        cleaniter = tel.cleaniterdone if tel.params['cleanalgo']!='none' else None
+        return recomputed, key, obsimage, chan, chanfreq, tel.noiserms, cleaniter, tel.randseed
+
+    tim1 = time.time()
+    recomputed, key, obsimage, chan, chanfreq, noiserms, cleaniter, randseed = run_job(session_id, 'image', compute)
     tim2 = time.time()
 
-#    print antlocsX, antlocsY
-
-    ### Prepare contents of antenna layout plot
-
-    traces1=[]
-    traces1.append( go.Scatter(
-            x=antlocsX,
-            y=antlocsY,
-            text=selected_config,
-            mode='markers',
-            opacity=0.7,
-            marker={
-                'size': 15,
-                'line': {'width': 0.5, 'color': 'white'}
-            },
-        ))
+    ## Precompute the neighbouring slider settings, starting with the slider that just moved,
+    ## up to the stages that compute() runs for them.
+    triggered = ctx.triggered[0]['prop_id'].split('.')[0]
+    if triggered=='uvcov-key' and uvkey is not None:
+        triggered = uvkey['trigger']
+    prefetcher.schedule(session_id,
+                        [sim_params(nvalues) for nvalues in neighbourSettings(values, prefetch_sliders, first=triggered)],
+                        randseed=randseed, stages=['clean','cube'] if chan is not None else ['clean'])
+
+    if obsimage is None:
+        return dash.no_update, dash.no_update, dash.no_update
+
+    title = "OBSERVED IMAGE" if cleaniter is None else "CLEAN IMAGE (%d components)"%(cleaniter)
+    if chan is not None:
+        title = "CHANNEL %d (%.3f GHz)"%(chan, chanfreq/1e+9)
+    elif noiserms > 0.0:
+        title += " (noise %.2g Jy/beam)"%(noiserms)
+    layout = image_layout('Right Ascension (pixels)', 'Declination (pixels)', title)
+    figure, nbytes = image_figure(obsimage, key, sent_key, layout, colorscale)
+    if isinstance(figure, dash.Patch):
+        figure['layout']['title'] = {'text':title}
     tim3 = time.time()
 
+    registry.observe('simmer_simulate_seconds', tim2-tim1, callback='image')
+    registry.observe('simmer_encode_seconds', tim3-tim2, figure='observed-image')
+    registry.observe('simmer_payload_bytes', nbytes, buckets=size_buckets, figure='observed-image')
 
-    ### Prepare contents of observed image.
-    ### Slider callback too
-    if thischanged=='config' or  thischanged=='timerange' or thischanged=='freqrange' or  thischanged=='antzoom' or     thischanged=='nant' or  thischanged=='declination' or   thischanged=='latitude' or thischanged=='weighting':
-        tel.makeUVcov(has=selected_has, 
-                      dec=selected_declination,
-                      obslatitude=selected_latitude,
-                      weighting=selected_weighting,
-                      bwr=selected_fas)
-    tim4 = time.time()
-
-    traces3=[]
-    traces3.append( go.Heatmap(
-            z=tel.getUVcov() ))
-
-
-    ## sky callback
-    if thischanged=='source':
-        tel.setsky(imtype=selected_im)
-    tim5 = time.time()
-    ## Sim
-    tel.makeImage()
-    tim6 = time.time()
-    
-    traces2=[]
-    traces2.append( go.Heatmap(
-            z=tel.getImage() ))
+    timing = {'simulate':round(1000*(tim2-tim1),1), 'encode':round(1000*(tim3-tim2),1),
+              'bytes':nbytes, 'recomputed':recomputed}
+    return figure, key, timing
+
+
+### Update the PSF, with the primary beam as contours
+@app.callback(
+    [Output('psf-image', 'figure'),
+     Output('psf-key', 'data')],
+    [Input('uvcov-key', 'data'),
+     Input('primarybeam-checklist', 'value'),
+     Input('colorscale-dropdown','value')],
+    [State(cid, 'value') for cid in control_ids if cid!='primarybeam-checklist'] +
+    [State('session-id','data'),
+     State('psf-key','data')])
+@registry.timed('simmer_callback_seconds', callback='psf')
+def update_psf(uvkey, *args):
+    ctx = dash.callback_context
+    session_id = ctx.states['session-id.data']
+    values = control_values(ctx)
+    colorscale = ctx.inputs['colorscale-dropdown.value']
+    sent_key = ctx.states['psf-key.data']
 
-    tim7=time.time()
+    def compute(tel):
+        tel.simulate(stage='psf', **sim_params(values))
+        tel.runStage('beam')
+        key = payloadKey(tel.getStageKey('psf'), tel.getStageKey('beam'), image_transport, image_maxsize,
+                         colorscale if image_transport=='png' else None)
+        if key==sent_key:
+            return None
+        return key, tel.getPSF(), tel.getPrimaryBeam(), tel.getDishDiams(), tel.getChannelFrequencies()
 
-#    print 'Ant read time : ', tim2-tim1
-#    print 'Ant plot time : ', tim3-tim2
-#    print 'UVcov time : ', tim4-tim3
-#    print 'Source time : ', tim5-tim4
-#    print 'Observe time :', tim6-tim5
-#    print 'Make raster : ', tim7-tim6
+    tim1 = time.time()
+    result = run_job(session_id, 'psf', compute)
+    if result is None:
+        return dash.no_update, dash.no_update
+    key, psfimage, pbimage, diams, freqs = result
+    tim2 = time.time()
 
-#    print 'Total time in callback : ', tim7-tim1, ' sec'
+    ## The whole figure is sent every time, as the beam contours come and go.
+    data = [heatmapTrace(psfimage, image_transport, image_maxsize, colorscale)]
+    title = "PSF"
+    if pbimage is not None:
+        ## The beam is smooth : its contours are drawn just as well from a 100 pixel image.
+        data.append( contourTrace(pbimage, 100) )
+        title = "PSF + PRIMARY BEAM (FWHM %.0f arcsec)"%(beamFWHM(np.mean(diams), np.mean(freqs)))
+    figure = {'data':data, 'layout':image_layout('Right Ascension (pixels)', 'Declination (pixels)', title)}
+    nbytes = len(json.dumps(data, cls=plotly.utils.PlotlyJSONEncoder))
+    tim3 = time.time()
 
-    ### Return list of outputs, sync'd with specification above
+    registry.observe('simmer_simulate_seconds', tim2-tim1, callback='psf')
+    registry.observe('simmer_encode_seconds', tim3-tim2, figure='psf-image')
+    registry.observe('simmer_payload_bytes', nbytes, buckets=size_buckets, figure='psf-image')
+    return figure, key
 
-    dispsize = 400
 
-    return [{
-        'data': traces1,
-        'layout': go.Layout(
-            xaxis={'title': 'X Position (m)','range':[-1000,1000]},
-            yaxis={'title': 'Y Position (m)','range':[-1000,1000]},
-            title="ARRAY CONFIGURATION",
-            width = dispsize, height = dispsize,
-            autosize = True
-        ) 
-    },
-    {
-        'data': traces3,
-        'layout': go.Layout(
-            xaxis={'title': 'Spatial frequency : U (pixels)'},
-            yaxis={'title': 'Spatial frequency : V (pixels)'},
-            title="SPATIAL FREQUENCY COVERAGE",
-            width = dispsize, height = dispsize,
-            autosize = True
-        ) 
-    },
-    {
-        'data': traces2,
-        'layout': go.Layout(
-            xaxis={'title': 'Right Ascension (pixels)'},
-            yaxis={'title': 'Declination (pixels)'},
-            title="OBSERVED IMAGE",
-            width = dispsize, height = dispsize,
-            autosize = True
-        ) 
+### Change the colour scale of the images, in place.
+@app.callback(
+    [Output('uvcov-image', 'figure', allow_duplicate=True),
+     Output('observed-image', 'figure', allow_duplicate=True),
+     Output('psf-image', 'figure', allow_duplicate=True)],
+    [Input('colorscale-dropdown','value')],
+    prevent_initial_call=True)
+def update_colorscale(colorscale):
+    if image_transport=='png':
+        ## Colour-mapped on the server : the image callbacks re-encode them.
+        return dash.no_update, dash.no_update, dash.no_update
+    figures = []
+    for fig in range(3):
+        figure = dash.Patch()
+        figure['data'][0]['colorscale'] = colorscale
+        figures.append(figure)
+    return figures
+
+
+## Report the server timing and payload sizes, and the time the browser then took to draw
+## the figures (until the second animation frame after they arrived).
+app.clientside_callback(
+    """
+    function(uvtiming, imtiming) {
+        var parts = [];
+        var timings = {'UV coverage':uvtiming, 'Image':imtiming};
+        for (var name in timings) {
+            var timing = timings[name];
+            if (timing) {
+                parts.push(name + ' : simulate ' + timing.simulate + ' ms, encode ' + timing.encode + ' ms, ' +
+                           (timing.bytes/1024).toFixed(1) + ' kB');
+            }
+        }
+        var t0 = performance.now();
+        return new Promise(function(resolve) {
+            requestAnimationFrame(function() { requestAnimationFrame(function() {
+                parts.push('render ' + (performance.now() - t0).toFixed(1) + ' ms');
+                resolve(parts.join(' | '));
+            }); });
+        });
     }
-    ]
+    """,
+    Output('timing-report', 'children'),
+    [Input('uvcov-timing', 'data'),
+     Input('image-timing', 'data')])
+
 
+## Show what the session's job queue is computing (polled from /progress/<session id>).
+app.clientside_callback(
+    """
+    function(n, sessionid, shown) {
+        return fetch('progress/' + sessionid).then(function(resp) { return resp.json(); }).then(function(prog) {
+            var text = '';
+            if (prog && prog.lane) {
+                text = 'Computing ' + prog.lane + (prog.stage ? ' : ' + prog.stage : '') +
+                       ' (' + prog.elapsed.toFixed(1) + ' s, ' + prog.done.length + ' stages done)';
+            }
+            if (prog && prog.pending.length > 0) {
+                text += (text ? ', then ' : 'Queued : ') + prog.pending.join(', ');
+            }
+            return text==(shown || '') ? window.dash_clientside.no_update : text;
+        }).catch(function() { return window.dash_clientside.no_update; });
+    }
+    """,
+    Output('job-progress', 'children'),
+    [Input('progress-interval', 'n_intervals')],
+    [State('session-id', 'data'),
+     State('job-progress', 'children')])
 
 
 #
@@ -409,7 +1004,7 @@ def update_figure(selected_config,
 #
 #    traces=[]
 #    traces.append( go.Heatmap(
-#            z=tel.getImage() ))
+#            z=obsimage ))
 #
 #    return {
 #        'data': traces,
@@ -426,7 +1021,36 @@ def update_figure(selected_config,
 #    }
 
 
+#### Warm up
+
+def control_defaults():
+    """
+    Initial values of the controls (by id), from the page layout.
+    """
+    return {comp.id:comp.value for comp in serve_layout()._traverse()
+            if getattr(comp, 'id', None) in control_ids}
+
+def warmup():
+    """
+    Fill the result cache for the page as first shown, and map in the standard configurations
+    from the disk cache. Run in the background at startup (SIMMER_WARMUP=0 to skip it), so the
+    server accepts requests meanwhile; a request that comes first just computes its own results.
+    This also does the first-use work of the libraries (the FFT backend's plans, scipy.special).
+    """
+    with registry.timer('simmer_warmup_seconds'):
+        sim = newsim(cache=cache)
+        sim.simulate(stage='clean', **sim_params(control_defaults()))
+        sim.runStage('beam')
+        if diskcache is not None or sharedstore is not None:
+            cache.warmup(sim, standardParams())
+
+warmup_thread = None
+if os.environ.get('SIMMER_WARMUP', '1')!='0':
+    warmup_thread = threading.Thread(target=warmup, name='simmer-warmup', daemon=True)
+    warmup_thread.start()
+
+
 #### Start the App
 
 if __name__ == '__main__':
-    app.run_server(debug=True, port=8000, host='127.0.0.1')
+    app.run_server(debug=True, port=8000, host='127.0.0.1', threaded=True)
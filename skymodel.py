@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+"""skymodel.py: Analytic sky component models (points, Gaussians, disks) for the imaging simulator."""
+
+import numpy as np
+import hashlib
+
+## scipy.special, if available, is imported on first use (it takes longer to import than all the rest).
+_besselj1 = None
+
+
+def besselj1(x):
+    """
+    Bessel function of the first kind, order 1. Uses scipy when available,
+    otherwise the polynomial approximations of Abramowitz & Stegun (9.4.4, 9.4.6).
+    """
+    global _besselj1
+    x = np.asarray(x,'float')
+    if _besselj1 is None:
+        try:
+            from scipy.special import j1
+            _besselj1 = j1
+        except ImportError:
+            _besselj1 = False
+    if _besselj1 is not False:
+        return _besselj1(x)
+
+    ax = np.abs(x)
+    out = np.empty_like(ax)
+
+    small = ax <= 3.0
+    y = (ax[small]/3.0)**2
+    out[small] = ax[small] * (0.5 + y*(-0.56249985 + y*(0.21093573 + y*(-0.03954289
+                                    + y*(0.00443319 + y*(-0.00031761 + y*0.00001109))))))
+
+    big = ~small
+    y = 3.0/ax[big]
+    f1 = 0.79788456 + y*(0.00000156 + y*(0.01659667 + y*(0.00017105
+                        + y*(-0.00249511 + y*(0.00113653 - y*0.00020033)))))
+    t1 = ax[big] - 2.35619449 + y*(0.12499612 + y*(0.00005650 + y*(-0.00637879
+                        + y*(0.00074348 + y*(0.00079824 - y*0.00029166)))))
+    out[big] = f1*np.cos(t1)/np.sqrt(ax[big])
+
+    return np.sign(x)*out
+
+
+ARCSEC = np.pi/(180.0*3600.0)
+
+
+class SkyModel:
+    """
+    A list of sky components, in world coordinates : offsets (arcsec) from the phase centre along 
+    the two image axes (same axis conventions as CalcSim.sky : sky[x,y]).
+      point    : 'flux' (Jy) at one position (placed on the nearest pixel of the image grid)
+      gaussian : total 'flux', width 'sigma' (arcsec)
+      disk     : total 'flux', radius 'rad' (arcsec)
+    Components may have a spectral index 'spindex' : their flux is then 'flux' * (freq/'reffreq')^spindex
+    (reffreq in Hz). Without one, a component has the same flux at all frequencies.
+    """
+
+    def __init__(self, components=None):
+        self.components = list(components) if components is not None else []
+
+    def addPoint(self, xoff, yoff, flux, spindex=0.0, reffreq=1.5e+9):
+        self.components.append(self.setSpectrum({'type':'point', 'xoff':xoff, 'yoff':yoff, 'flux':flux}, spindex, reffreq))
+
+    def addGaussian(self, xoff, yoff, flux, sigma, spindex=0.0, reffreq=1.5e+9):
+        self.components.append(self.setSpectrum({'type':'gaussian', 'xoff':xoff, 'yoff':yoff, 'flux':flux, 'sigma':sigma},
+                                                spindex, reffreq))
+
+    def addDisk(self, xoff, yoff, flux, rad, spindex=0.0, reffreq=1.5e+9):
+        self.components.append(self.setSpectrum({'type':'disk', 'xoff':xoff, 'yoff':yoff, 'flux':flux, 'rad':rad},
+                                                spindex, reffreq))
+
+    def setSpectrum(self, comp, spindex, reffreq):
+        ## Flat spectrum components are left without spectral keys (so their hashes are unchanged).
+        if spindex!=0.0:
+            comp.update({'spindex':float(spindex), 'reffreq':float(reffreq)})
+        return comp
+
+    def getFlux(self, comp, freq=None):
+        """
+        Flux of a component at a frequency (Hz), or its reference flux if freq is None.
+        """
+        if freq is None or 'spindex' not in comp:
+            return comp['flux']
+        return comp['flux'] * (freq/comp['reffreq'])**comp['spindex']
+
+    def isFlat(self):
+        """
+        Whether all the components have flat spectra.
+        """
+        return all('spindex' not in comp for comp in self.components)
+
+    def getSpectralGroups(self):
+        """
+        The components grouped by spectrum, as a list of (spindex, reffreq, flat spectrum SkyModel of the group
+        at its reference fluxes). The model at any frequency is the sum of the groups scaled by (freq/reffreq)^spindex,
+        so anything linear in the sky (its transform, say) need only be computed once per group.
+        """
+        groups = {}
+        for comp in self.components:
+            spec = (comp.get('spindex',0.0), comp.get('reffreq',1.0))
+            groups.setdefault(spec, SkyModel()).components.append(
+                {key:val for key, val in comp.items() if key not in ['spindex','reffreq']})
+        return [spec + (model,) for spec, model in groups.items()]
+
+    def getHash(self):
+        """
+        Content hash of the component list, to key cached products such as ftsky.
+        """
+        desc = repr([sorted(comp.items()) for comp in self.components])
+        return hashlib.sha1(desc.encode()).hexdigest()
+
+    def getPixelPosition(self, comp, cellsize):
+        """
+        Position of a component in pixels, relative to the image centre. Points are snapped to the pixel grid.
+        """
+        xpix = comp['xoff']/cellsize
+        ypix = comp['yoff']/cellsize
+        if comp['type']=='point':
+            xpix, ypix = np.rint(xpix), np.rint(ypix)
+        return xpix, ypix
+
+    def render(self, npix, cellsize, out=None, dtype='float', freq=None):
+        """
+        Image (Jy/pixel) of all components on an npix x npix grid with the given cell size (arcsec),
+        at a frequency (Hz) or at their reference fluxes. Adds into 'out' if given.
+        """
+        sky = np.zeros((npix,npix),dtype) if out is None else out
+        cen = int(npix/2)
+        xx = (np.arange(npix,dtype='float')-cen)[:,np.newaxis]
+        yy = (np.arange(npix,dtype='float')-cen)[np.newaxis,:]
+        for comp in self.components:
+            xpix, ypix = self.getPixelPosition(comp, cellsize)
+            flux = self.getFlux(comp, freq)
+            if comp['type']=='point':
+                if 0 <= cen+xpix < npix and 0 <= cen+ypix < npix:
+                    sky[int(cen+xpix),int(cen+ypix)] += flux
+            elif comp['type']=='gaussian':
+                sig = comp['sigma']/cellsize
+                rsq = (xx-xpix)**2 + (yy-ypix)**2
+                sky += (flux/(2*np.pi*sig**2)) * np.exp(-0.5*rsq/(sig**2))
+            elif comp['type']=='disk':
+                rad = comp['rad']/cellsize
+                rsq = (xx-xpix)**2 + (yy-ypix)**2
+                sky += (flux/(np.pi*rad**2)) * (rsq < rad**2)
+            else:
+                raise ValueError("Unknown sky component type : "+str(comp['type']))
+        return sky
+
+    def predict(self, u, v, cellsize=None, dtype='complex', freq=None):
+        """
+        Analytic visibilities of all components at (u, v), in wavelengths, at a frequency (Hz) or at their
+        reference fluxes. 
+        If a cell size (arcsec) is given, point sources are snapped to that pixel grid, as in render().
+        The result (and the per-component scratch array) are of the given complex dtype.
+        On a uv grid, this matches CalcSim.ft2d(render()) (exactly for points, and up to
+        pixelisation and wrap-around of the tails for extended components).
+        """
+        u = np.asarray(u,'float')
+        v = np.asarray(v,'float')
+        vis = np.zeros(np.broadcast(u,v).shape,dtype)
+        term = np.empty(vis.shape,dtype)
+        rho = None
+        for comp in self.components:
+            if cellsize is not None:
+                xpix, ypix = self.getPixelPosition(comp, cellsize)
+                lpos, mpos = xpix*cellsize*ARCSEC, ypix*cellsize*ARCSEC
+            else:
+                lpos, mpos = comp['xoff']*ARCSEC, comp['yoff']*ARCSEC
+            ## Separable phase ramp : on a grid (u as a column, v as a row) this costs only 2*npix exponentials.
+            np.multiply( np.exp( (-2j*np.pi*lpos) * u ), np.exp( (-2j*np.pi*mpos) * v ), out=term )
+            term *= self.getFlux(comp, freq)
+            if comp['type']!='point':
+                if rho is None:
+                    rho = np.sqrt(u**2 + v**2)
+                if comp['type']=='gaussian':
+                    sig = comp['sigma']*ARCSEC
+                    term *= np.exp(-2*(np.pi*sig*rho)**2)
+                elif comp['type']=='disk':
+                    arg = 2*np.pi*comp['rad']*ARCSEC*rho
+                    safe = np.where(arg>0, arg, 1.0)
+                    term *= np.where(arg>0, 2*besselj1(safe)/safe, 1.0)
+                else:
+                    raise ValueError("Unknown sky component type : "+str(comp['type']))
+            vis += term
+        return vis
+
+    def ftGrid(self, ngrid, cellsize, dtype='complex', freq=None):
+        """
+        Analytic Fourier transform of the model on the full (centred) ngrid x ngrid uv grid 
+        that corresponds to an image of ngrid pixels of the given cell size (arcsec), at a frequency (Hz).
+        """
+        cen = int(ngrid/2)
+        du = 1.0/(ngrid*cellsize*ARCSEC)
+        uu = ((np.arange(ngrid,dtype='float')-cen)*du)[:,np.newaxis]
+        vv = ((np.arange(ngrid,dtype='float')-cen)*du)[np.newaxis,:]
+        return self.predict(uu, vv, cellsize, dtype, freq)
@@ -0,0 +1,44 @@
+"""CLEAN converges on the web app's default image, with the gains its slider allows."""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('SIMMER_CACHE_DIR', '')
+os.environ.setdefault('SIMMER_WARMUP', '0')
+
+import simmer
+import deconvolver
+from calcsim import CalcSim
+
+
+def defaultSim(padding):
+    sim = CalcSim(npix=256, padding=padding)
+    params = simmer.sim_params(simmer.control_defaults())
+    params.update(npix=256, padding=padding)
+    sim.simulate(stage='image', **params)
+    return sim
+
+
+@pytest.mark.parametrize('gain', [0.1, 0.5])
+@pytest.mark.parametrize('padding', [1.0, 2.0])
+def test_hogbom_residual_falls(gain, padding):
+    sim = defaultSim(padding)
+    psf = sim.getCleanPSF()
+    residual = sim.obssky
+    peaks = [np.max(np.abs(residual))]
+    for step in range(10):
+        model, residual, niter = deconvolver.hogbom(residual, psf, niter=100, gain=gain)
+        peaks.append(np.max(np.abs(residual)))
+    assert np.all(np.diff(peaks) <= 0)
+    assert peaks[-1] < 1e-2*peaks[0]
+
+
+@pytest.mark.parametrize('padding', [1.0, 2.0])
+def test_clark_converges(padding):
+    sim = defaultSim(padding)
+    sim.simulate(stage='clean', cleanalgo='clark', cleangain=0.5, cleaniter=2000, cleanthresh=0.0)
+    assert np.max(np.abs(sim.cleanresidual)) < 1e-2*np.max(np.abs(sim.obssky))
@@ -0,0 +1,57 @@
+"""Gridding the sky times the gain-product grid is gridding the corrupted visibilities one by one."""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('SIMMER_CACHE_DIR', '')
+os.environ.setdefault('SIMMER_WARMUP', '0')
+
+import simmer
+from calcsim import CalcSim
+from gridder import gridIndices
+
+
+def explicitGridding(sim):
+    """
+    The mean corrupted visibility in each uv cell, summed one visibility (and its conjugate) at a time.
+    """
+    freqs = sim.getChannelFrequencies()
+    uvws = sim.calcBaselineUVWs(hourangles=sim.hourangles, declination=sim.params['dec'],
+                                obslatitude=sim.params['obslatitude'], fratios=freqs/sim.clight)
+    ant1, ant2 = sim.getBaselineIndices()
+    gainidx = sim.getGainIndices()
+    scale = 1.0/sim.getUVCellSize()
+    skyvis = sim.ftskyobs.astype('complex128')
+    grid = np.zeros(skyvis.shape, 'complex128')
+    counts = np.zeros(skyvis.shape, 'float64')
+    for tt in range(uvws.shape[0]):
+        gains = sim.gains[gainidx[tt]].astype('complex128')
+        for bb in range(uvws.shape[1]):
+            prod = gains[ant1[bb]]*np.conj(gains[ant2[bb]])
+            for cc in range(uvws.shape[2]):
+                u, v = uvws[tt,bb,cc,0]*scale, uvws[tt,bb,cc,1]*scale
+                for sign, val in [(1, prod), (-1, np.conj(prod))]:
+                    x, y = gridIndices(sign*u, sign*v, sim.ngrid)
+                    grid[x,y] += sim.tweights[tt]*val*skyvis[x,y]
+                    counts[x,y] += sim.tweights[tt]
+    sampled = counts > 0
+    grid[sampled] /= counts[sampled]
+    return grid, sampled
+
+
+@pytest.mark.parametrize('gaintype', ['offset', 'randomwalk'])
+def test_gaingrid_matches_explicit_gridding(gaintype):
+    sim = CalcSim(npix=128)
+    params = simmer.sim_params(simmer.control_defaults())
+    params.update(npix=128, nant=6, bwr=[1.0,1.5], gaintype=gaintype, gainamp=0.2, gainphase=30.0)
+    sim.simulate(stage='image', **params)
+
+    grid, sampled = explicitGridding(sim)
+    assert np.array_equal(sampled, sim.uvcounts > 0)
+    corrupted = sim.ftskyobs.astype('complex128')*sim.gaingrid
+    scale = np.max(np.abs(grid))
+    assert np.max(np.abs(corrupted[sampled] - grid[sampled])) < 1e-12*scale
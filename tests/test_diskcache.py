@@ -0,0 +1,35 @@
+"""Precomputed standard configurations are found on disk by the web app's requests."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('SIMMER_CACHE_DIR', '')
+os.environ.setdefault('SIMMER_WARMUP', '0')
+
+import simmer
+from calcsim import CalcSim
+from diskcache import DiskCache, precompute, standardParams
+
+
+def test_precompute_serves_ui_requests(tmp_path):
+    paramsets = standardParams()[0:2]
+    precompute(DiskCache(str(tmp_path)), paramsets=paramsets)
+
+    ## A new process's view of the cache : nothing in memory, everything from disk.
+    sim = CalcSim(cache=DiskCache(str(tmp_path)))
+    for params in paramsets:
+        values = simmer.control_defaults()
+        values.update({'config-dropdown':params['configtype'], 'nant-dropdown':str(params['nant']),
+                       'source-dropdown':params['imtype']})
+        uiparams = simmer.sim_params(values)
+        assert sim.simulate(stage='psf', **uiparams) == []
+        assert sim.simulate(stage='sky', **uiparams) == []
+
+
+def test_random_layouts_not_on_disk(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    sim = CalcSim(cache=cache)
+    sim.simulate(stage='psf', configtype='RandomConfig', changeseed=True)
+    assert cache.getStats()['items'] == 0
+    assert 'uvws' not in cache.stages
@@ -0,0 +1,44 @@
+"""Visibility noise follows the radiometer equation, and the image noise is the predicted 'noiserms'."""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('SIMMER_CACHE_DIR', '')
+os.environ.setdefault('SIMMER_WARMUP', '0')
+
+import simmer
+from calcsim import CalcSim
+
+
+def test_radiometer_equation():
+    sim = CalcSim(npix=128)
+    sim.simulate(stage='psf', npix=128, configtype='YConfig', nant=6, dishdiam=25.0)
+    tsys, inttime, chanwidth = 50.0, 900.0, 0.1e+9
+    ## SEFD = 2 k Tsys / (eta A), in Jy, for a 25 m dish of aperture efficiency 0.7.
+    sefd = 2*1.380649e-23*tsys/(0.7*np.pi*12.5**2) / 1e-26
+    sigmas = sim.getVisNoise(tsys, inttime=inttime, chanwidth=chanwidth)
+    assert len(sigmas) == 15
+    assert np.allclose(sigmas, sefd/np.sqrt(2*chanwidth*inttime), rtol=1e-12, atol=0)
+
+
+@pytest.mark.parametrize('noisemode', ['gridded', 'visibility'])
+@pytest.mark.parametrize('weighting', [3.5, -2.0])
+def test_image_noise_rms(noisemode, weighting):
+    sim = CalcSim(npix=256)
+    params = simmer.sim_params(simmer.control_defaults())
+    params.update(npix=256, weighting=weighting, noisemode=noisemode)
+    sim.simulate(stage='image', **params)
+    clean = np.array(sim.obssky, copy=True)
+
+    ## The image is linear in the visibilities, so the difference is the image of the noise alone.
+    ## A few heavily weighted cells dominate one image's rms, so the variance is averaged over several seeds.
+    variances = []
+    for seed in range(1, 9):
+        sim.simulate(stage='image', tsys=50.0, noiseseed=seed)
+        variances.append(np.var(sim.obssky - clean))
+    assert sim.noiserms > 0
+    assert abs(np.sqrt(np.mean(variances))/sim.noiserms - 1) < 0.1
@@ -0,0 +1,72 @@
+"""The batched uvw calculations give the uvws of the original antenna by antenna projection."""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('SIMMER_CACHE_DIR', '')
+os.environ.setdefault('SIMMER_WARMUP', '0')
+
+from calcsim import CalcSim
+
+
+def projectAntennas(sim, hourangle, declination, obslatitude):
+    """
+    UVWs (nant, 3) of each antenna, projected one at a time onto the rotated local axes (see localxyz2uvw).
+    """
+    latrot = -90+obslatitude
+    dirs = [sim.localxyz2uvw(np.eye(3)[ax]*1000.0, hourangle, declination, latrot) for ax in range(3)]
+    antuvws = np.zeros((len(sim.antennalist['EastLoc']), 3))
+    for ant in range(len(antuvws)):
+        axyz = np.array([sim.antennalist['EastLoc'][ant], sim.antennalist['NorthLoc'][ant],
+                         sim.antennalist['ElevLoc'][ant]], 'float')
+        for ax in range(3):
+            antuvws[ant,ax] = np.dot(axyz, dirs[ax])/np.linalg.norm(dirs[ax])
+    return antuvws
+
+
+@pytest.fixture(scope='module')
+def sim():
+    sim = CalcSim(npix=128)
+    sim.simulate(stage='psf', npix=128, configtype='YConfig', nant=12)
+    return sim
+
+
+@pytest.mark.parametrize('declination, obslatitude', [(60.0, 34.0), (-30.0, -23.0)])
+def test_antenna_uvws(sim, declination, obslatitude):
+    hourangles = sim.getHourAngles([-3.0,2.0])
+    antuvws = sim.calcAntUVWs(hourangles, declination, obslatitude)
+    scale = np.max(np.abs(antuvws))
+    for tt, hourangle in enumerate(hourangles):
+        expected = projectAntennas(sim, hourangle, declination, obslatitude)
+        assert np.max(np.abs(antuvws[tt] - expected)) < 1e-12*scale
+        assert np.max(np.abs(sim.getAntUVWs(hourangle, declination, obslatitude) - expected)) < 1e-12*scale
+
+
+def test_baseline_uvws(sim):
+    hourangles = sim.getHourAngles([-1.0,1.0])
+    fratios = sim.getFrequencies([1.0,1.5])/sim.clight
+    bluvws = sim.calcBaselineUVWs(hourangles, 60.0, 34.0, fratios)
+    ant1, ant2 = sim.getBaselineIndices()
+    assert bluvws.shape == (len(hourangles), len(ant1), len(fratios), 3)
+    scale = np.max(np.abs(bluvws))
+    for tt, hourangle in enumerate(hourangles):
+        antuvws = projectAntennas(sim, hourangle, 60.0, 34.0)
+        for bb in range(len(ant1)):
+            for cc, fratio in enumerate(fratios):
+                expected = (antuvws[ant1[bb]] - antuvws[ant2[bb]])*fratio
+                assert np.max(np.abs(bluvws[tt,bb,cc] - expected)) < 1e-12*scale
+
+
+def test_antenna_uvw_list_order(sim):
+    has, bwr = [-1.0,1.0], [1.0,1.5]
+    flocs = sim.calcAntUVWList(has=has, dec=60.0, obslatitude=34.0, bwr=bwr)
+    maxval = sim.getUVCellSize()*sim.ngrid/2
+    expected = [projectAntennas(sim, hourangle, 60.0, 34.0)[ant,0:2]*fratio/maxval
+                for fratio in sim.getFrequencies(bwr)/sim.clight
+                for hourangle in sim.getHourAngles(has)
+                for ant in range(len(sim.antennalist['EastLoc']))]
+    assert np.allclose(flocs, expected, rtol=0, atol=1e-12*np.max(np.abs(flocs)))
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+"""transport.py: Compact encodings of images for the browser (typed arrays, quantised uint8, PNG)."""
+
+import base64
+import hashlib
+import struct
+import zlib
+
+import numpy as np
+
+
+## Encodings of a heatmap's values :
+##   uint8   : values quantised to 256 levels, sent as a base64 typed array (the colorbar is relabelled),
+##   float32 : full values as a base64 float32 typed array,
+##   png     : a colour-mapped PNG image (no colorbar or hover values),
+##   json    : nested lists of floats, as before.
+transports = ['uint8', 'float32', 'png', 'json']
+
+## A few of plotly.js's named colorscales (its default RdBu first), as [fraction, (r,g,b)] stops,
+## so that PNG images can be colour-mapped on the server to match the heatmaps.
+colorscales = {
+    'RdBu'    : [[0.0, (5,10,172)], [0.35, (106,137,247)], [0.5, (190,190,190)],
+                 [0.6, (220,170,132)], [0.7, (230,145,90)], [1.0, (178,10,32)]],
+    'Viridis' : [[0.0, (68,1,84)], [0.125, (71,45,123)], [0.25, (59,82,139)], [0.375, (44,114,142)],
+                 [0.5, (33,145,140)], [0.625, (40,174,128)], [0.75, (94,201,98)], [0.875, (173,220,48)],
+                 [1.0, (253,231,37)]],
+    'Hot'     : [[0.0, (0,0,0)], [0.3, (230,0,0)], [0.6, (255,210,0)], [1.0, (255,255,255)]],
+    'Greys'   : [[0.0, (0,0,0)], [1.0, (255,255,255)]] }
+
+
+def downsample(arr, maxsize=None):
+    """
+    Block-average an image down to at most maxsize pixels on a side (whole blocks only).
+    Returns the image and the block size.
+    """
+    if maxsize is None or max(arr.shape) <= maxsize:
+        return arr, 1
+    fac = -(-max(arr.shape)//maxsize)
+    ny, nx = arr.shape[0]//fac, arr.shape[1]//fac
+    return arr[0:ny*fac, 0:nx*fac].reshape(ny, fac, nx, fac).mean(axis=(1,3)), fac
+
+
+def quantise(arr, vmin=None, vmax=None):
+    """
+    Values scaled to 0..255 between vmin and vmax (default : the data range), as uint8.
+    """
+    vmin = float(np.min(arr)) if vmin is None else vmin
+    vmax = float(np.max(arr)) if vmax is None else vmax
+    scale = 255.0/(vmax-vmin) if vmax > vmin else 0.0
+    levels = np.clip(np.rint((arr-vmin)*scale), 0, 255).astype('uint8')
+    return levels, vmin, vmax
+
+
+def encodeArray(arr):
+    """
+    A plotly.js typed-array spec : base64 of the raw little-endian data, with its dtype and shape.
+    """
+    arr = np.ascontiguousarray(arr, arr.dtype.newbyteorder('<'))
+    return {'dtype': {'uint8':'u1', 'float32':'f4', 'float64':'f8'}[arr.dtype.name],
+            'bdata': base64.b64encode(arr.tobytes()).decode('ascii'),
+            'shape': ','.join(str(dim) for dim in arr.shape)}
+
+
+def colourLUT(colorscale='RdBu'):
+    """
+    (256, 3) uint8 lookup table, linearly interpolated along a colorscale (a name from 'colorscales', 
+    or a list of [fraction, (r,g,b)] stops).
+    """
+    if isinstance(colorscale, str):
+        colorscale = colorscales[colorscale]
+    fracs = [stop[0] for stop in colorscale]
+    levels = np.linspace(0.0, 1.0, 256)
+    return np.stack([ np.interp(levels, fracs, [stop[1][chan] for stop in colorscale]) for chan in range(3) ],
+                    axis=-1).round().astype('uint8')
+
+
+def encodePNG(rgb):
+    """
+    An (ny, nx, 3) uint8 image as PNG bytes (8-bit RGB, no filtering, zlib compressed).
+    """
+    ny, nx = rgb.shape[0:2]
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag+data) & 0xffffffff)
+    ## Each row starts with its filter type (0 : none)
+    rows = np.zeros((ny, 1+3*nx), 'uint8')
+    rows[:,1:] = rgb.reshape(ny, 3*nx)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', nx, ny, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(rows.tobytes(), 6)) + chunk(b'IEND', b''))
+
+
+def heatmapTrace(arr, transport='uint8', maxsize=None, colorscale='RdBu'):
+    """
+    A plotly trace (dict) showing an image, in the given transport encoding, optionally downsampled
+    to maxsize pixels on a side. Axes stay in units of the original pixels.
+    For 'png', the figure's y axis must have autorange=True (image traces otherwise reverse it).
+    """
+    if transport not in transports:
+        raise ValueError("Unknown transport : "+str(transport))
+    img, fac = downsample(np.asarray(arr), maxsize)
+    ## Centres of the averaged blocks, in original pixels
+    axes = {'x0':(fac-1)/2.0, 'dx':fac, 'y0':(fac-1)/2.0, 'dy':fac}
+
+    if transport=='json':
+        return dict(type='heatmap', z=img.tolist(), colorscale=colorscale, **axes)
+    if transport=='float32':
+        return dict(type='heatmap', z=encodeArray(img.astype('float32')), colorscale=colorscale, **axes)
+
+    levels, vmin, vmax = quantise(img)
+    if transport=='png':
+        ## On a non-reversed y axis, plotly draws an image's first row at y0 (the bottom), as a heatmap draws z[0].
+        png = encodePNG(colourLUT(colorscale)[levels])
+        return dict(type='image', source='data:image/png;base64,'+base64.b64encode(png).decode('ascii'),
+                    hoverinfo='x+y', **axes)
+
+    ## uint8 : the colorbar is labelled with the original values
+    ticks = np.linspace(0, 255, 6)
+    return dict(type='heatmap', z=encodeArray(levels), zmin=0, zmax=255, colorscale=colorscale, **axes,
+                colorbar={'tickvals':ticks.tolist(),
+                          'ticktext':['%.3g'%(vmin+(vmax-vmin)*tick/255.0) for tick in ticks]},
+                hovertemplate='x: %{x}<br>y: %{y}<extra></extra>')
+
+
+def contourTrace(arr, maxsize=None, start=0.1, end=0.9, step=0.2, colour='black'):
+    """
+    A plotly trace (dict) of labelled contour lines (from start to end, every step) of an image, 
+    e.g. a primary beam drawn over a heatmap of the same size, optionally downsampled to maxsize 
+    pixels on a side. Axes stay in units of the original pixels.
+    """
+    img, fac = downsample(np.asarray(arr), maxsize)
+    return dict(type='contour', z=encodeArray(img.astype('float32')), x0=(fac-1)/2.0, dx=fac, y0=(fac-1)/2.0, dy=fac,
+                autocontour=False, contours={'start':start, 'end':end, 'size':step, 'coloring':'lines', 'showlabels':True},
+                line={'color':colour, 'width':1}, showscale=False, hoverinfo='skip')
+
+
+def payloadKey(*parts):
+    """
+    Short digest of whatever determines a figure's contents (e.g. stage keys and display settings),
+    so that the browser can hold on to it and unchanged figures need not be resent.
+    """
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()[0:16]